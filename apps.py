@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class TranscriptionsConfig(AppConfig):
     name = 'transcriptions'
+
+    def ready(self):
+        # connects the worker_process_init signal which warms up new celery worker processes
+        from transcriptions import warmup  # noqa: F401
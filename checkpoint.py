@@ -0,0 +1,34 @@
+import os
+import json
+
+
+class Checkpoint(object):
+    """Record of completed work items so that an interrupted batch run can be resumed.
+
+    Each entry is stored against a key (a file path or a transcription identifier) along with a
+    fingerprint of the content that was processed so that changed content is not skipped.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        if path is not None and os.path.exists(path):
+            with open(path, encoding='utf-8') as checkpoint_file:
+                self.entries = json.load(checkpoint_file)
+
+    def is_done(self, key, fingerprint):
+        return key in self.entries and self.entries[key].get('fingerprint') == fingerprint
+
+    def mark_done(self, key, fingerprint, **details):
+        details['fingerprint'] = fingerprint
+        self.entries[key] = details
+        self.save()
+
+    def save(self):
+        if self.path is None:
+            return
+        # write to a temporary file and then replace so an interruption never leaves a truncated checkpoint
+        temp_path = '{}.tmp'.format(self.path)
+        with open(temp_path, 'w', encoding='utf-8') as checkpoint_file:
+            json.dump(self.entries, checkpoint_file, indent=1, sort_keys=True)
+        os.replace(temp_path, self.path)
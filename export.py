@@ -0,0 +1,149 @@
+"""Export collation units as newline delimited JSON (NDJSON) or read them as a JSON array.
+
+The units are read through a server side cursor so an export of any size runs in constant memory.
+The witnesses are read as the JSON text stored in the database and passed through without being
+decoded and encoded again unless they are stored in the compact format and the expanded shape
+produced by the word parser is requested. orjson is used to encode the units if it is installed.
+
+The read path (generate_json) only reads the fields which are asked for, so the TEI is not read
+unless it is wanted, and gives the related objects as their ids as the API serializer does."""
+
+import re
+import json
+from django.db.models import Q, TextField
+from django.db.models.functions import Cast
+from transcriptions import fields, models, witness_format
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+EXPORT_FIELDS = ['identifier', 'context', 'siglum', 'transcription_identifier', 'language', 'chapter_number',
+                 'stanza_number', 'line_number', 'duplicate_position', 'index']
+
+EXPORT_CHUNK_SIZE = 2000
+
+READ_FIELDS = ['id', 'identifier', 'index', 'document_id', 'context', 'reference', 'chapter_number', 'stanza_number',
+               'line_number', 'siglum', 'language', 'duplicate_position', 'transcription', 'transcription_siglum',
+               'siglum_sort_key', 'transcription_identifier', 'user', 'work', 'public', 'witnesses', 'tei']
+
+# the tei is large and only needed for reparsing so it must be asked for
+DEFAULT_READ_FIELDS = [field for field in READ_FIELDS if field != 'tei']
+
+READ_SOURCES = {'transcription': 'transcription_id', 'user': 'user_id', 'work': 'work_id'}
+
+
+def parse_context(context):
+    """Return the chapter, stanza and line numbers of a context such as Y.28.1.2, missing parts are None."""
+    match = re.match(r'^[A-Za-z]\w*\.(\d+)(?:\.(\d+))?(?:\.(\d+))?$', context)
+    if match is None:
+        raise ValueError('{} is not a valid context.'.format(context))
+    return [int(number) if number is not None else None for number in match.groups()]
+
+
+def get_context_filter(context, after=True):
+    # lexicographic comparison of (chapter, stanza, line) with the given context, missing parts of the
+    # context match any value so Y.28 to Y.29 includes all of chapter 29
+    lookup = 'gt' if after else 'lt'
+    fields = ['chapter_number', 'stanza_number', 'line_number']
+    numbers = [(field, number) for field, number in zip(fields, parse_context(context)) if number is not None]
+    condition = Q()
+    for field, number in reversed(numbers):
+        if len(condition) == 0:
+            condition = Q(**{'{}__{}'.format(field, lookup): number}) | Q(**{field: number})
+        else:
+            condition = Q(**{'{}__{}'.format(field, lookup): number}) | (Q(**{field: number}) & condition)
+    return condition
+
+
+def get_export_units(work=None, start=None, end=None, languages=None, sigla=None):
+    units = models.CollationUnit.objects.all()
+    if work is not None:
+        units = units.filter(work__abbreviation=work)
+    if start is not None:
+        units = units.filter(get_context_filter(start, after=True))
+    if end is not None:
+        units = units.filter(get_context_filter(end, after=False))
+    if languages:
+        units = units.filter(language__in=languages)
+    if sigla:
+        units = units.filter(siglum__in=sigla)
+    return units.order_by('chapter_number', 'stanza_number', 'line_number', 'siglum_sort_key', 'siglum',
+                          'duplicate_position', 'language')
+
+
+def encode(row):
+    if orjson is not None:
+        return orjson.dumps(row)
+    return json.dumps(row, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def decode(text):
+    if orjson is not None:
+        return orjson.loads(text)
+    return json.loads(text)
+
+
+def encode_witnesses(witnesses, compact=False):
+    """Return the witnesses read as JSON text from the database as UTF-8 JSON in the format asked for.
+
+    The stored text is passed through unless the witnesses are stored in the compact format and the
+    expanded format is asked for. Units indexed before the compact format was introduced are stored in
+    the expanded shape, a list, and are passed through in both cases as witness_format.expand()
+    returns them unchanged.
+    """
+    if witnesses is None:
+        return b'null'
+    if compact or witnesses.startswith('['):
+        return witnesses.encode('utf-8')
+    return encode(witness_format.expand(decode(witnesses)))
+
+
+def generate_lines(units, compact=False):
+    """Yield each unit as a line of JSON encoded as UTF-8."""
+    # the witnesses are read as text so that they are only decoded when they must be expanded
+    rows = units.annotate(witnesses_json=Cast('witnesses_fragment__witnesses', TextField())).values_list(
+        *EXPORT_FIELDS, 'witnesses_json').iterator(chunk_size=EXPORT_CHUNK_SIZE)
+    for row in rows:
+        encoded = encode(dict(zip(EXPORT_FIELDS, row[:-1])))
+        yield b''.join([encoded[:-1], b',"witnesses":', encode_witnesses(row[-1], compact=compact), b'}\n'])
+
+
+def get_read_fields(requested=None):
+    """Return the fields to read from a comma separated list of field names or the default fields if there is none."""
+    if not requested:
+        return DEFAULT_READ_FIELDS
+    read_fields = [field.strip() for field in requested.split(',') if field.strip() != '']
+    unknown = [field for field in read_fields if field not in READ_FIELDS]
+    if len(unknown) > 0:
+        raise ValueError('Unknown fields {}, the fields are {}.'.format(', '.join(unknown), ', '.join(READ_FIELDS)))
+    return read_fields
+
+
+def generate_json(units, read_fields, compact=False):
+    """Yield the fields of the units as a JSON array encoded as UTF-8, one unit at a time."""
+    columns = [field for field in read_fields if field not in ['witnesses', 'tei']]
+    sources = [READ_SOURCES.get(field, field) for field in columns]
+    if 'witnesses' in read_fields:
+        # read as text so that the compact witnesses need not be decoded at all
+        units = units.annotate(witnesses_json=Cast('witnesses_fragment__witnesses', TextField()))
+        sources.append('witnesses_json')
+    if 'tei' in read_fields:
+        sources.append('tei_fragment__tei')
+    rows = units.values_list(*sources).iterator(chunk_size=EXPORT_CHUNK_SIZE)
+    separator = b'['
+    for row in rows:
+        values = dict(zip(sources, row))
+        # the fields encoded together without the enclosing braces
+        parts = [encode({field: values[source] for field, source in zip(columns, sources)})[1:-1]]
+        if 'witnesses' in read_fields:
+            parts.append(b'"witnesses":' + encode_witnesses(values['witnesses_json'], compact=compact))
+        if 'tei' in read_fields:
+            tei = values['tei_fragment__tei']
+            parts.append(b'"tei":' + encode(fields.decompress(tei) if tei is not None else None))
+        yield separator + b'{' + b','.join(part for part in parts if part) + b'}'
+        separator = b','
+    if separator == b'[':
+        yield b'['
+    yield b']'
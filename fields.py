@@ -0,0 +1,112 @@
+"""Model fields for the transcriptions app."""
+
+import zlib
+from django.db import models
+from django.db.models.query_utils import DeferredAttribute
+
+# each compressed value starts with the magic bytes followed by the id of the dictionary used
+MAGIC = b'\x00TZ'
+
+# zlib preset dictionaries of the strings most common in MUYA TEI, the most frequent last as zlib
+# favours the end of the dictionary. A dictionary must never be changed once values have been
+# compressed with it, a new one should be added with the next id and made the default instead.
+DICTIONARIES = {
+    1: ''.join([
+        '<?xml version="1.0" encoding="UTF-8"?>',
+        '<teiHeader><fileDesc><titleStmt><title type="document" n="" key=""></title></titleStmt>',
+        '<publicationStmt><p></p></publicationStmt><sourceDesc><listWit><witness xml:id="corrector"/>',
+        '<witness xml:id="firsthand"/></listWit></sourceDesc></fileDesc></teiHeader>',
+        '<div type="chapter" n="Y.', '<div type="stanza" n="Y.', '</div>',
+        '<note type="transcriptionRD">', '<ab type="ritualdirection" n="', '</note>',
+        '<gap reason="lacuna" unit="word" quantity="', '<gap reason="abbreviatedText"/>',
+        '<gap reason="illegible" unit="character" extent="',
+        '<supplied reason="omitted">', '</supplied>', '<unclear>', '</unclear>',
+        ' xml:lang="sa" subtype="translation"', ' xml:lang="pal-Phlv" subtype="commentary"',
+        '<rdg type="corr" hand="corrector">', '<app><rdg type="orig" hand="firsthand">', '</rdg>', '</app>',
+        '<pb n="', '<cb n="', '<lb n="', '<fw type="pageNum">', '</fw>', '<seg type="', '</seg>',
+        '<space unit="character" quantity="', '<ab type="line" n="Y.', '</ab>',
+        ' xmlns="http://www.tei-c.org/ns/1.0"', '<w lemma="', '<pc>.</pc>', '<pc>:</pc>', '</w> <w>', '<w>', '</w>',
+    ]).encode('utf-8'),
+}
+
+DEFAULT_DICTIONARY = 1
+
+COMPRESSION_LEVEL = 6
+
+
+class CompressedText(bytes):
+    """The compressed bytes of a value read from the database, decompressed by decompress()."""
+
+
+def compress(text, dictionary_id=DEFAULT_DICTIONARY):
+    compressor = zlib.compressobj(COMPRESSION_LEVEL, zdict=DICTIONARIES[dictionary_id])
+    return MAGIC + bytes([dictionary_id]) + compressor.compress(text.encode('utf-8')) + compressor.flush()
+
+
+def decompress(data):
+    data = bytes(data)
+    if not data.startswith(MAGIC):
+        # not compressed
+        return data.decode('utf-8')
+    dictionary_id = data[len(MAGIC)]
+    decompressor = zlib.decompressobj(zdict=DICTIONARIES[dictionary_id])
+    return (decompressor.decompress(data[len(MAGIC) + 1:]) + decompressor.flush()).decode('utf-8')
+
+
+class CompressedTextDescriptor(DeferredAttribute):
+    """Decompress the value of the field the first time it is read from a model instance."""
+
+    def __get__(self, instance, cls=None):
+        value = super().__get__(instance, cls)
+        if isinstance(value, CompressedText):
+            value = decompress(value)
+            instance.__dict__[self.field.attname] = value
+        return value
+
+    def __set__(self, instance, value):
+        instance.__dict__[self.field.attname] = value
+
+
+class CompressedTextField(models.TextField):
+    """A text field stored compressed with zlib and a preset dictionary in a binary column.
+
+    The value of the field on a model instance is the text, it is only decompressed when it is first
+    read and an instance saved without reading it writes back the compressed bytes unchanged. Queries
+    using values() or values_list() return CompressedText which can be read with decompress(). The
+    column cannot be used for text lookups.
+    """
+
+    descriptor_class = CompressedTextDescriptor
+
+    def db_type(self, connection):
+        return connection.data_types['BinaryField']
+
+    def from_db_value(self, value, expression, connection):
+        if value is None:
+            return None
+        return CompressedText(value)
+
+    def to_python(self, value):
+        if isinstance(value, (bytes, memoryview)):
+            return decompress(value)
+        return super().to_python(value)
+
+    def pre_save(self, model_instance, add):
+        # avoid decompressing a value which has not been read just to compress it again
+        if self.attname in model_instance.__dict__:
+            return model_instance.__dict__[self.attname]
+        return super().pre_save(model_instance, add)
+
+    def get_prep_value(self, value):
+        if value is None or isinstance(value, bytes):
+            return value
+        return compress(super().get_prep_value(value))
+
+    def get_db_prep_value(self, value, connection, prepared=False):
+        value = super().get_db_prep_value(value, connection, prepared)
+        if value is not None:
+            return connection.Database.Binary(value)
+        return value
+
+    def value_to_string(self, obj):
+        return self.value_from_object(obj)
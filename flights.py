@@ -0,0 +1,81 @@
+"""Keep a single indexing task in flight for each transcription.
+
+The task indexing each transcription is recorded in the Django cache under a key made from the parts
+of the transcription identifier (the collection, siglum, main language, chapter range and user), which
+are read from the TEI without parsing the transcription, along with a digest of the content and
+options it was given. A request to index the same content again is given the task already in flight
+and a request with different content supersedes it. A task which has finished, or which has not
+reported any progress for TRANSCRIPTIONS_FLIGHT_STALE seconds because its worker died, is no longer
+in flight. The cache only saves wasted work, the saves are serialised for each identifier by a
+database advisory lock in save_transcription so two tasks can never replace the same collation units
+at once."""
+
+import json
+import time
+import hashlib
+from lxml import etree
+from celery import states
+from celery.backends.base import DisabledBackend
+from celery.result import AsyncResult
+from django.conf import settings
+from django.core.cache import cache
+from transcriptions import progress
+from transcriptions.yasna_parser import get_chapter_range
+
+FLIGHT_TIMEOUT = 60 * 60 * 24
+
+FLIGHT_STALE = 60 * 10
+
+FINISHED_STATES = ['SUCCESS', 'FAILURE', 'SUPERSEDED']
+
+NSMAP = {'tei': 'http://www.tei-c.org/ns/1.0'}
+
+
+def get_key(collection, siglum, user, xml_string):
+    root = etree.fromstring(xml_string)
+    languages = root.xpath('.//tei:text/@xml:lang', namespaces=NSMAP)
+    main_language = languages[0].lower() if len(languages) > 0 else ''
+    return 'transcriptions:flight:{}:{}:{}:{}:{}'.format(collection, siglum, main_language,
+                                                         get_chapter_range(root, NSMAP), user)
+
+
+def get_digest(xml_string, public_flag, languages):
+    options = json.dumps([bool(public_flag), sorted(languages)])
+    return hashlib.sha256(options.encode('utf-8') + b'\0' + xml_string.encode('utf-8')).hexdigest()
+
+
+def get_current(key):
+    """Return the task id and digest of the task in flight for the key or None if it has finished."""
+    current = cache.get(key)
+    if current is None:
+        return None
+    state = progress.get_progress(current['task_id'])
+    if state is not None and state['state'] in FINISHED_STATES:
+        return None
+    # a task whose worker died never publishes that it has finished
+    updated = max(current.get('registered', 0), state.get('updated', 0) if state is not None else 0)
+    if time.time() - updated > getattr(settings, 'TRANSCRIPTIONS_FLIGHT_STALE', FLIGHT_STALE):
+        return None
+    # the result backend records the failure of a task whose worker process was lost
+    result = AsyncResult(current['task_id'])
+    if not isinstance(result.backend, DisabledBackend) and result.state in states.READY_STATES:
+        return None
+    return current
+
+
+def register(key, task_id, digest):
+    cache.set(key, {'task_id': task_id, 'digest': digest, 'registered': time.time()}, FLIGHT_TIMEOUT)
+
+
+def get_task_id(key):
+    return cache.get(key, {}).get('task_id')
+
+
+def is_current(key, task_id):
+    current_task_id = get_task_id(key)
+    return current_task_id is None or current_task_id == task_id
+
+
+def finish(key, task_id):
+    if get_task_id(key) == task_id:
+        cache.delete(key)
@@ -0,0 +1,165 @@
+import os
+import json
+import time
+import tracemalloc
+from django.core.management.base import BaseCommand, CommandError
+from transcriptions.synthetic import generate_transcription
+from transcriptions.yasna_parser import YasnaParser
+from transcriptions.yasna_word_parser import YasnaWordParser
+
+SCENARIOS = {
+    'small': {'chapters': 1, 'stanzas': 5, 'lines': 4},
+    'medium': {'chapters': 4, 'stanzas': 15, 'lines': 5},
+    'large': {'chapters': 10, 'stanzas': 30, 'lines': 6},
+}
+
+STAGES = ['parse', 'units', 'words']
+
+
+def run_pipeline(xml_string, languages, timings):
+    """Run the indexing pipeline recording the time taken by each stage in timings."""
+    start = time.perf_counter()
+    parser = YasnaParser(xml_string, collection='AV', user_id=1, languages=languages)
+    timings['parse'] += time.perf_counter() - start
+
+    start = time.perf_counter()
+    transcription = parser.get_transcription()
+    all_units = {}
+    for language in languages:
+        all_units[language] = parser.get_all_collation_units(language)
+    timings['units'] += time.perf_counter() - start
+
+    start = time.perf_counter()
+    corrector_order = None
+    if 'corrector_order' in transcription:
+        corrector_order = parser.doctor_corrector_order(transcription['corrector_order'])
+    word_parser = YasnaWordParser()
+    for language in languages:
+        for unit in all_units[language]:
+            word_parser.parse_unit(unit, corrector_order)
+    timings['words'] += time.perf_counter() - start
+    return all_units
+
+
+def measure_memory(xml_string, languages):
+    """Return the peak python memory allocated by each stage of the pipeline."""
+    peaks = {}
+    tracemalloc.start()
+    parser = YasnaParser(xml_string, collection='AV', user_id=1, languages=languages)
+    peaks['parse'] = tracemalloc.get_traced_memory()[1]
+    tracemalloc.reset_peak()
+    transcription = parser.get_transcription()
+    all_units = {}
+    for language in languages:
+        all_units[language] = parser.get_all_collation_units(language)
+    peaks['units'] = tracemalloc.get_traced_memory()[1]
+    tracemalloc.reset_peak()
+    corrector_order = None
+    if 'corrector_order' in transcription:
+        corrector_order = parser.doctor_corrector_order(transcription['corrector_order'])
+    word_parser = YasnaWordParser()
+    for language in languages:
+        for unit in all_units[language]:
+            word_parser.parse_unit(unit, corrector_order)
+    peaks['words'] = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peaks
+
+
+def count_tokens(all_units):
+    count = 0
+    for language in all_units:
+        for unit in all_units[language]:
+            for reading in unit.get('witnesses', []):
+                count += len(reading['tokens'])
+    return count
+
+
+class Command(BaseCommand):
+
+    '''
+    benchmarks the transcription parsers against synthetic MUYA transcriptions and reports the
+    throughput and peak memory of each stage of the pipeline. Results can be stored as a baseline
+    and later runs compared against it to flag regressions.
+    '''
+
+    help = 'Benchmark the transcription parsers with synthetic transcriptions.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS.keys()),
+                            help='the size of transcription to benchmark (can be repeated, defaults to all)')
+        parser.add_argument('--app-density', type=float, default=0.1)
+        parser.add_argument('--hands', type=int, default=2)
+        parser.add_argument('--ritual-directions', type=float, default=0.1)
+        parser.add_argument('--language', action='append', dest='languages',
+                            help='language to generate and extract (can be repeated, defaults to ae)')
+        parser.add_argument('--basetext', action='store_true',
+                            help='generate basetexts so that ritual directions are processed')
+        parser.add_argument('--repeat', type=int, default=3, help='the number of timed runs of each scenario')
+        parser.add_argument('--baseline', default=None, help='path of a baseline file to compare against')
+        parser.add_argument('--save-baseline', action='store_true', help='write the results to the baseline file')
+        parser.add_argument('--tolerance', type=float, default=0.2,
+                            help='the proportional drop in throughput that counts as a regression')
+
+    def handle(self, *args, **options):
+
+        languages = options['languages'] or ['ae']
+        siglum = 'basetext' if options['basetext'] else '4010'
+        results = {}
+        for name in options['scenario'] or list(SCENARIOS.keys()):
+            config = {'siglum': siglum, 'app_density': options['app_density'], 'hands': options['hands'],
+                      'ritual_directions': options['ritual_directions'], 'languages': languages}
+            config.update(SCENARIOS[name])
+            xml_string = generate_transcription(**config)
+            timings = {stage: 0 for stage in STAGES}
+            for i in range(options['repeat']):
+                all_units = run_pipeline(xml_string, languages, timings)
+            units = sum(len(all_units[language]) for language in all_units)
+            tokens = count_tokens(all_units)
+            peaks = measure_memory(xml_string, languages)
+
+            results[name] = {'config': config}
+            self.stdout.write('{}: {} units, {} tokens, {:.1f} KB of TEI'.format(name, units, tokens,
+                                                                                len(xml_string) / 1024))
+            for stage in STAGES:
+                seconds = timings[stage] / options['repeat']
+                results[name][stage] = {'seconds': seconds,
+                                        'units_per_second': units / seconds if seconds else 0,
+                                        'tokens_per_second': tokens / seconds if seconds else 0,
+                                        'peak_memory': peaks[stage]}
+                self.stdout.write('  {:<6} {:>10.1f} units/s {:>12.1f} tokens/s {:>10.1f} KB peak'.format(
+                    stage, results[name][stage]['units_per_second'], results[name][stage]['tokens_per_second'],
+                    peaks[stage] / 1024))
+
+        if options['baseline'] is None:
+            return
+        if options['save_baseline']:
+            with open(options['baseline'], 'w', encoding='utf-8') as baseline_file:
+                json.dump(results, baseline_file, indent=1, sort_keys=True)
+            self.stdout.write('Baseline written to {}'.format(options['baseline']))
+            return
+        if not os.path.exists(options['baseline']):
+            raise CommandError('The baseline file {} does not exist.'.format(options['baseline']))
+        with open(options['baseline'], encoding='utf-8') as baseline_file:
+            baseline = json.load(baseline_file)
+
+        regressions = []
+        for name in results:
+            if name in baseline and baseline[name].get('config') != results[name]['config']:
+                self.stderr.write('The baseline for {} was recorded with different settings so it has not been '
+                                  'compared.'.format(name))
+                continue
+            for stage in STAGES:
+                try:
+                    expected = baseline[name][stage]['units_per_second']
+                except KeyError:
+                    continue
+                actual = results[name][stage]['units_per_second']
+                if actual < expected * (1 - options['tolerance']):
+                    regressions.append('{} {}: {:.1f} units/s against a baseline of {:.1f} units/s'.format(
+                        name, stage, actual, expected))
+        if len(regressions) > 0:
+            for regression in regressions:
+                self.stderr.write(regression)
+            raise CommandError('{} stages are slower than the baseline.'.format(len(regressions)))
+        self.stdout.write('No regressions against the baseline.')
@@ -0,0 +1,30 @@
+import time
+from django.core.management.base import BaseCommand
+from transcriptions import routing, tasks
+
+
+class Command(BaseCommand):
+
+    '''
+    deletes the unit fragments which are no longer used by any collation unit. Fragments are shared
+    between units so they are left in place when units are replaced or deleted and must be collected
+    with this command or by running the collect_fragments task periodically.
+    '''
+
+    help = 'Delete unit fragments which are no longer referenced.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--async', action='store_true', dest='run_async',
+                            help='send the collection to the celery workers')
+
+    def handle(self, *args, **options):
+
+        if options['run_async']:
+            task = tasks.collect_fragments.apply_async(**routing.get_options(routing.BULK))
+            self.stdout.write('Collection started with task id {}.'.format(task.task_id))
+            return
+
+        start = time.perf_counter()
+        result = tasks.collect_fragments()
+        self.stdout.write('Deleted {} unit fragments in {:.2f}s.'.format(result['fragments'],
+                                                                         time.perf_counter() - start))
@@ -0,0 +1,58 @@
+import time
+from django.core.management.base import BaseCommand, CommandError
+from accounts.models import User
+from transcriptions import progress, routing, tasks
+
+
+class Command(BaseCommand):
+
+    '''
+    deletes all of the transcriptions matching the options given along with their collation units.
+    The units are deleted in batches so that no single transaction holds locks for long. With --async
+    the deletion is sent to the celery workers instead and its progress can be followed with the
+    progress endpoint by the user given with --user.
+    '''
+
+    help = 'Delete transcriptions by user, work or siglum pattern.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', help='username whose transcriptions to delete')
+        parser.add_argument('--work', help='abbreviation of the work whose transcriptions to delete')
+        parser.add_argument('--siglum', help='siglum to delete, * matches any characters (e.g. 40*)')
+        parser.add_argument('--dry-run', action='store_true', help='list the transcriptions without deleting them')
+        parser.add_argument('--async', action='store_true', dest='run_async',
+                            help='send the deletion to the celery workers')
+
+    def handle(self, *args, **options):
+
+        user = None
+        if options['user'] is not None:
+            try:
+                user = User.objects.get(username=options['user']).id
+            except User.DoesNotExist:
+                raise CommandError('The user {} does not exist.'.format(options['user']))
+        kwargs = {'user': user, 'work': options['work'], 'siglum': options['siglum']}
+        try:
+            transcriptions = tasks.get_transcriptions_to_delete(**kwargs)
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        if options['dry_run']:
+            identifiers = list(transcriptions.order_by('identifier').values_list('identifier', flat=True))
+            for identifier in identifiers:
+                self.stdout.write(identifier)
+            self.stdout.write('{} transcriptions would be deleted.'.format(len(identifiers)))
+            return
+
+        if options['run_async']:
+            task = tasks.delete_transcriptions.apply_async(kwargs=kwargs, **routing.get_options(routing.BULK))
+            if user is not None:
+                # the user whose transcriptions are deleted can follow the deletion from the progress endpoint
+                progress.set_owner(task.task_id, user)
+            self.stdout.write('Deletion started with task id {}.'.format(task.task_id))
+            return
+
+        start = time.perf_counter()
+        result = tasks.delete_transcriptions(**kwargs)
+        self.stdout.write('Deleted {} transcriptions ({} collation units) in {:.2f}s.'.format(
+            len(result['transcriptions']), result['units'], time.perf_counter() - start))
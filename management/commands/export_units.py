@@ -0,0 +1,50 @@
+import sys
+import time
+from django.core.management.base import BaseCommand, CommandError
+from transcriptions.export import get_export_units, generate_lines
+
+
+class Command(BaseCommand):
+
+    '''
+    writes the collation units matching the options given as newline delimited JSON, one unit per
+    line with its witnesses. The units are ordered by context and then siglum.
+    '''
+
+    help = 'Export collation units as NDJSON.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--work', help='abbreviation of the work to export')
+        parser.add_argument('--start', help='the first context to export (e.g. Y.28 or Y.28.1.2)')
+        parser.add_argument('--end', help='the last context to export')
+        parser.add_argument('--language', action='append', dest='languages',
+                            help='language to export (can be repeated, defaults to all)')
+        parser.add_argument('--siglum', action='append', dest='sigla',
+                            help='siglum to export (can be repeated, defaults to all)')
+        parser.add_argument('--output', default=None, help='the file to write to (defaults to stdout)')
+        parser.add_argument('--compact', action='store_true',
+                            help='write the witnesses in the compact storage format without expanding them')
+
+    def handle(self, *args, **options):
+
+        try:
+            units = get_export_units(work=options['work'], start=options['start'], end=options['end'],
+                                     languages=options['languages'], sigla=options['sigla'])
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        start = time.perf_counter()
+        count = 0
+        if options['output'] is None:
+            output = sys.stdout.buffer
+        else:
+            output = open(options['output'], 'wb')
+        try:
+            for line in generate_lines(units, compact=options['compact']):
+                output.write(line)
+                count += 1
+        finally:
+            if options['output'] is not None:
+                output.close()
+        elapsed = time.perf_counter() - start
+        self.stderr.write('Exported {} collation units in {:.2f}s.'.format(count, elapsed))
@@ -0,0 +1,177 @@
+import os
+import re
+import glob
+import time
+import hashlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from lxml import etree
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from accounts.models import User
+from transcriptions import tasks
+from transcriptions.checkpoint import Checkpoint
+from transcriptions.validation import validate_xml, get_siglum, dry_run, format_error
+
+
+def find_files(paths):
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            matches = glob.glob(os.path.join(path, '*.xml'))
+        else:
+            matches = glob.glob(path)
+        for match in sorted(matches):
+            if match not in files:
+                files.append(match)
+    return files
+
+
+def get_fingerprint(path):
+    with open(path, 'rb') as xml_file:
+        return hashlib.sha1(xml_file.read()).hexdigest()
+
+
+def index_file(path, collection, user_id, languages, skip_schema, check_only=False):
+    filename = os.path.basename(path)
+    try:
+        with open(path, 'rb') as xml_file:
+            content = xml_file.read()
+        try:
+            tree = etree.fromstring(content)
+        except etree.XMLSyntaxError:
+            return {'path': path, 'error': 'the file was not well formed xml'}
+
+        results = validate_xml(tree, filename, skip_schema)
+        if results['valid'] is False:
+            return {'path': path, 'error': ' '.join(results['errors'])}
+
+        siglum = get_siglum(tree)
+        if siglum == 'basetext':
+            public_flag = True
+        else:
+            public_flag = False
+
+        # remove the encoding declaration because etree parser does not support it
+        xml_string = re.sub(r'<\?xml.+?\?>', '', content.decode('utf-8'))
+        if check_only:
+            return {'path': path, 'report': dry_run(xml_string, filename, collection=collection, languages=languages)}
+        data = tasks.parse_transcription(xml_string, collection, username=user_id, public_flag=public_flag,
+                                         languages=languages, source=filename)
+        summary = tasks.save_transcription(data, user_id)
+    except Exception as e:
+        return {'path': path, 'error': str(e)}
+    summary['path'] = path
+    return summary
+
+
+class Command(BaseCommand):
+
+    '''
+    validates and indexes TEI transcription files from the file system. The files are processed
+    in parallel and progress is recorded in an optional checkpoint file so that an interrupted run
+    can be resumed without reindexing the files that have already been loaded. With --dry-run the
+    files are parsed in memory and every structural error and the statistics of each are reported
+    without anything being written.
+    '''
+
+    help = 'Validate and index a directory or glob of TEI transcription files.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='+', help='directories, files or glob patterns of TEI files')
+        parser.add_argument('--user', required=True, help='username of the owner of the transcriptions')
+        parser.add_argument('--collection', default='AV')
+        parser.add_argument('--language', action='append', dest='languages',
+                            help='language to extract (can be repeated, defaults to ae)')
+        parser.add_argument('--workers', type=int, default=1)
+        parser.add_argument('--checkpoint', default=None, help='path of the checkpoint file used to resume a run')
+        parser.add_argument('--skip-schema', action='store_true')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='report the errors and statistics of each file without indexing it')
+
+    def handle(self, *args, **options):
+
+        try:
+            user = User.objects.get(username=options['user'])
+        except User.DoesNotExist:
+            raise CommandError('The user {} does not exist.'.format(options['user']))
+        languages = options['languages'] or ['ae']
+
+        files = find_files(options['paths'])
+        if len(files) == 0:
+            raise CommandError('No TEI files were found.')
+
+        checkpoint = Checkpoint(options['checkpoint'])
+        to_index = {}
+        for path in files:
+            fingerprint = get_fingerprint(path)
+            if checkpoint.is_done(path, fingerprint):
+                continue
+            to_index[path] = fingerprint
+        skipped = len(files) - len(to_index)
+        if skipped > 0:
+            self.stdout.write('Skipping {} files already indexed according to the checkpoint.'.format(skipped))
+
+        arguments = (options['collection'], user.id, languages, options['skip_schema'], options['dry_run'])
+        start = time.perf_counter()
+        indexed = 0
+        units = 0
+        failures = []
+
+        if options['workers'] > 1:
+            # the worker processes must open their own database connections
+            connections.close_all()
+            with ProcessPoolExecutor(max_workers=options['workers']) as executor:
+                futures = [executor.submit(index_file, path, *arguments) for path in to_index]
+                results = (future.result() for future in as_completed(futures))
+                indexed, units = self.record_results(results, to_index, checkpoint, failures)
+        else:
+            results = (index_file(path, *arguments) for path in to_index)
+            indexed, units = self.record_results(results, to_index, checkpoint, failures)
+
+        elapsed = time.perf_counter() - start
+        if options['dry_run']:
+            self.stdout.write('Checked {} files ({} collation units) in {:.2f}s, nothing was written.'.format(
+                indexed, units, elapsed))
+        else:
+            self.stdout.write('Indexed {} files ({} collation units) in {:.2f}s: {:.2f} files/s, '
+                              '{:.2f} units/s.'.format(indexed, units, elapsed,
+                                                       indexed / elapsed if elapsed else 0,
+                                                       units / elapsed if elapsed else 0))
+        if len(failures) > 0:
+            for failure in failures:
+                self.stderr.write('{}: {}'.format(failure['path'], failure['error']))
+            raise CommandError('{} files could not be indexed.'.format(len(failures)))
+
+    def record_results(self, results, fingerprints, checkpoint, failures):
+        indexed = 0
+        units = 0
+        for result in results:
+            if 'error' in result:
+                failures.append(result)
+                continue
+            if 'report' in result:
+                self.write_report(result['path'], result['report'])
+                if result['report']['valid'] is False:
+                    failures.append({'path': result['path'], 'error': '{} structural errors'.format(
+                        len(result['report']['errors']))})
+                    continue
+                indexed += 1
+                units += sum(result['report']['stats']['units'].values())
+                continue
+            indexed += 1
+            units += result['units']
+            checkpoint.mark_done(result['path'], fingerprints[result['path']],
+                                 identifier=result['identifier'], units=result['units'])
+            self.stdout.write('{} indexed as {} ({} units)'.format(result['path'], result['identifier'],
+                                                                   result['units']))
+        return indexed, units
+
+    def write_report(self, path, report):
+        stats = report['stats']
+        self.stdout.write('{}: {} units ({}), {} tokens, readings by hand: {}, about {} KB to write'.format(
+            path, sum(stats['units'].values()),
+            ', '.join('{} {}'.format(language, count) for language, count in stats['units'].items()),
+            stats['tokens'], ', '.join('{} {}'.format(hand, count) for hand, count in stats['hands'].items()),
+            (stats['estimated_bytes'] + 1023) // 1024))
+        for error in report['errors']:
+            self.stdout.write('  {}'.format(format_error(error)))
@@ -0,0 +1,160 @@
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.db.models import Q
+from transcriptions import models, tasks, witness_format
+from transcriptions.checkpoint import Checkpoint
+from transcriptions.yasna_parser import PARSER_VERSION
+
+
+def get_fingerprint(version):
+    # the version of a transcription is increased whenever it is saved so, with the parser version, it
+    # identifies what was indexed without reading the tei
+    return '{}:{}'.format(PARSER_VERSION, version)
+
+
+def get_languages(transcription):
+    languages = list(transcription.units.order_by('language').values_list('language', flat=True).distinct())
+    if len(languages) == 0:
+        return ['ae']
+    return languages
+
+
+def normalise_witnesses(witnesses):
+    # the order of the readings is not significant and is not stable between parses
+    if witnesses is None:
+        return None
+    return sorted(witness_format.expand(witnesses), key=lambda reading: reading['id'])
+
+
+def compare_units(transcription, data):
+    existing = dict(transcription.units.order_by().values_list('identifier', 'witnesses_fragment__witnesses'))
+    new = {}
+    for language in data['collation_units']:
+        for unit in data['collation_units'][language]:
+            new[unit['identifier']] = unit.get('witnesses')
+    return {'added': sorted(set(new) - set(existing)),
+            'removed': sorted(set(existing) - set(new)),
+            'changed': sorted(key for key in set(new) & set(existing)
+                              if normalise_witnesses(new[key]) != normalise_witnesses(existing[key]))}
+
+
+def reindex_transcription(transcription_id, identifier, dry_run=False):
+    # the identifier is passed in from the list of transcriptions so that a failure can be reported by it even
+    # if the transcription itself could not be read
+    try:
+        transcription = models.Transcription.objects.select_related('collection').get(id=transcription_id)
+        if transcription.collection is not None:
+            collection = transcription.collection.abbreviation
+        else:
+            collection = transcription.identifier.split('_')[0]
+        languages = get_languages(transcription)
+        data = tasks.parse_transcription(transcription.tei, collection, username=transcription.user_id,
+                                         public_flag=transcription.public, languages=languages,
+                                         source=transcription.source)
+        if data['transcription']['identifier'] != transcription.identifier:
+            return {'identifier': transcription.identifier,
+                    'error': 'The transcription now parses with the identifier {} so it must be '
+                             'uploaded again.'.format(data['transcription']['identifier'])}
+        if dry_run is True:
+            result = compare_units(transcription, data)
+            result['identifier'] = transcription.identifier
+            return result
+        result = tasks.save_transcription(data, transcription.user_id)
+    except Exception as e:
+        return {'identifier': identifier, 'error': str(e)}
+    result['fingerprint'] = get_fingerprint(result['version'])
+    return result
+
+
+class Command(BaseCommand):
+
+    '''
+    reparses the TEI stored for each transcription and replaces its collation units. This is needed
+    after any change to the parsers. Transcriptions already stamped with the current parser version
+    are skipped unless --force is used.
+    '''
+
+    help = 'Reindex stored transcriptions with the current version of the parsers.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--work', action='append', help='abbreviation of a work to reindex (can be repeated)')
+        parser.add_argument('--siglum', action='append', help='siglum to reindex (can be repeated)')
+        parser.add_argument('--user', action='append', help='username whose transcriptions to reindex '
+                                                            '(can be repeated)')
+        parser.add_argument('--workers', type=int, default=1)
+        parser.add_argument('--dry-run', action='store_true',
+                            help='reparse and report the units that would change without saving anything')
+        parser.add_argument('--checkpoint', default=None, help='path of the checkpoint file used to resume a run')
+        parser.add_argument('--force', action='store_true',
+                            help='reindex transcriptions already stamped with the current parser version')
+
+    def handle(self, *args, **options):
+
+        transcriptions = models.Transcription.objects.all()
+        if options['work']:
+            transcriptions = transcriptions.filter(work__abbreviation__in=options['work'])
+        if options['siglum']:
+            transcriptions = transcriptions.filter(siglum__in=options['siglum'])
+        if options['user']:
+            transcriptions = transcriptions.filter(user__username__in=options['user'])
+        if not options['force']:
+            transcriptions = transcriptions.filter(Q(parser_version__isnull=True) |
+                                                   Q(parser_version__lt=PARSER_VERSION))
+
+        checkpoint = Checkpoint(options['checkpoint'])
+        to_index = []
+        for transcription_id, identifier, version in transcriptions.values_list('id', 'identifier', 'version'):
+            if checkpoint.is_done(identifier, get_fingerprint(version)):
+                continue
+            to_index.append((transcription_id, identifier))
+        if len(to_index) == 0:
+            self.stdout.write('There are no transcriptions to reindex.')
+            return
+
+        start = time.perf_counter()
+        failures = []
+        if options['workers'] > 1:
+            # the worker processes must open their own database connections
+            connections.close_all()
+            with ProcessPoolExecutor(max_workers=options['workers']) as executor:
+                futures = [executor.submit(reindex_transcription, transcription_id, identifier, options['dry_run'])
+                           for transcription_id, identifier in to_index]
+                results = (future.result() for future in as_completed(futures))
+                reindexed, units = self.record_results(results, checkpoint, failures, options['dry_run'])
+        else:
+            results = (reindex_transcription(transcription_id, identifier, options['dry_run'])
+                       for transcription_id, identifier in to_index)
+            reindexed, units = self.record_results(results, checkpoint, failures, options['dry_run'])
+
+        elapsed = time.perf_counter() - start
+        if options['dry_run']:
+            self.stdout.write('Checked {} transcriptions in {:.2f}s, {} units would '
+                              'change.'.format(reindexed, elapsed, units))
+        else:
+            self.stdout.write('Reindexed {} transcriptions ({} collation units) in {:.2f}s: {:.2f} units/s.'.format(
+                reindexed, units, elapsed, units / elapsed if elapsed else 0))
+        if len(failures) > 0:
+            for failure in failures:
+                self.stderr.write('{}: {}'.format(failure['identifier'], failure['error']))
+            raise CommandError('{} transcriptions could not be reindexed.'.format(len(failures)))
+
+    def record_results(self, results, checkpoint, failures, dry_run):
+        reindexed = 0
+        units = 0
+        for result in results:
+            if 'error' in result:
+                failures.append(result)
+                continue
+            reindexed += 1
+            if dry_run:
+                for key in ['added', 'removed', 'changed']:
+                    units += len(result[key])
+                    for identifier in result[key]:
+                        self.stdout.write('{} {}'.format(key, identifier))
+                continue
+            units += result['units']
+            checkpoint.mark_done(result['identifier'], result['fingerprint'], units=result['units'])
+            self.stdout.write('{} reindexed ({} units)'.format(result['identifier'], result['units']))
+        return reindexed, units
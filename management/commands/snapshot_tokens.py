@@ -0,0 +1,33 @@
+import time
+from django.core.management.base import BaseCommand, CommandError
+from transcriptions import snapshot
+
+
+class Command(BaseCommand):
+
+    '''
+    writes a token level snapshot of the collation units to a directory in a columnar format for
+    analysis outside the database. Only the transcriptions which have been reindexed, uploaded or
+    deleted since the last run are written again so the command can be run as often as needed.
+    '''
+
+    help = 'Write or update a columnar snapshot of the tokens of the collation units.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('directory', help='the directory of the snapshot')
+        parser.add_argument('--format', choices=snapshot.FORMATS, default=None, dest='snapshot_format',
+                            help='the format of the parts (defaults to parquet if pyarrow is installed and '
+                                 'otherwise npy)')
+
+    def handle(self, *args, **options):
+
+        start = time.perf_counter()
+        try:
+            summary = snapshot.update_snapshot(
+                options['directory'], snapshot_format=options['snapshot_format'],
+                on_part=lambda identifier, rows: self.stdout.write('{} written ({} rows)'.format(identifier, rows)))
+        except ValueError as e:
+            raise CommandError(str(e))
+        self.stdout.write('Wrote {} transcriptions, kept {} and removed {} in {:.2f}s, the snapshot has {} '
+                          'rows.'.format(summary['written'], summary['unchanged'], summary['removed'],
+                                         time.perf_counter() - start, summary['rows']))
@@ -0,0 +1,18 @@
+# Generated by Django 3.2 on 2026-10-19 09:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('transcriptions', '0025_delete_ceremonymapping'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='transcription',
+            name='parser_version',
+            field=models.IntegerField(null=True, verbose_name='parser_version'),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 3.2 on 2026-10-19 09:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('transcriptions', '0026_transcription_parser_version'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='collationunit',
+            index=models.Index(fields=['siglum', 'user', 'language', 'chapter_number', 'stanza_number', 'line_number'], name='collationunit_siglum_user_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='collationunit',
+            index=models.Index(fields=['transcription_identifier'], name='collationunit_trans_ident_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='collationunit',
+            index=models.Index(fields=['work', 'context'], name='collationunit_work_context_idx'),
+        ),
+    ]
@@ -0,0 +1,65 @@
+# Generated by Django 3.2 on 2026-10-19 09:41
+
+import re
+from django.db import migrations, models
+import django.db.models.expressions
+
+
+def get_siglum_sort_key(siglum):
+    # a copy of yasna_parser.get_siglum_sort_key as it was when this migration was written
+    if siglum == 'basetext':
+        return -1
+    try:
+        return float(siglum)
+    except ValueError:
+        match = re.match(r'^(\d+)S(\d?)$', siglum)
+        if match is not None:
+            sort_key = float(match.group(1)) + 0.1
+            if match.group(2) != '':
+                sort_key += float(match.group(2))/100
+            return sort_key
+    return None
+
+
+def add_sort_keys(apps, schema_editor):
+    # one update per siglum rather than per row
+    Transcription = apps.get_model('transcriptions', 'Transcription')
+    CollationUnit = apps.get_model('transcriptions', 'CollationUnit')
+    sigla = Transcription.objects.order_by().values_list('siglum', flat=True).distinct()
+    for siglum in sigla:
+        sort_key = get_siglum_sort_key(siglum)
+        Transcription.objects.filter(siglum=siglum).update(siglum_sort_key=sort_key)
+        CollationUnit.objects.filter(transcription_siglum=siglum).update(siglum_sort_key=sort_key)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('transcriptions', '0027_auto_20261019_0939'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='transcription',
+            options={'ordering': [django.db.models.expressions.OrderBy(django.db.models.expressions.F('siglum_sort_key'), nulls_last=True), 'siglum']},
+        ),
+        migrations.AddField(
+            model_name='collationunit',
+            name='siglum_sort_key',
+            field=models.FloatField(null=True, verbose_name='siglum_sort_key'),
+        ),
+        migrations.AddField(
+            model_name='transcription',
+            name='siglum_sort_key',
+            field=models.FloatField(null=True, verbose_name='siglum_sort_key'),
+        ),
+        migrations.AddIndex(
+            model_name='collationunit',
+            index=models.Index(fields=['context', 'language', 'siglum_sort_key'], name='collationunit_context_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='transcription',
+            index=models.Index(fields=['user', 'siglum_sort_key', 'siglum'], name='transcription_user_sort_idx'),
+        ),
+        migrations.RunPython(add_sort_keys, migrations.RunPython.noop),
+    ]
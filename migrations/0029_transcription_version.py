@@ -0,0 +1,23 @@
+# Generated by Django 3.2 on 2026-10-19 09:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('transcriptions', '0028_siglum_sort_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='transcription',
+            name='modified',
+            field=models.DateTimeField(null=True, verbose_name='modified'),
+        ),
+        migrations.AddField(
+            model_name='transcription',
+            name='version',
+            field=models.IntegerField(default=1, verbose_name='version'),
+        ),
+    ]
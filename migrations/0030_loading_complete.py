@@ -0,0 +1,25 @@
+# Generated by Django 3.2 on 2026-10-19 10:02
+
+from django.db import migrations, models
+
+
+def set_loading_complete(apps, schema_editor):
+    # the units of a transcription used to be saved one by one outside a transaction so a load which
+    # failed part of the way through left some of them behind. Only a transcription without any units
+    # is known not to have loaded, whether the others are complete cannot be told so they are left unset
+    Transcription = apps.get_model('transcriptions', 'Transcription')
+    CollationUnit = apps.get_model('transcriptions', 'CollationUnit')
+    units = CollationUnit.objects.filter(transcription_id=models.OuterRef('id'))
+    Transcription.objects.filter(loading_complete__isnull=True).exclude(models.Exists(units)).update(
+        loading_complete=False)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('transcriptions', '0029_transcription_version'),
+    ]
+
+    operations = [
+        migrations.RunPython(set_loading_complete, migrations.RunPython.noop),
+    ]
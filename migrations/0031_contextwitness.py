@@ -0,0 +1,51 @@
+# Generated by Django 3.2 on 2026-10-19 10:05
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.db.models.expressions
+
+
+# copy the existing collation units with a single set based insert rather than row by row
+BACKFILL_SQL = '''
+INSERT INTO transcriptions_contextwitness (context, language, siglum, siglum_sort_key, duplicate_position,
+                                           unit_identifier, transcription_id, user_id, public, witnesses)
+SELECT context, language, siglum, siglum_sort_key, duplicate_position, identifier, transcription_id, user_id,
+       public, witnesses
+FROM transcriptions_collationunit
+'''
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('transcriptions', '0030_loading_complete'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ContextWitness',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('context', models.TextField(verbose_name='context')),
+                ('language', models.TextField(verbose_name='language')),
+                ('siglum', models.TextField(verbose_name='siglum')),
+                ('siglum_sort_key', models.FloatField(null=True, verbose_name='siglum_sort_key')),
+                ('duplicate_position', models.IntegerField(null=True, verbose_name='duplicate_position')),
+                ('unit_identifier', models.TextField(verbose_name='unit_identifier')),
+                ('public', models.BooleanField(verbose_name='public')),
+                ('witnesses', models.JSONField(null=True)),
+                ('transcription', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='context_witnesses', to='transcriptions.transcription')),
+                ('user', models.ForeignKey(null=True, on_delete=django.db.models.deletion.PROTECT, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': [django.db.models.expressions.OrderBy(django.db.models.expressions.F('siglum_sort_key'), nulls_last=True), 'siglum', 'duplicate_position'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='contextwitness',
+            index=models.Index(fields=['context', 'language', 'siglum_sort_key'], name='contextwitness_context_idx'),
+        ),
+        migrations.RunSQL(BACKFILL_SQL, migrations.RunSQL.noop),
+    ]
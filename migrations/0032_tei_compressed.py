@@ -0,0 +1,35 @@
+# Generated by Django 3.2 on 2026-10-19 10:20
+
+from django.db import migrations, models
+import transcriptions.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('transcriptions', '0031_contextwitness'),
+    ]
+
+    operations = [
+        # the uncompressed columns are made nullable so that the migrations can be reversed
+        migrations.AlterField(
+            model_name='collationunit',
+            name='tei',
+            field=models.TextField(null=True, verbose_name='tei'),
+        ),
+        migrations.AlterField(
+            model_name='transcription',
+            name='tei',
+            field=models.TextField(null=True, verbose_name='tei'),
+        ),
+        migrations.AddField(
+            model_name='collationunit',
+            name='tei_compressed',
+            field=transcriptions.fields.CompressedTextField(null=True, verbose_name='tei'),
+        ),
+        migrations.AddField(
+            model_name='transcription',
+            name='tei_compressed',
+            field=transcriptions.fields.CompressedTextField(null=True, verbose_name='tei'),
+        ),
+    ]
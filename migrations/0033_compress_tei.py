@@ -0,0 +1,44 @@
+# Generated by Django 3.2 on 2026-10-19 10:21
+
+from django.db import migrations, transaction
+
+BATCH_SIZE = 500
+
+
+def copy_tei(apps, source, target):
+    # each batch is committed separately so a large table is not rewritten in a single transaction
+    # and an interrupted migration continues from the rows not yet converted when it is run again
+    for model_name in ['Transcription', 'CollationUnit']:
+        model = apps.get_model('transcriptions', model_name)
+        last_id = 0
+        while True:
+            with transaction.atomic():
+                batch = list(model.objects.filter(id__gt=last_id, **{'{}__isnull'.format(target): True})
+                             .order_by('id').only('id', source)[:BATCH_SIZE])
+                if len(batch) == 0:
+                    break
+                for instance in batch:
+                    setattr(instance, target, getattr(instance, source))
+                model.objects.bulk_update(batch, [target])
+            last_id = batch[-1].id
+
+
+def compress_tei(apps, schema_editor):
+    copy_tei(apps, 'tei', 'tei_compressed')
+
+
+def decompress_tei(apps, schema_editor):
+    copy_tei(apps, 'tei_compressed', 'tei')
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [
+        ('transcriptions', '0032_tei_compressed'),
+    ]
+
+    operations = [
+        migrations.RunPython(compress_tei, decompress_tei),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 3.2 on 2026-10-19 10:22
+
+from django.db import migrations
+import transcriptions.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('transcriptions', '0033_compress_tei'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='collationunit',
+            name='tei',
+        ),
+        migrations.RemoveField(
+            model_name='transcription',
+            name='tei',
+        ),
+        migrations.RenameField(
+            model_name='collationunit',
+            old_name='tei_compressed',
+            new_name='tei',
+        ),
+        migrations.RenameField(
+            model_name='transcription',
+            old_name='tei_compressed',
+            new_name='tei',
+        ),
+        migrations.AlterField(
+            model_name='collationunit',
+            name='tei',
+            field=transcriptions.fields.CompressedTextField(verbose_name='tei'),
+        ),
+        migrations.AlterField(
+            model_name='transcription',
+            name='tei',
+            field=transcriptions.fields.CompressedTextField(verbose_name='tei'),
+        ),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 3.2 on 2026-10-19 10:40
+
+from django.db import migrations, models
+import django.db.models.deletion
+import transcriptions.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('transcriptions', '0034_replace_tei'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UnitFragment',
+            fields=[
+                ('digest', models.CharField(max_length=64, primary_key=True, serialize=False, verbose_name='digest')),
+                ('tei', transcriptions.fields.CompressedTextField(null=True, verbose_name='tei')),
+                ('witnesses', models.JSONField(null=True)),
+            ],
+        ),
+        # the tei column is made nullable so that the migrations can be reversed
+        migrations.AlterField(
+            model_name='collationunit',
+            name='tei',
+            field=transcriptions.fields.CompressedTextField(null=True, verbose_name='tei'),
+        ),
+        migrations.AddField(
+            model_name='collationunit',
+            name='tei_fragment',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+',
+                                    to='transcriptions.unitfragment'),
+        ),
+        migrations.AddField(
+            model_name='collationunit',
+            name='witnesses_fragment',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+',
+                                    to='transcriptions.unitfragment'),
+        ),
+        migrations.AddField(
+            model_name='contextwitness',
+            name='witnesses_fragment',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+',
+                                    to='transcriptions.unitfragment'),
+        ),
+    ]
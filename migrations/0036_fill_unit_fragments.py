@@ -0,0 +1,104 @@
+# Generated by Django 3.2 on 2026-10-19 10:41
+
+import json
+import hashlib
+from django.db import migrations, transaction
+
+BATCH_SIZE = 500
+CONTEXT_BATCH_SIZE = 10000
+
+# the context index is updated with one statement for each range of its ids, joined to the units through
+# their unique identifier, rather than with a statement for each unit on its unindexed unit_identifier
+FILL_CONTEXT_SQL = '''
+    UPDATE {context} AS cw SET witnesses_fragment_id = cu.witnesses_fragment_id
+    FROM {unit} AS cu
+    WHERE cw.id > %s AND cw.id <= %s AND cw.witnesses_fragment_id IS NULL
+    AND cu.identifier = cw.unit_identifier AND cu.witnesses_fragment_id IS NOT NULL
+'''
+
+EMPTY_CONTEXT_SQL = '''
+    UPDATE {context} AS cw SET witnesses = f.witnesses
+    FROM {unit} AS cu JOIN {fragment} AS f ON f.digest = cu.witnesses_fragment_id
+    WHERE cw.id > %s AND cw.id <= %s AND cu.identifier = cw.unit_identifier
+'''
+
+
+# copies of UnitFragment.for_tei and UnitFragment.for_witnesses as they were when this migration was written
+def get_tei_digest(tei):
+    return hashlib.sha256(b'tei\0' + tei.encode('utf-8')).hexdigest()
+
+
+def get_witnesses_digest(witnesses):
+    content = json.dumps(witnesses, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.sha256(b'witnesses\0' + content.encode('utf-8')).hexdigest()
+
+
+def update_context_witnesses(apps, schema_editor, sql):
+    CollationUnit = apps.get_model('transcriptions', 'CollationUnit')
+    ContextWitness = apps.get_model('transcriptions', 'ContextWitness')
+    UnitFragment = apps.get_model('transcriptions', 'UnitFragment')
+    sql = sql.format(context=ContextWitness._meta.db_table, unit=CollationUnit._meta.db_table,
+                     fragment=UnitFragment._meta.db_table)
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute('SELECT max(id) FROM {}'.format(ContextWitness._meta.db_table))
+        max_id = cursor.fetchone()[0] or 0
+        for start in range(0, max_id, CONTEXT_BATCH_SIZE):
+            with transaction.atomic():
+                cursor.execute(sql, [start, start + CONTEXT_BATCH_SIZE])
+
+
+def fill_fragments(apps, schema_editor):
+    # each batch is committed separately and an interrupted migration continues from the units
+    # without fragments when it is run again
+    UnitFragment = apps.get_model('transcriptions', 'UnitFragment')
+    CollationUnit = apps.get_model('transcriptions', 'CollationUnit')
+    last_id = 0
+    while True:
+        with transaction.atomic():
+            batch = list(CollationUnit.objects.filter(id__gt=last_id, tei_fragment__isnull=True)
+                         .order_by('id').only('id', 'identifier', 'tei', 'witnesses')[:BATCH_SIZE])
+            if len(batch) == 0:
+                break
+            fragments = {}
+            for unit in batch:
+                unit.tei_fragment_id = get_tei_digest(unit.tei)
+                fragments[unit.tei_fragment_id] = UnitFragment(digest=unit.tei_fragment_id, tei=unit.tei)
+                if unit.witnesses is not None:
+                    unit.witnesses_fragment_id = get_witnesses_digest(unit.witnesses)
+                    fragments[unit.witnesses_fragment_id] = UnitFragment(digest=unit.witnesses_fragment_id,
+                                                                         witnesses=unit.witnesses)
+            UnitFragment.objects.bulk_create(fragments.values(), ignore_conflicts=True)
+            CollationUnit.objects.bulk_update(batch, ['tei_fragment', 'witnesses_fragment'])
+        last_id = batch[-1].id
+    update_context_witnesses(apps, schema_editor, FILL_CONTEXT_SQL)
+
+
+def empty_fragments(apps, schema_editor):
+    CollationUnit = apps.get_model('transcriptions', 'CollationUnit')
+    last_id = 0
+    while True:
+        with transaction.atomic():
+            batch = list(CollationUnit.objects.filter(id__gt=last_id, tei__isnull=True).order_by('id')
+                         .select_related('tei_fragment', 'witnesses_fragment')[:BATCH_SIZE])
+            if len(batch) == 0:
+                break
+            for unit in batch:
+                unit.tei = unit.tei_fragment.tei
+                if unit.witnesses_fragment is not None:
+                    unit.witnesses = unit.witnesses_fragment.witnesses
+            CollationUnit.objects.bulk_update(batch, ['tei', 'witnesses'])
+        last_id = batch[-1].id
+    update_context_witnesses(apps, schema_editor, EMPTY_CONTEXT_SQL)
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [
+        ('transcriptions', '0035_unitfragment'),
+    ]
+
+    operations = [
+        migrations.RunPython(fill_fragments, empty_fragments),
+    ]
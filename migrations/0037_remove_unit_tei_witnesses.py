@@ -0,0 +1,32 @@
+# Generated by Django 3.2 on 2026-10-19 10:42
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('transcriptions', '0036_fill_unit_fragments'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='collationunit',
+            name='tei',
+        ),
+        migrations.RemoveField(
+            model_name='collationunit',
+            name='witnesses',
+        ),
+        migrations.RemoveField(
+            model_name='contextwitness',
+            name='witnesses',
+        ),
+        migrations.AlterField(
+            model_name='collationunit',
+            name='tei_fragment',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.DO_NOTHING, related_name='+',
+                                    to='transcriptions.unitfragment'),
+        ),
+    ]
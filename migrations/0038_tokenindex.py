@@ -0,0 +1,44 @@
+# Generated by Django 3.2 on 2026-10-19 11:05
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.db.models.expressions
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('transcriptions', '0037_remove_unit_tei_witnesses'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TokenIndex',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('term', models.TextField(verbose_name='term')),
+                ('kind', models.TextField(verbose_name='kind')),
+                ('context', models.TextField(verbose_name='context')),
+                ('language', models.TextField(verbose_name='language')),
+                ('siglum', models.TextField(verbose_name='siglum')),
+                ('siglum_sort_key', models.FloatField(null=True, verbose_name='siglum_sort_key')),
+                ('hand', models.TextField(null=True, verbose_name='hand')),
+                ('reading', models.TextField(verbose_name='reading')),
+                ('position', models.IntegerField(verbose_name='position')),
+                ('unit_identifier', models.TextField(verbose_name='unit_identifier')),
+                ('public', models.BooleanField(verbose_name='public')),
+                ('transcription', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='token_index', to='transcriptions.transcription')),
+                ('user', models.ForeignKey(null=True, on_delete=django.db.models.deletion.PROTECT, to=settings.AUTH_USER_MODEL)),
+                ('work', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='+', to='transcriptions.work')),
+            ],
+            options={
+                'ordering': [django.db.models.expressions.OrderBy(django.db.models.expressions.F('siglum_sort_key'), nulls_last=True), 'siglum', 'id'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='tokenindex',
+            index=models.Index(fields=['term', 'kind', 'siglum_sort_key'], name='tokenindex_term_idx'),
+        ),
+    ]
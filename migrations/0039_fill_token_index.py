@@ -0,0 +1,124 @@
+# Generated by Django 3.2 on 2026-10-19 11:06
+
+from django.db import migrations, transaction
+
+BATCH_SIZE = 5000
+
+# copies of the expansion of version 1 of witness_format and of its get_token_terms as they were when
+# this migration was written so that later changes to the module do not change what it indexes
+READING_KEYS = {'id': 'id', 'hand': 'h', 'hand_abbreviation': 'ha', 'gap_reading': 'g'}
+
+READING_DEFAULTS = {'hand': 'firsthand', 'hand_abbreviation': '*'}
+
+TOKEN_KEYS = {
+    'verse': 'v', 'reading': 'rd', 'siglum': 's', 'index': 'i', 'type': 'ty', 't': 't', 'original': 'o',
+    'expanded': 'e', 'lemma': 'l', 'rule_match': 'r', 'language': 'lg', 'foreign': 'f', 'supplied': 'su',
+    'unclear': 'u', 'nomSac': 'n', 'gap_before': 'gb', 'gap_before_details': 'gbd', 'gap_after': 'ga',
+    'gap_details': 'gd', 'pc_before': 'pb', 'pc_after': 'pa', 'rd_before': 'rb', 'rd_after': 'ra',
+    'rdt_before': 'tb', 'rdt_after': 'ta',
+}
+
+SHARED_KEYS = ['verse', 'reading', 'siglum']
+
+EXPANDED_TOKEN_KEYS = {short: key for key, short in TOKEN_KEYS.items()}
+EXPANDED_READING_KEYS = {short: key for key, short in READING_KEYS.items()}
+
+
+def normalise(text):
+    for character in '[]{}()':
+        text = text.replace(character, '')
+    return text.lower()
+
+
+def expand_token(token, position, shared):
+    expanded = dict(shared)
+    for key, value in token.items():
+        expanded[EXPANDED_TOKEN_KEYS.get(key, key)] = value
+    if 'index' not in expanded:
+        expanded['index'] = str((position + 1) * 2)
+    if 't' not in expanded:
+        text = expanded['lemma'] if 'lemma' in expanded else expanded.get('expanded', expanded.get('original'))
+        expanded['t'] = normalise(text) if text is not None else None
+    if 'rule_match' not in expanded:
+        expanded['rule_match'] = None
+        if 'original' in expanded:
+            expanded['rule_match'] = [expanded.get('lemma', expanded['original']).lower()]
+            if 'expanded' in expanded:
+                expanded['rule_match'].append(expanded['expanded'].lower())
+    return expanded
+
+
+def expand(witnesses):
+    if witnesses is None or isinstance(witnesses, list):
+        return witnesses
+    if witnesses.get('v') != 1:
+        raise ValueError('Unknown witness format version {}.'.format(witnesses.get('v')))
+    readings = []
+    for reading in witnesses['r']:
+        expanded = {}
+        shared = {}
+        for key, value in reading.items():
+            if key == 'k':
+                continue
+            if key in EXPANDED_TOKEN_KEYS and EXPANDED_TOKEN_KEYS[key] in SHARED_KEYS:
+                shared[EXPANDED_TOKEN_KEYS[key]] = value
+            else:
+                expanded[EXPANDED_READING_KEYS.get(key, key)] = value
+        for key, value in READING_DEFAULTS.items():
+            expanded.setdefault(key, value)
+        expanded['tokens'] = [expand_token(token, position, shared) for position, token in enumerate(reading['k'])]
+        readings.append(expanded)
+    return readings
+
+
+def get_token_terms(witnesses):
+    for reading in expand(witnesses) or []:
+        for token in reading['tokens']:
+            terms = []
+            if token.get('t') is not None:
+                terms.append(normalise(token['t']))
+            for variant in token.get('rule_match') or []:
+                if normalise(variant) not in terms:
+                    terms.append(normalise(variant))
+            for term in terms:
+                yield reading, token, 'token', term
+            if token.get('lemma') is not None:
+                yield reading, token, 'lemma', normalise(token['lemma'])
+
+
+def fill_token_index(apps, schema_editor):
+    # each transcription is indexed and committed separately and those already indexed are skipped so an
+    # interrupted migration continues where it stopped when it is run again
+    Transcription = apps.get_model('transcriptions', 'Transcription')
+    CollationUnit = apps.get_model('transcriptions', 'CollationUnit')
+    TokenIndex = apps.get_model('transcriptions', 'TokenIndex')
+    transcription_ids = list(Transcription.objects.order_by('id').values_list('id', flat=True))
+    for transcription_id in transcription_ids:
+        with transaction.atomic():
+            if TokenIndex.objects.filter(transcription_id=transcription_id).exists():
+                continue
+            tokens = []
+            units = (CollationUnit.objects.filter(transcription_id=transcription_id, witnesses_fragment__isnull=False)
+                     .order_by('id').select_related('witnesses_fragment'))
+            for unit in units.iterator():
+                for reading, token, kind, term in get_token_terms(unit.witnesses_fragment.witnesses):
+                    tokens.append(TokenIndex(term=term, kind=kind, context=unit.context, language=unit.language,
+                                             siglum=unit.siglum, siglum_sort_key=unit.siglum_sort_key,
+                                             hand=reading.get('hand'), reading=reading['id'],
+                                             position=int(token['index']), unit_identifier=unit.identifier,
+                                             work_id=unit.work_id, transcription_id=transcription_id,
+                                             user_id=unit.user_id, public=unit.public))
+            TokenIndex.objects.bulk_create(tokens, batch_size=BATCH_SIZE)
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [
+        ('transcriptions', '0038_tokenindex'),
+    ]
+
+    operations = [
+        migrations.RunPython(fill_token_index, migrations.RunPython.noop),
+    ]
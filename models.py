@@ -1,7 +1,13 @@
+import json
+import hashlib
 from django.conf import settings
 from django.db import models
+from django.utils import timezone
+from django.utils.functional import cached_property
 from api.models import BaseModel
 from django.contrib.postgres.fields import ArrayField
+from transcriptions import witness_format
+from transcriptions.fields import CompressedTextField
 
 
 class Collection (models.Model):
@@ -58,6 +64,17 @@ class Work (models.Model):
         return data
 
 
+class TranscriptionQuerySet(models.QuerySet):
+
+    def without_tei(self):
+        # the tei holds the whole uploaded document so it is only loaded when explicitly needed
+        return self.defer('tei')
+
+    def touch(self):
+        # mark the transcriptions as changed so that cached and conditional responses are refreshed
+        return self.update(version=models.F('version') + 1, modified=timezone.now())
+
+
 class Transcription (models.Model):
 
     AVAILABILITY = 'logged_in'
@@ -67,20 +84,29 @@ class Transcription (models.Model):
     SERIALIZER = 'TranscriptionSerializer'
 
     class Meta:
-        ordering = ['siglum']
+        ordering = [models.F('siglum_sort_key').asc(nulls_last=True), 'siglum']
+        indexes = [
+            models.Index(fields=['user', 'siglum_sort_key', 'siglum'], name='transcription_user_sort_idx'),
+        ]
 
     identifier = models.TextField('identifier', unique=True)
     collection = models.ForeignKey(Collection, on_delete=models.PROTECT, null=True)
     document_id = models.TextField('document_id')
-    tei = models.TextField('tei')
+    tei = CompressedTextField('tei')
     source = models.TextField('source')
     siglum = models.TextField('siglum')
+    siglum_sort_key = models.FloatField('siglum_sort_key', null=True)
     main_language = models.TextField('main_language')
     corrector_order = ArrayField(models.CharField(max_length=50), null=True)
     user = models.ForeignKey(settings.AUTH_USER_MODEL, models.PROTECT, null=True)
     work = models.ForeignKey('Work', on_delete=models.PROTECT, related_name="transcriptions")
     loading_complete = models.BooleanField('loading_complete', null=True)
     public = models.BooleanField('public')
+    parser_version = models.IntegerField('parser_version', null=True)
+    version = models.IntegerField('version', default=1)
+    modified = models.DateTimeField('modified', null=True)
+
+    objects = TranscriptionQuerySet.as_manager()
 
     def get_serialization_fields():
         fields = '__all__'
@@ -97,18 +123,74 @@ class Transcription (models.Model):
         return self.identifier
 
 
+class UnitFragment (models.Model):
+
+    # content addressed storage for the tei and witnesses of the collation units, each distinct value
+    # is stored once under the sha256 digest of its content and shared by every unit with that content.
+    # Fragments are not deleted with the units, collect_fragments removes those no longer referenced.
+
+    digest = models.CharField('digest', max_length=64, primary_key=True)
+    tei = CompressedTextField('tei', null=True)
+    witnesses = models.JSONField(null=True)
+
+    def __str__(self):
+        return self.digest
+
+    @classmethod
+    def for_tei(cls, tei):
+        digest = hashlib.sha256(b'tei\0' + tei.encode('utf-8')).hexdigest()
+        return cls(digest=digest, tei=tei)
+
+    @classmethod
+    def for_witnesses(cls, witnesses):
+        content = json.dumps(witnesses, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+        digest = hashlib.sha256(b'witnesses\0' + content.encode('utf-8')).hexdigest()
+        return cls(digest=digest, witnesses=witnesses)
+
+
+class CollationUnitQuerySet(models.QuerySet):
+
+    # the columns which moved to the fragments, still accepted by values() and values_list() so that
+    # queries written against the columns return the stored tei (compressed) and witnesses (compact)
+    FRAGMENT_FIELDS = {'tei': 'tei_fragment__tei', 'witnesses': 'witnesses_fragment__witnesses'}
+
+    def values(self, *fields, **expressions):
+        for field in fields:
+            if field in self.FRAGMENT_FIELDS:
+                expressions[field] = models.F(self.FRAGMENT_FIELDS[field])
+        return super().values(*[field for field in fields if field not in self.FRAGMENT_FIELDS], **expressions)
+
+    def values_list(self, *fields, **kwargs):
+        fields = [models.F(self.FRAGMENT_FIELDS[field]) if field in self.FRAGMENT_FIELDS else field
+                  for field in fields]
+        return super().values_list(*fields, **kwargs)
+
+    def unordered(self):
+        # the default ordering is not needed for counts, deletes and bulk reads and it stops the
+        # indexes being used for anything other than the lookup
+        return self.order_by()
+
+    def for_transcription(self, transcription_identifier):
+        return self.filter(transcription_identifier=transcription_identifier).order_by()
+
+    def without_tei(self):
+        # the tei fragment is only needed for reparsing, displays use the witnesses
+        return self.select_related('witnesses_fragment').defer('witnesses_fragment__tei')
+
+
 class CollationUnit (models.Model):
 
     AVAILABILITY = 'public_or_user'
 
-    RELATED_KEYS = ['transcription', 'work', 'user']
+    # the fragments are loaded with the units because the tei and witnesses are read from them
+    RELATED_KEYS = ['transcription', 'work', 'user', 'tei_fragment', 'witnesses_fragment']
 
     SERIALIZER = 'CollationUnitSerializer'
 
     identifier = models.TextField('identifier', unique=True)
     index = models.IntegerField('index')
     document_id = models.TextField('document_id')
-    tei = models.TextField('tei')
+    tei_fragment = models.ForeignKey('UnitFragment', models.DO_NOTHING, related_name='+')
     context = models.TextField('context')
     reference = models.TextField('reference')
     chapter_number = models.IntegerField('chapter_number', null=True)
@@ -119,14 +201,40 @@ class CollationUnit (models.Model):
     duplicate_position = models.IntegerField('duplicate_position', null=True)
     transcription = models.ForeignKey('Transcription', models.CASCADE, related_name="units")
     transcription_siglum = models.TextField('transcription_siglum')
+    siglum_sort_key = models.FloatField('siglum_sort_key', null=True)
     transcription_identifier = models.TextField('transcription_identifier')
     user = models.ForeignKey(settings.AUTH_USER_MODEL, models.PROTECT, null=True)
     work = models.ForeignKey('Work', models.PROTECT, related_name="work_units")
-    witnesses = models.JSONField(null=True)
+    witnesses_fragment = models.ForeignKey('UnitFragment', models.DO_NOTHING, related_name='+', null=True)
     public = models.BooleanField('public')
 
+    objects = CollationUnitQuerySet.as_manager()
+
+    @property
+    def tei(self):
+        return self.tei_fragment.tei
+
+    @property
+    def compact_witnesses(self):
+        # the witnesses as they are stored, in the compact format of witness_format
+        if self.witnesses_fragment_id is None:
+            return None
+        return self.witnesses_fragment.witnesses
+
+    @cached_property
+    def witnesses(self):
+        # expanded to the shape produced by the word parser whatever the storage format
+        return witness_format.expand(self.compact_witnesses)
+
     class Meta:
         ordering = ['chapter_number', 'stanza_number', 'line_number']
+        indexes = [
+            models.Index(fields=['siglum', 'user', 'language', 'chapter_number', 'stanza_number', 'line_number'],
+                         name='collationunit_siglum_user_idx'),
+            models.Index(fields=['transcription_identifier'], name='collationunit_trans_ident_idx'),
+            models.Index(fields=['work', 'context'], name='collationunit_work_context_idx'),
+            models.Index(fields=['context', 'language', 'siglum_sort_key'], name='collationunit_context_idx'),
+        ]
 
     def get_serialization_fields():
         fields = '__all__'
@@ -138,3 +246,119 @@ class CollationUnit (models.Model):
         for field in fields:
             data[field.name] = field.get_internal_type()
         return data
+
+
+class AvailableQuerySet(models.QuerySet):
+
+    def available_to(self, user):
+        if user.is_authenticated:
+            return self.filter(models.Q(public=True) | models.Q(user=user))
+        return self.filter(public=True)
+
+
+class ContextWitnessQuerySet(AvailableQuerySet):
+
+    def for_context(self, context, language):
+        return self.filter(context=context, language=language)
+
+
+class ContextWitness (models.Model):
+
+    # a denormalised copy of the data needed to collate a context with one row per collation unit,
+    # it is written by the indexer alongside the collation units and replaced with them
+
+    context = models.TextField('context')
+    language = models.TextField('language')
+    siglum = models.TextField('siglum')
+    siglum_sort_key = models.FloatField('siglum_sort_key', null=True)
+    duplicate_position = models.IntegerField('duplicate_position', null=True)
+    unit_identifier = models.TextField('unit_identifier')
+    transcription = models.ForeignKey('Transcription', models.CASCADE, related_name="context_witnesses")
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, models.PROTECT, null=True)
+    public = models.BooleanField('public')
+    witnesses_fragment = models.ForeignKey('UnitFragment', models.DO_NOTHING, related_name='+', null=True)
+
+    objects = ContextWitnessQuerySet.as_manager()
+
+    @property
+    def compact_witnesses(self):
+        if self.witnesses_fragment_id is None:
+            return None
+        return self.witnesses_fragment.witnesses
+
+    @cached_property
+    def witnesses(self):
+        return witness_format.expand(self.compact_witnesses)
+
+    class Meta:
+        ordering = [models.F('siglum_sort_key').asc(nulls_last=True), 'siglum', 'duplicate_position']
+        indexes = [
+            models.Index(fields=['context', 'language', 'siglum_sort_key'], name='contextwitness_context_idx'),
+        ]
+
+    def __str__(self):
+        return self.unit_identifier
+
+    @classmethod
+    def from_unit(cls, unit):
+        return cls(context=unit.context, language=unit.language, siglum=unit.siglum,
+                   siglum_sort_key=unit.siglum_sort_key, duplicate_position=unit.duplicate_position,
+                   unit_identifier=unit.identifier, transcription=unit.transcription, user=unit.user,
+                   public=unit.public, witnesses_fragment_id=unit.witnesses_fragment_id)
+
+
+class TokenIndexQuerySet(AvailableQuerySet):
+
+    def search(self, term, kind='token', work=None, sigla=None, hand=None, language=None):
+        tokens = self.filter(term=witness_format.normalise(term), kind=kind)
+        if work is not None:
+            tokens = tokens.filter(work__abbreviation=work)
+        if sigla:
+            tokens = tokens.filter(siglum__in=sigla)
+        if hand is not None:
+            tokens = tokens.filter(hand=hand)
+        if language is not None:
+            tokens = tokens.filter(language=language)
+        return tokens
+
+
+class TokenIndex (models.Model):
+
+    # an inverted index from the normalised forms and lemmas of the tokens of the collation units to
+    # each reading and position they occur in, written by the indexer alongside the collation units
+
+    KINDS = ['token', 'lemma']
+
+    term = models.TextField('term')
+    kind = models.TextField('kind')
+    context = models.TextField('context')
+    language = models.TextField('language')
+    siglum = models.TextField('siglum')
+    siglum_sort_key = models.FloatField('siglum_sort_key', null=True)
+    hand = models.TextField('hand', null=True)
+    reading = models.TextField('reading')
+    position = models.IntegerField('position')
+    unit_identifier = models.TextField('unit_identifier')
+    work = models.ForeignKey('Work', models.PROTECT, related_name='+')
+    transcription = models.ForeignKey('Transcription', models.CASCADE, related_name="token_index")
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, models.PROTECT, null=True)
+    public = models.BooleanField('public')
+
+    objects = TokenIndexQuerySet.as_manager()
+
+    class Meta:
+        ordering = [models.F('siglum_sort_key').asc(nulls_last=True), 'siglum', 'id']
+        indexes = [
+            models.Index(fields=['term', 'kind', 'siglum_sort_key'], name='tokenindex_term_idx'),
+        ]
+
+    def __str__(self):
+        return self.term
+
+    @classmethod
+    def for_unit(cls, unit, witnesses):
+        return [cls(term=term, kind=kind, context=unit.context, language=unit.language, siglum=unit.siglum,
+                    siglum_sort_key=unit.siglum_sort_key, hand=reading.get('hand'), reading=reading['id'],
+                    position=int(token['index']), unit_identifier=unit.identifier, work=unit.work,
+                    transcription=unit.transcription, user=unit.user, public=unit.public)
+                for reading, token, kind, term in witness_format.get_token_terms(witnesses)]
@@ -0,0 +1,152 @@
+"""Publish and read the progress of the transcription tasks.
+
+Progress is kept in the Django cache, which must be shared between the web server and the Celery
+workers, so that following a task does not repeatedly query the Celery result backend."""
+
+import time
+from django.conf import settings
+from django.core.cache import cache
+
+PROGRESS_TIMEOUT = 60 * 60 * 24
+
+
+def get_key(task_id):
+    return 'transcriptions:progress:{}'.format(task_id)
+
+
+def get_sequence_key(task_id):
+    return 'transcriptions:progress:{}:sequence'.format(task_id)
+
+
+def publish(task_id, state, **meta):
+    """Store the current state of the task and increase its sequence number."""
+    if task_id is None:
+        return
+    # the sequence is increased atomically in the cache so that concurrent updates never share a number
+    cache.add(get_sequence_key(task_id), 0, PROGRESS_TIMEOUT)
+    sequence = cache.incr(get_sequence_key(task_id))
+    cache.set(get_key(task_id), {'state': state, 'sequence': sequence, 'meta': meta, 'updated': time.time()},
+              PROGRESS_TIMEOUT)
+
+
+def get_progress(task_id):
+    return cache.get(get_key(task_id))
+
+
+def get_owner_key(task_id):
+    return 'transcriptions:owner:{}'.format(task_id)
+
+
+def set_owner(task_id, user_id):
+    """Record the user who started a task or batch, only they can follow its progress."""
+    cache.set(get_owner_key(task_id), user_id, PROGRESS_TIMEOUT)
+
+
+def is_owner(task_id, user_id):
+    return cache.get(get_owner_key(task_id)) == user_id
+
+
+def get_batch_key(batch_id):
+    return 'transcriptions:batch:{}'.format(batch_id)
+
+
+def register_batch(batch_id, files):
+    """Store the files of a batch upload, each a dictionary with the task_id of its indexing task if it has one."""
+    cache.set(get_batch_key(batch_id), files, PROGRESS_TIMEOUT)
+
+
+def get_batch_progress(batch_id):
+    """Return the combined progress of the indexing tasks of a batch upload in the same form as a single task.
+
+    The sequence number is the sum of those of the tasks so it changes whenever any of them does and
+    the batch is finished once every task has succeeded, failed or been superseded. Files which did not
+    validate have no task and are counted as failed. A file whose task was superseded by a later upload
+    of the same transcription is counted separately because it was not indexed by this batch.
+    """
+    files = cache.get(get_batch_key(batch_id))
+    if files is None:
+        return None
+    task_progress = cache.get_many([get_key(file['task_id']) for file in files if file.get('task_id')])
+    summary = {'files': [], 'files_total': len(files), 'files_done': 0, 'files_failed': 0,
+               'files_superseded': 0, 'units_done': 0, 'units_total': 0}
+    sequence = 0
+    for file in files:
+        current = task_progress.get(get_key(file.get('task_id')), None)
+        if file.get('task_id') is None:
+            # counted as a change so that a batch of invalid files is reported as finished at once
+            state = 'INVALID'
+            sequence += 1
+        elif current is None:
+            state = 'PENDING'
+        else:
+            state = current['state']
+            sequence += current['sequence']
+            if state == 'SUCCESS':
+                summary['units_done'] += current['meta'].get('units', 0)
+                summary['units_total'] += current['meta'].get('units', 0)
+            else:
+                summary['units_done'] += current['meta'].get('units_done', 0)
+                summary['units_total'] += current['meta'].get('units_total', 0)
+        if state == 'SUCCESS':
+            summary['files_done'] += 1
+        elif state == 'SUPERSEDED':
+            summary['files_superseded'] += 1
+        elif state in ('FAILURE', 'INVALID'):
+            summary['files_failed'] += 1
+        file = dict(file, state=state)
+        if state == 'FAILURE':
+            file['errors'] = [current['meta'].get('message')]
+        summary['files'].append(file)
+    if summary['files_done'] + summary['files_failed'] + summary['files_superseded'] == len(files):
+        state = 'SUCCESS'
+    elif all(file['state'] == 'PENDING' for file in summary['files']):
+        state = 'PENDING'
+    else:
+        state = 'PROGRESS'
+    return {'state': state, 'sequence': sequence, 'meta': summary}
+
+
+class ProgressReporter(object):
+    """Collect the counts reported by the stages of a task and publish them.
+
+    Each stage reports a running count of units per language at its batch boundaries. The progress
+    is published whenever the stage or language changes and otherwise at most once per interval so
+    reporting costs little however many units there are. The celery task state is only updated when
+    the stage changes to keep writes to the result backend to a minimum.
+    """
+
+    STAGES = ['parsed', 'word_parsed', 'written']
+
+    def __init__(self, task=None, interval=None):
+        self.task = task
+        self.task_id = task.request.id if task is not None else None
+        if interval is None:
+            interval = getattr(settings, 'TRANSCRIPTIONS_PROGRESS_INTERVAL', 0.5)
+        self.interval = interval
+        self.stage = None
+        self.language = None
+        self.counts = {}
+        self.last_published = None
+
+    def get_meta(self):
+        return {'stage': self.stage,
+                'language': self.language,
+                'counts': self.counts,
+                'units_total': sum(counts.get('parsed', 0) for counts in self.counts.values()),
+                'units_done': sum(counts.get('written', 0) for counts in self.counts.values())}
+
+    def report(self, stage, language, count):
+        new_stage = stage != self.stage
+        boundary = new_stage or language != self.language
+        self.stage = stage
+        self.language = language
+        self.counts.setdefault(language, {})[stage] = count
+        if self.task_id is None:
+            return
+        now = time.monotonic()
+        if boundary or self.last_published is None or now - self.last_published >= self.interval:
+            meta = self.get_meta()
+            publish(self.task_id, 'PROGRESS', **meta)
+            self.last_published = now
+            if new_stage:
+                self.task.update_state(state='PROGRESS', meta=meta)
@@ -0,0 +1,71 @@
+"""Send the transcription tasks to queues by workload and limit the indexing tasks each user runs at once.
+
+Each task is given one of three workloads: interactive (a single file uploaded from the manage page),
+large (the base text or any file of at least TRANSCRIPTIONS_LARGE_TRANSCRIPTION_SIZE characters) and
+bulk (the files of a batch upload, deletions and the collection of fragments). TRANSCRIPTIONS_QUEUES
+maps each workload to a Celery queue and a workload which is not mapped is sent to the default queue,
+so the routing only takes effect once workers have been started for the queues.
+
+The indexing tasks of each user hold one of TRANSCRIPTIONS_USER_CONCURRENCY slots while they run. The
+slots are postgres session advisory locks so they are released if a worker dies. A task which finds
+all of its user's slots taken is retried after TRANSCRIPTIONS_USER_SLOT_WAIT seconds, which puts it at
+the back of its queue so the tasks of other users are run first."""
+
+from contextlib import contextmanager
+from django.conf import settings
+from django.db import connection
+
+INTERACTIVE = 'interactive'
+LARGE = 'large'
+BULK = 'bulk'
+
+LARGE_TRANSCRIPTION_SIZE = 2000000
+USER_CONCURRENCY = 2
+USER_SLOT_WAIT = 5
+
+# the first key of the postgres advisory locks which hold the indexing slots of each user
+USER_SLOT_LOCK_CLASS = 7343
+
+
+def get_workload(xml_string, siglum=None, batch=False):
+    size = getattr(settings, 'TRANSCRIPTIONS_LARGE_TRANSCRIPTION_SIZE', LARGE_TRANSCRIPTION_SIZE)
+    if siglum == 'basetext' or len(xml_string) >= size:
+        return LARGE
+    if batch is True:
+        return BULK
+    return INTERACTIVE
+
+
+def get_options(workload):
+    """Return the options to send a task of the workload with."""
+    queue = getattr(settings, 'TRANSCRIPTIONS_QUEUES', {}).get(workload)
+    if queue is None:
+        return {}
+    return {'queue': queue}
+
+
+def get_slot_wait():
+    return getattr(settings, 'TRANSCRIPTIONS_USER_SLOT_WAIT', USER_SLOT_WAIT)
+
+
+@contextmanager
+def user_slot(user):
+    """Hold one of the indexing slots of the user for the block, which is given False if they are all taken."""
+    limit = getattr(settings, 'TRANSCRIPTIONS_USER_CONCURRENCY', USER_CONCURRENCY)
+    if user is None or not limit:
+        yield True
+        return
+    with connection.cursor() as cursor:
+        for slot in range(limit):
+            slot_key = '{}:{}'.format(user, slot)
+            cursor.execute('SELECT pg_try_advisory_lock(%s, hashtext(%s))', [USER_SLOT_LOCK_CLASS, slot_key])
+            if cursor.fetchone()[0] is True:
+                break
+        else:
+            yield False
+            return
+    try:
+        yield True
+    finally:
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT pg_advisory_unlock(%s, hashtext(%s))', [USER_SLOT_LOCK_CLASS, slot_key])
@@ -23,5 +23,10 @@ class TranscriptionSerializer(api_serializers.BaseModelSerializer):
 
 class CollationUnitSerializer(api_serializers.BaseModelSerializer):
 
+    # the tei and witnesses are stored in shared fragments and the witnesses are compacted but both
+    # are always served as they were produced by the parser
+    tei = serializers.ReadOnlyField()
+    witnesses = serializers.ReadOnlyField()
+
     class Meta:
         model = models.CollationUnit
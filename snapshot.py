@@ -0,0 +1,216 @@
+"""Write a flattened token level snapshot of the collation units for analysis outside the database.
+
+Each token of each reading of the collation units becomes a row of COLUMNS, and a reading which is
+only a gap becomes a single row without a token. The snapshot is a directory with a part for each
+transcription and a manifest.json which records the version of the transcription each part was read
+from, so an update only rewrites the parts of the transcriptions which have been reindexed since the
+last one and removes those of transcriptions which have been deleted.
+
+The parts are Parquet or Arrow IPC files if pyarrow is installed. Otherwise each part is a directory
+of .npy files, one for each column, which numpy can memory map (numpy.load(path, mmap_mode='r')).
+The string columns of an npy part are dictionary encoded: the .npy file holds int32 codes into the
+list of values in the .json file of the same name, with -1 for a missing value."""
+
+import os
+import sys
+import json
+import shutil
+from array import array
+from transcriptions import models, witness_format
+
+try:
+    import pyarrow
+    import pyarrow.feather
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+MANIFEST_NAME = 'manifest.json'
+
+SNAPSHOT_CHUNK_SIZE = 2000
+
+FORMATS = ['parquet', 'arrow', 'npy']
+
+STRING_COLUMNS = ['transcription', 'unit', 'context', 'language', 'siglum', 'hand', 'reading', 't']
+COLUMNS = STRING_COLUMNS + ['position', 'flags']
+
+# the bits of the flags column
+GAP_BEFORE = 1
+GAP_AFTER = 2
+SUPPLIED = 4
+UNCLEAR = 8
+NOMSAC = 16
+FOREIGN = 32
+GAP_READING = 64
+
+TOKEN_FLAGS = [('gap_before', GAP_BEFORE), ('gap_after', GAP_AFTER), ('supplied', SUPPLIED), ('unclear', UNCLEAR),
+               ('nomSac', NOMSAC), ('foreign', FOREIGN)]
+
+
+def get_default_format():
+    if pyarrow is not None:
+        return 'parquet'
+    return 'npy'
+
+
+def get_flags(token):
+    flags = 0
+    for key, flag in TOKEN_FLAGS:
+        if token.get(key):
+            flags |= flag
+    return flags
+
+
+def get_columns(transcription_id, identifier):
+    """Return a dictionary of the list of values of each column for the units of a transcription."""
+    columns = {column: [] for column in COLUMNS}
+    units = models.CollationUnit.objects.filter(transcription_id=transcription_id).order_by(
+        'chapter_number', 'stanza_number', 'line_number', 'duplicate_position', 'language').values_list(
+        'identifier', 'context', 'language', 'siglum', 'witnesses_fragment__witnesses')
+    for unit, context, language, siglum, witnesses in units.iterator(chunk_size=SNAPSHOT_CHUNK_SIZE):
+        for reading in witness_format.expand(witnesses) or []:
+            rows = [(token.get('t'), int(token['index']), get_flags(token)) for token in reading['tokens']]
+            if len(rows) == 0 and 'gap_reading' in reading:
+                rows = [(None, 0, GAP_READING)]
+            for t, position, flags in rows:
+                columns['transcription'].append(identifier)
+                columns['unit'].append(unit)
+                columns['context'].append(context)
+                columns['language'].append(language)
+                columns['siglum'].append(siglum)
+                columns['hand'].append(reading.get('hand'))
+                columns['reading'].append(reading['id'])
+                columns['t'].append(t)
+                columns['position'].append(position)
+                columns['flags'].append(flags)
+    return columns
+
+
+def write_npy_array(path, typecode, descr, values):
+    # the .npy format is a short header describing the array followed by the raw little endian values
+    data = array(typecode, values)
+    if sys.byteorder == 'big':
+        data.byteswap()
+    header = "{{'descr': '{}', 'fortran_order': False, 'shape': ({},), }}".format(descr, len(data))
+    # the header is padded so that the data is aligned to 64 bytes
+    header = header + ' ' * (63 - (len(header) + 10) % 64) + '\n'
+    with open(path, 'wb') as npy_file:
+        npy_file.write(b'\x93NUMPY\x01\x00' + len(header).to_bytes(2, 'little') + header.encode('latin-1'))
+        data.tofile(npy_file)
+
+
+def write_npy(path, columns):
+    os.makedirs(path)
+    for column in STRING_COLUMNS:
+        codes = {}
+        values = []
+        for value in columns[column]:
+            if value is not None and value not in codes:
+                codes[value] = len(values)
+                values.append(value)
+        write_npy_array(os.path.join(path, '{}.npy'.format(column)), 'i', '<i4',
+                        (codes[value] if value is not None else -1 for value in columns[column]))
+        with open(os.path.join(path, '{}.json'.format(column)), 'w', encoding='utf-8') as values_file:
+            json.dump(values, values_file, ensure_ascii=False)
+    write_npy_array(os.path.join(path, 'position.npy'), 'i', '<i4', columns['position'])
+    write_npy_array(os.path.join(path, 'flags.npy'), 'B', '|u1', columns['flags'])
+
+
+def get_table(columns):
+    arrays = {column: pyarrow.array(columns[column], pyarrow.string()).dictionary_encode()
+              for column in STRING_COLUMNS}
+    arrays['position'] = pyarrow.array(columns['position'], pyarrow.int32())
+    arrays['flags'] = pyarrow.array(columns['flags'], pyarrow.uint8())
+    return pyarrow.table(arrays)
+
+
+def remove_part(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+def write_part(path, columns, snapshot_format):
+    # anything left at the path by an interrupted update is replaced
+    remove_part(path)
+    if snapshot_format == 'npy':
+        write_npy(path, columns)
+    elif snapshot_format == 'parquet':
+        pyarrow.parquet.write_table(get_table(columns), path)
+    else:
+        # uncompressed so that the file can be memory mapped
+        pyarrow.feather.write_feather(get_table(columns), path, compression='uncompressed')
+
+
+def read_manifest(directory):
+    try:
+        with open(os.path.join(directory, MANIFEST_NAME), encoding='utf-8') as manifest_file:
+            return json.load(manifest_file)
+    except FileNotFoundError:
+        return {'format': None, 'columns': COLUMNS, 'transcriptions': {}}
+
+
+def write_manifest(directory, manifest):
+    # written to a temporary file and renamed so a reader never sees a partly written manifest
+    path = os.path.join(directory, MANIFEST_NAME)
+    with open(path + '.tmp', 'w', encoding='utf-8') as manifest_file:
+        json.dump(manifest, manifest_file, ensure_ascii=False, indent=1)
+    os.replace(path + '.tmp', path)
+
+
+def update_snapshot(directory, snapshot_format=None, on_part=None):
+    """Bring the snapshot in the directory up to date with the transcriptions and return a summary.
+
+    The parts of the transcriptions whose version is unchanged are kept unless the format has changed.
+    A new part is written under a new name and the manifest is saved before the part it replaces is
+    removed, so an interrupted update leaves a consistent snapshot which the next update continues.
+    """
+    if snapshot_format is None:
+        snapshot_format = get_default_format()
+    if snapshot_format not in FORMATS:
+        raise ValueError('{} is not a snapshot format, use one of {}.'.format(snapshot_format, ', '.join(FORMATS)))
+    if snapshot_format != 'npy' and pyarrow is None:
+        raise ValueError('pyarrow must be installed to write {} snapshots.'.format(snapshot_format))
+    os.makedirs(directory, exist_ok=True)
+    manifest = read_manifest(directory)
+    parts = manifest['transcriptions']
+    if manifest['format'] != snapshot_format:
+        # every part is written again in the new format
+        manifest = {'format': snapshot_format, 'columns': COLUMNS, 'transcriptions': {}}
+        write_manifest(directory, manifest)
+        for part in parts.values():
+            remove_part(os.path.join(directory, part['path']))
+        parts = manifest['transcriptions']
+    extension = {'npy': '', 'parquet': '.parquet', 'arrow': '.arrow'}[snapshot_format]
+
+    summary = {'written': 0, 'unchanged': 0, 'removed': 0, 'rows': 0}
+    current = models.Transcription.objects.order_by('identifier').values_list('id', 'identifier', 'version')
+    identifiers = set()
+    for transcription_id, identifier, version in current:
+        identifiers.add(identifier)
+        part = parts.get(identifier)
+        if part is not None and part['id'] == transcription_id and part['version'] == version:
+            summary['unchanged'] += 1
+            summary['rows'] += part['rows']
+            continue
+        columns = get_columns(transcription_id, identifier)
+        path = '{}-{}{}'.format(transcription_id, version, extension)
+        write_part(os.path.join(directory, path), columns, snapshot_format)
+        parts[identifier] = {'id': transcription_id, 'version': version, 'rows': len(columns['position']),
+                             'path': path}
+        write_manifest(directory, manifest)
+        if part is not None:
+            remove_part(os.path.join(directory, part['path']))
+        summary['written'] += 1
+        summary['rows'] += len(columns['position'])
+        if on_part is not None:
+            on_part(identifier, len(columns['position']))
+
+    deleted = [identifier for identifier in parts if identifier not in identifiers]
+    stale = [parts.pop(identifier) for identifier in deleted]
+    write_manifest(directory, manifest)
+    for part in stale:
+        remove_part(os.path.join(directory, part['path']))
+    summary['removed'] = len(deleted)
+    return summary
@@ -2,27 +2,43 @@
 indexing = (function () {
     "use strict";
 
-    var pollApparatusState;
+    var pollApparatusState, pollDeletionState, pollBatchState, pollLater;
     var poll_xhr;
+    var stage_labels = {'parsed': 'Extracting units',
+                        'word_parsed': 'Parsing words',
+                        'written': 'Saving units'};
 
 
+  // the progress endpoint answers at once and says in its Retry-After header how many seconds to wait before
+  // asking again while the task is unfinished
+  pollLater = function (poll, sequence, xhr) {
+    var seconds;
+    seconds = parseFloat(xhr.getResponseHeader('Retry-After'));
+    if (isNaN(seconds)) {
+        seconds = 1;
+    }
+    setTimeout(function() {
+        poll(sequence);
+    }, seconds * 1000);
+  };
+
   pollApparatusState = function () {
-    var poll, stop;
-    stop = 0;
-    poll = function(){
+    var poll;
+    poll = function(sequence){
         var task_id, siglum;
         task_id = document.getElementById('task_id').value;
         siglum = document.getElementById('siglum').value;
         poll_xhr = $.ajax({
-          url:'../pollstate',
-          type: 'POST',
+          url:'/transcriptions/progress',
+          type: 'GET',
           data: {
-              task_id: task_id,
+              task: task_id,
+              siglum: siglum,
+              sequence: sequence
           },
-          success: function(result) {
+          success: function(result, status, xhr) {
               var message;
               if (result.state === 'SUCCESS' || result.state === 'FAILURE') {
-                  stop = 1;
                   if (result.state === 'SUCCESS') {
                       document.getElementById('message').innerHTML = 'The indexing of ' + siglum + ' is complete.<br/><br/>If you want to check the data uploaded do so before closing this message.';
                       document.getElementById('indicator').innerHTML = '';
@@ -45,28 +61,141 @@ indexing = (function () {
                     document.getElementsByTagName('body')[0].removeChild(document.getElementById('error'));
                     window.location.reload();
                   });
+                  return;
+              } else if (result.state === 'SUPERSEDED') {
+                  // a newer upload of the same transcription replaced this task so follow that one instead
+                  document.getElementById('task_id').value = result.progress.superseded_by;
+                  poll(0);
+                  return;
               } else if (result.state === 'PENDING') {
                   // We have the flag to tell us when the task has started so pending is a waiting state
                   document.getElementById('message').innerHTML = 'Your task is waiting to start.' +
                                                                  '<br/><br/>Task Id: ' + task_id;
                   document.getElementById('indicator').innerHTML += '.&#8203;';
               } else {
-                  document.getElementById('message').innerHTML = 'Indexing of ' + siglum +
-                                                                 ' in progress.<br/><br/>Task Id: ' + task_id;
+                  message = 'Indexing of ' + siglum + ' in progress.';
+                  if (result.progress.counts !== undefined) {
+                      message += '<br/><br/>' + stage_labels[result.progress.stage] + ' (' +
+                                 result.progress.language + '): ' +
+                                 result.progress.counts[result.progress.language][result.progress.stage] + ' units';
+                      if (result.progress.stage === 'written') {
+                          message += '<br/>' + result.progress.units_done + ' of ' + result.progress.units_total +
+                                     ' units saved';
+                      }
+                  }
+                  document.getElementById('message').innerHTML = message + '<br/><br/>Task Id: ' + task_id;
                   document.getElementById('indicator').innerHTML += '.&#8203;';
               }
+              pollLater(poll, result.sequence, xhr);
+          },
+          error: function() {
+              // wait before trying again so a server error does not turn into a busy loop
+              setTimeout(function() {
+                  poll(sequence);
+              }, 2000);
+          }
+        });
+    };
+    poll(0);
+  };
+
+  pollDeletionState = function (task_id, identifier) {
+    var poll;
+    poll = function(sequence){
+        $.ajax({
+          url:'/transcriptions/progress',
+          type: 'GET',
+          data: {
+              task: task_id,
+              sequence: sequence
+          },
+          success: function(result, status, xhr) {
+              if (result.state === 'SUCCESS') {
+                  document.getElementById('message').innerHTML = 'The deletion of ' + identifier + ' is complete.';
+              } else if (result.state === 'FAILURE') {
+                  document.getElementById('message').innerHTML = 'Your task failed with the message:<br/><br/>' +
+                                                                 result.result.message + '<br/><br/>' +
+                                                                 'Task Id: ' + task_id;
+              } else {
+                  if (result.progress.units_deleted !== undefined) {
+                      document.getElementById('message').innerHTML = 'Deleting ' + identifier + ': ' +
+                                                                     result.progress.units_deleted +
+                                                                     ' units deleted.';
+                  }
+                  pollLater(poll, result.sequence, xhr);
+                  return;
+              }
+              document.getElementById('error_close').innerHTML = 'close';
+              $('#error_close').off('click.error-close');
+              $('#error_close').on('click.error-close', function(event) {
+                document.getElementsByTagName('body')[0].removeChild(document.getElementById('error'));
+                window.location.reload();
+              });
+          },
+          error: function() {
+              setTimeout(function() {
+                  poll(sequence);
+              }, 2000);
+          }
+        });
+    };
+    poll(0);
+  };
+
+  pollBatchState = function (batch_id) {
+    var poll;
+    poll = function(sequence){
+        $.ajax({
+          url:'/transcriptions/progress',
+          type: 'GET',
+          data: {
+              batch: batch_id,
+              sequence: sequence
+          },
+          success: function(result, status, xhr) {
+              var message, i, file;
+              message = result.progress.files_done + ' of ' + result.progress.files_total + ' files indexed';
+              if (result.progress.files_failed > 0) {
+                  message += ', ' + result.progress.files_failed + ' failed';
+              }
+              if (result.progress.files_superseded > 0) {
+                  message += ', ' + result.progress.files_superseded + ' replaced by a later upload';
+              }
+              message += '.<br/>' + result.progress.units_done + ' of ' + result.progress.units_total +
+                         ' units saved.<br/><br/>';
+              for (i = 0; i < result.progress.files.length; i += 1) {
+                  file = result.progress.files[i];
+                  message += file.file_name + ': ' + file.state.toLowerCase();
+                  if (file.state === 'INVALID' || file.state === 'FAILURE') {
+                      message += ' (' + file.errors.join(' ') + ')';
+                  }
+                  message += '<br/>';
+              }
+              document.getElementById('message').innerHTML = message;
+              if (result.state !== 'SUCCESS') {
+                  pollLater(poll, result.sequence, xhr);
+                  return;
+              }
+              document.getElementById('error_close').innerHTML = 'close';
+              $('#error_close').off('click.error-close');
+              $('#error_close').on('click.error-close', function(event) {
+                document.getElementsByTagName('body')[0].removeChild(document.getElementById('error'));
+                window.location.reload();
+              });
+          },
+          error: function() {
+              setTimeout(function() {
+                  poll(sequence);
+              }, 2000);
           }
         });
     };
-    var refreshIntervalId = setInterval(function() {
-        poll();
-        if(stop == 1){
-            clearInterval(refreshIntervalId);
-        }
-    }, 500);
+    poll(0);
   };
 
-  return {pollApparatusState: pollApparatusState};
+  return {pollApparatusState: pollApparatusState,
+          pollDeletionState: pollDeletionState,
+          pollBatchState: pollBatchState};
 
 
 
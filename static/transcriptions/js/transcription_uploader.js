@@ -5,8 +5,8 @@ transcript_uploader = (function() {
   var prepareForm;
 
   //private
-  var readFile, validateFile, showValidationReport, handleError, showErrorBox,
-  indexFile, showProgress, setupAjax, csrfSafeMethod, getCookie;
+  var readFile, validateFile, showValidationReport, formatStats, handleError, showErrorBox,
+  indexFile, indexBatch, showProgress, setupAjax, csrfSafeMethod, getCookie;
 
   $(document).ready(function() {
     transcript_uploader.prepareForm();
@@ -25,7 +25,11 @@ transcript_uploader = (function() {
           document.getElementById('index_button').disabled = false;
           $('#index_button').off('click.index');
           $('#index_button').on('click.index', function() {
-            indexFile();
+            if (document.getElementById('index_file').files.length > 1) {
+              indexBatch();
+            } else {
+              indexFile();
+            }
           });
         });
       });
@@ -37,11 +41,12 @@ transcript_uploader = (function() {
         document.getElementById('validate_button').disabled = false;
         $('#validate_button').off('click.validate');
         $('#validate_button').on('click.validate', function() {
-          var f, options;
+          var f, options, dry_run;
           f = document.getElementById('validation_file').files[0];
           options = forms.serialiseForm('transcription_validate_form');
+          dry_run = document.getElementById('validate_dry_run').checked;
           prepareForm();
-          validateFile(options.validate_src, escape(f.name));
+          validateFile(options.validate_src, escape(f.name), dry_run);
         });
       });
     });
@@ -147,20 +152,40 @@ transcript_uploader = (function() {
         return;
     }
     if (report.valid === true) {
-      showMessageBox(report.filename + ' is valid');
+      showMessageBox(report.filename + ' is valid' + formatStats(report.stats));
     } else {
       showErrorBox(report.filename + ' is not valid for the following reasons:<br/><br/>' +
-        report.errors.join('<br/><br/>'));
+        report.errors.join('<br/><br/>') + formatStats(report.stats));
     }
   };
 
-  validateFile = function(string, file_name) {
+  formatStats = function(stats) {
+    var text, language, hand;
+    if (stats === undefined) {
+      return '';
+    }
+    text = '<br/><br/>Units:';
+    for (language in stats.units) {
+      text += ' ' + language + ' ' + stats.units[language];
+    }
+    text += '<br/>Tokens: ' + stats.tokens + '<br/>Readings by hand:';
+    for (hand in stats.hands) {
+      text += ' ' + hand + ' ' + stats.hands[hand];
+    }
+    text += '<br/>Estimated size: ' + Math.ceil(stats.estimated_bytes / 1024) + ' KB';
+    return text;
+  };
+
+  validateFile = function(string, file_name, dry_run) {
     var options, url, callback;
     url = 'validate/';
     options = {
       'src': string,
       'file_name': file_name
     };
+    if (dry_run === true) {
+      options.dry_run = true;
+    }
     showValidationReport(JSON.stringify({}));
     callback = function(resp) {
       showValidationReport(resp);
@@ -215,6 +240,43 @@ transcript_uploader = (function() {
     });
   };
 
+  indexBatch = function () {
+    var data, form_data, files, i;
+    data = forms.serialiseForm('transcription_upload_form');
+    files = document.getElementById('index_file').files;
+    $('#index_button').off('click.index');
+    $('#index_button').prop('disabled', true);
+    // the files are sent as they are rather than base64 encoded and are validated and indexed on the server
+    form_data = new FormData();
+    for (i = 0; i < files.length; i += 1) {
+      form_data.append('files', files[i]);
+    }
+    form_data.append('collection', data.collection);
+    for (const key in data) {
+      if (key.indexOf('language') === 0) {
+        form_data.append(key, data[key]);
+      }
+    }
+    if (document.getElementById('upload_skip_schema').checked) {
+      form_data.append('skip_schema', true);
+    }
+    showMessageBox('<p id="message">Uploading ' + files.length + ' files.</p>');
+    document.getElementById('error_close').innerHTML = '';
+    $.ajax({
+      url: 'batch/',
+      type: 'POST',
+      data: form_data,
+      processData: false,
+      contentType: false,
+      dataType: 'json'
+    }).done(function (response) {
+      indexing.pollBatchState(response.batch_id);
+    }).fail(function (response) {
+      prepareForm();
+      handleError('upload', response);
+    });
+  };
+
   deleteFile = function () {
     var ok, transcriptionDetails;
     transcriptionDetails = document.getElementById('delete-transcription').value;
@@ -223,7 +285,14 @@ transcript_uploader = (function() {
     }
     ok = confirm('You are about to delete the transcription ' + transcriptionDetails.split('|')[0] + '.\nAre you sure you want to continue?');
     if (ok === true) {
-      document.getElementById('transcription_delete_form').submit();
+      $.post('/transcriptions/delete', forms.serialiseForm('transcription_delete_form'), function(response) {
+        showMessageBox('<p id="message">Waiting for the deletion of ' + transcriptionDetails.split('|')[0] +
+                       ' to start.</p>');
+        document.getElementById('error_close').innerHTML = '';
+        indexing.pollDeletionState(response.task_id, transcriptionDetails.split('|')[0]);
+      }, 'json').fail(function (response) {
+        handleError('delete', response);
+      });
     } else {
       return;
     }
@@ -0,0 +1,84 @@
+"""Render a Django template as a stream of parts with the content of some of its blocks generated separately.
+
+The template is rendered node by node in the same way as Django renders it, so inheritance and
+block.super work as usual, except that a block named in streams is replaced by the strings its
+generator yields. Everything before such a block is sent as soon as the block is reached and the
+rest of the page once the generator is exhausted, so a long list can be sent while it is read
+without the rest of the page being parsed out of rendered output.
+"""
+
+from django.template.context import make_context
+from django.template.loader import get_template
+from django.template.loader_tags import BLOCK_CONTEXT_KEY, BlockContext, BlockNode, ExtendsNode
+from django.template.base import TextNode
+
+
+class StreamedPart(str):
+    pass
+
+
+def generate_extends(node, context, streams):
+    # as ExtendsNode.render
+    compiled_parent = node.get_parent(context)
+    if BLOCK_CONTEXT_KEY not in context.render_context:
+        context.render_context[BLOCK_CONTEXT_KEY] = BlockContext()
+    block_context = context.render_context[BLOCK_CONTEXT_KEY]
+    block_context.add_blocks(node.blocks)
+    for parent_node in compiled_parent.nodelist:
+        if not isinstance(parent_node, TextNode):
+            if not isinstance(parent_node, ExtendsNode):
+                block_context.add_blocks({block.name: block for block in
+                                          compiled_parent.nodelist.get_nodes_by_type(BlockNode)})
+            break
+    with context.render_context.push_state(compiled_parent, isolated_context=False):
+        yield from generate_nodes(compiled_parent.nodelist, context, streams)
+
+
+def generate_block(node, context, streams):
+    # as BlockNode.render
+    block_context = context.render_context.get(BLOCK_CONTEXT_KEY)
+    with context.push():
+        push = None
+        block = node
+        if block_context is not None:
+            push = block = block_context.pop(node.name)
+            if block is None:
+                block = node
+            block = type(node)(block.name, block.nodelist)
+            block.context = context
+        context['block'] = block
+        if block.name in streams:
+            for part in streams[block.name]:
+                yield StreamedPart(part)
+        else:
+            yield from generate_nodes(block.nodelist, context, streams)
+        if push is not None:
+            block_context.push(node.name, push)
+
+
+def generate_nodes(nodelist, context, streams):
+    for node in nodelist:
+        if isinstance(node, ExtendsNode):
+            yield from generate_extends(node, context, streams)
+        elif isinstance(node, BlockNode):
+            yield from generate_block(node, context, streams)
+        else:
+            yield node.render_annotated(context)
+
+
+def stream_template(template_name, context, request, streams):
+    """Yield the template rendered in parts with each block named in streams replaced by its generator."""
+    template = get_template(template_name)
+    context = make_context(context, request, autoescape=template.backend.engine.autoescape)
+    template = template.template
+    parts = []
+    with context.render_context.push_state(template), context.bind_template(template):
+        context.template_name = template.name
+        for part in generate_nodes(template.nodelist, context, streams):
+            if isinstance(part, StreamedPart):
+                # everything rendered before the streamed block is sent with its first part
+                yield ''.join(parts) + part
+                parts = []
+            else:
+                parts.append(part)
+    yield ''.join(parts)
@@ -0,0 +1,98 @@
+"""Generate synthetic MUYA TEI transcriptions.
+
+The documents are deterministic for a given set of arguments and valid against the MUYA schema so
+they can be used for benchmarking and testing the parsers without real manuscript data."""
+
+import random
+from xml.sax.saxutils import quoteattr
+
+LETTERS = ['a', 'ā', 'ə', 'ō', 'i', 'u', 'ū', 'e', 'k', 'g', 't', 'θ', 'd', 'δ', 'p', 'f', 'b', 'β', 'm', 'n',
+           'ŋ', 'y', 'v', 'r', 's', 'š', 'z', 'ž', 'x', 'h']
+
+TRANSLATION_LANGUAGES = ['sa', 'pal-Phlv', 'gu']
+
+
+def make_word(rng):
+    return ''.join(rng.choice(LETTERS) for i in range(rng.randint(2, 9)))
+
+
+def make_words(rng, count, language=None):
+    words = []
+    for i in range(count):
+        word = make_word(rng)
+        choice = rng.random()
+        if choice < 0.05:
+            word = '{}<supplied reason="omitted">{}</supplied>'.format(word[:1], word[1:])
+        elif choice < 0.1:
+            word = '{}<unclear>{}</unclear>'.format(word[:1], word[1:])
+        if language is None and rng.random() < 0.1:
+            words.append('<w lemma={}>{}</w>'.format(quoteattr(make_word(rng)), word))
+        else:
+            words.append('<w>{}</w>'.format(word))
+        if rng.random() < 0.2:
+            words.append('<pc>.</pc>')
+    return words
+
+
+def make_app(rng, hands):
+    hand = rng.choice(hands[1:])
+    return ('<app><rdg type="orig" hand="firsthand"><w>{}</w></rdg>'
+            '<rdg type="corr" hand="{}"><w>{}</w></rdg></app>'.format(make_word(rng), hand, make_word(rng)))
+
+
+def make_line(rng, reference, app_density, hands, words_per_line):
+    content = []
+    for word in make_words(rng, words_per_line):
+        if len(hands) > 1 and word.startswith('<w') and rng.random() < app_density:
+            content.append(make_app(rng, hands))
+        else:
+            content.append(word)
+    if rng.random() < 0.05:
+        content.append('<gap reason="lacuna" unit="word" quantity="{}"/>'.format(rng.randint(1, 4)))
+    return '<ab type="line" n="{}">{}</ab>'.format(reference, ' '.join(content))
+
+
+def make_translation(rng, reference, language, words_per_line):
+    subtypes = ['translation', 'commentary']
+    return ''.join('<ab type="line" n="{}" xml:lang="{}" subtype="{}">{}</ab>'.format(
+        reference, language, subtype, ' '.join(make_words(rng, words_per_line, language))) for subtype in subtypes)
+
+
+def generate_transcription(siglum='4010', chapters=2, stanzas=3, lines=4, words_per_line=8, app_density=0.1,
+                           hands=2, ritual_directions=0.1, languages=['ae'], first_chapter=28, seed=0):
+    """Return a synthetic transcription as a string.
+
+    hands is the total number of hands including the first hand, app_density is the proportion of
+    words with a correction and ritual_directions the proportion of lines followed by a ritual
+    direction. Any language other than ae is added as a translation and commentary of each line.
+    """
+    rng = random.Random('{}-{}'.format(seed, siglum))
+    hand_ids = ['firsthand'] + ['corrector{}'.format(i) if i > 1 else 'corrector' for i in range(1, hands)]
+    other_languages = [language for language in languages if language != 'ae']
+
+    body = []
+    for chapter in range(first_chapter, first_chapter + chapters):
+        body.append('<div type="chapter" n="Y.{}">'.format(chapter))
+        for stanza in range(1, stanzas + 1):
+            body.append('<div type="stanza" n="Y.{}.{}">'.format(chapter, stanza))
+            for line in range(1, lines + 1):
+                reference = 'Y.{}.{}.{}'.format(chapter, stanza, line)
+                body.append(make_line(rng, reference, app_density, hand_ids, words_per_line))
+                for language in other_languages:
+                    body.append(make_translation(rng, reference, language, words_per_line))
+                if rng.random() < ritual_directions:
+                    body.append('<ab type="ritualdirection" n="{}"><note type="transcriptionRD">{}</note>{}'
+                                '</ab>'.format(reference, make_word(rng), make_word(rng)))
+            body.append('</div>')
+        body.append('</div>')
+
+    witnesses = ''.join('<witness xml:id="{}"/>'.format(hand) for hand in hand_ids)
+    return ('<TEI xmlns="http://www.tei-c.org/ns/1.0">'
+            '<teiHeader><fileDesc>'
+            '<titleStmt><title type="document" n="{siglum}" key="{siglum}">Synthetic transcription</title>'
+            '</titleStmt>'
+            '<publicationStmt><p>Generated for testing</p></publicationStmt>'
+            '<sourceDesc><listWit>{witnesses}</listWit></sourceDesc>'
+            '</fileDesc></teiHeader>'
+            '<text xml:lang="ae"><body>\n{body}\n</body></text>'
+            '</TEI>').format(siglum=siglum, witnesses=witnesses, body='\n'.join(body))
@@ -1,27 +1,151 @@
-from celery import shared_task
+import re
+from celery import group, shared_task, uuid
 from lxml import etree
-from django.db import IntegrityError
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Exists, OuterRef
+from django.utils import timezone
 from accounts.models import User
-from transcriptions import models
+from transcriptions import flights, models, progress, routing, witness_format
 from transcriptions.yasna_parser import YasnaParser
 from transcriptions.yasna_word_parser import YasnaWordParser
 
+UNIT_BATCH_SIZE = 500
+DELETE_BATCH_SIZE = 5000
+TOKEN_BATCH_SIZE = 5000
 
-@shared_task(track_started=True)
-def index_transcription(xml_string, collection, username=None, siglum=None, project_id=None, public_flag=False,
+# the key of the postgres advisory lock which stops fragments being collected while units are saved
+FRAGMENT_LOCK_KEY = 7342001
+# the first key of the postgres advisory locks which serialise the saves of each transcription identifier
+TRANSCRIPTION_LOCK_CLASS = 7342
+
+
+@shared_task(bind=True, track_started=True)
+def index_transcription(self, xml_string, collection, username=None, siglum=None, project_id=None, public_flag=False,
                         languages=['ae']):
 
+    task_id = self.request.id
+    try:
+        flight_key = flights.get_key(collection, siglum, username, xml_string)
+    except Exception as e:
+        # nothing can have been registered for input which has no key so only the failure is published
+        progress.publish(task_id, 'FAILURE', message=str(e))
+        raise
+    if not flights.is_current(flight_key, task_id):
+        # a newer upload of the transcription was started after this task was queued
+        return {'superseded': True}
+    with routing.user_slot(username) as has_slot:
+        if not has_slot:
+            # the user already has as many indexing tasks running as allowed so wait at the back of the queue
+            progress.publish(task_id, 'PENDING', stage='waiting')
+            raise self.retry(countdown=routing.get_slot_wait(), max_retries=None)
+        reporter = progress.ProgressReporter(self)
+        progress.publish(task_id, 'STARTED', stage='parsing')
+        identifier = None
+        try:
+            data = parse_transcription(xml_string, collection, username=username, public_flag=public_flag,
+                                       languages=languages, on_progress=reporter.report)
+            if not flights.is_current(flight_key, task_id):
+                progress.publish(task_id, 'SUPERSEDED', superseded_by=flights.get_task_id(flight_key))
+                return {'superseded': True}
+            identifier = data['transcription']['identifier']
+            # mark any existing transcription as incomplete while its units are replaced
+            models.Transcription.objects.filter(identifier=identifier).update(loading_complete=False)
+            result = save_transcription(data, username, on_progress=reporter.report)
+        except Exception as e:
+            if identifier is not None:
+                # the save has been rolled back so any existing transcription still has all of its units
+                models.Transcription.objects.filter(identifier=identifier).update(loading_complete=True)
+            progress.publish(task_id, 'FAILURE', message=str(e))
+            flights.finish(flight_key, task_id)
+            raise
+        progress.publish(task_id, 'SUCCESS', **result)
+        flights.finish(flight_key, task_id)
+        return result
+
+
+def get_index_transcription_task(xml_string, collection, username=None, siglum=None, public_flag=False,
+                                 languages=['ae'], batch=False):
+    """Return the id of the task to index the transcription and its signature if it needs to be started.
+
+    If the same content is already being indexed for the user the id of that task is returned with
+    no signature and if different content is being indexed that task is revoked (if it has not
+    started) or stops before saving (if it has) and is replaced by the new one. The task is sent to
+    the queue of its workload (see routing.py).
+    """
+    flight_key = flights.get_key(collection, siglum, username, xml_string)
+    digest = flights.get_digest(xml_string, public_flag, languages)
+    current = flights.get_current(flight_key)
+    if current is not None and current['digest'] == digest:
+        return current['task_id'], None
+    task_id = uuid()
+    flights.register(flight_key, task_id, digest)
+    # recorded here so that every indexing task, however it was started, can be followed by its user
+    progress.set_owner(task_id, username)
+    if current is not None:
+        index_transcription.app.control.revoke(current['task_id'])
+        progress.publish(current['task_id'], 'SUPERSEDED', superseded_by=task_id)
+    signature = index_transcription.signature(args=(xml_string, collection),
+                                              kwargs={'username': username, 'siglum': siglum,
+                                                      'public_flag': public_flag, 'languages': languages},
+                                              task_id=task_id, immutable=True,
+                                              **routing.get_options(routing.get_workload(xml_string, siglum, batch)))
+    return task_id, signature
+
+
+def start_index_transcription(xml_string, collection, username=None, siglum=None, public_flag=False,
+                              languages=['ae']):
+    """Start a task to index the transcription unless one is already indexing it and return its id."""
+    task_id, signature = get_index_transcription_task(xml_string, collection, username=username, siglum=siglum,
+                                                      public_flag=public_flag, languages=languages)
+    if signature is not None:
+        signature.apply_async()
+    return task_id
+
+
+def start_index_batch(uploads, collection, username=None, languages=['ae']):
+    """Start the indexing of several transcriptions as a group and return the id of the task for each.
+
+    Each upload is a dictionary of the xml_string, siglum and public_flag of a transcription.
+    """
+    task_ids = []
+    signatures = []
+    for upload in uploads:
+        task_id, signature = get_index_transcription_task(upload['xml_string'], collection, username=username,
+                                                          siglum=upload['siglum'],
+                                                          public_flag=upload['public_flag'], languages=languages,
+                                                          batch=True)
+        task_ids.append(task_id)
+        if signature is not None:
+            signatures.append(signature)
+    if len(signatures) > 0:
+        group(signatures).apply_async()
+    return task_ids
+
+
+def parse_transcription(xml_string, collection, username=None, public_flag=False, languages=['ae'],
+                        source='Web upload', on_progress=None):
+
     if public_flag is True:
         private_boolean = False
     else:
         private_boolean = True
-    source = 'Web upload'
 
     parser = YasnaParser(xml_string, collection=collection, filename=source, private=private_boolean, user_id=username,
                          languages=languages)
 
-    data = parser.get_data_online()
+    return parser.get_data_online(on_progress=on_progress)
+
+
+def lock_transcription(identifier):
+    # held until the end of the transaction so that saves of the same transcription run one at a time
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT pg_advisory_xact_lock(%s, hashtext(%s))', [TRANSCRIPTION_LOCK_CLASS, identifier])
+
 
+@transaction.atomic
+def save_transcription(data, username, on_progress=None):
+
+    lock_transcription(data['transcription']['identifier'])
     user = User.objects.get(id=username)
     data['transcription']['user'] = user
     try:
@@ -52,38 +176,166 @@ def index_transcription(xml_string, collection, username=None, siglum=None, proj
 
     existing_transcription_identifier = None
 
-    transcriptions = models.Transcription.objects.filter(identifier=data['transcription']['identifier'])
+    transcriptions = models.Transcription.objects.filter(
+        identifier=data['transcription']['identifier']).only('id', 'version')
     if transcriptions.count() > 1:
         raise Exception('There are too many transcriptions with the identifier {} in the system. '
                         'This must be fixed before uploading this '
                         'transcription.'.format(data['transcription']['identifier']))
 
     if transcriptions.count() == 1:
-        current_id = transcriptions[0].id
-        units = models.CollationUnit.objects.filter(transcription_identifier=data['transcription']['identifier'])
-        units.delete()
+        existing_transcription = transcriptions[0]
+        current_id = existing_transcription.id
+        models.CollationUnit.objects.for_transcription(data['transcription']['identifier']).delete()
+        models.ContextWitness.objects.filter(transcription_id=current_id).delete()
+        models.TokenIndex.objects.filter(transcription_id=current_id).delete()
         data['transcription']['id'] = current_id
+        data['transcription']['version'] = existing_transcription.version + 1
 
     # check that the deletion worked
-    units = models.CollationUnit.objects.filter(transcription_identifier=data['transcription']['identifier'])
-    if units.count() > 0:
+    if models.CollationUnit.objects.for_transcription(data['transcription']['identifier']).exists():
         raise Exception('The existing collation units did not delete correctly. Please try the upload again.')
 
     # Now make the new objects
+    data['transcription']['modified'] = timezone.now()
+    data['transcription']['loading_complete'] = True
     transcription_object = models.Transcription(**data['transcription'])
     transcription_object.save()
 
+    lock_fragments(shared=True)
+    fragments = {}
+    unit_witnesses = {}
+    unit_count = 0
     for language in data['collation_units'].keys():
+        collationunit_objects = []
         for unit in data['collation_units'][language]:
             unit['transcription'] = transcription_object
             unit['user'] = user
             unit['work'] = current_work
+            # the tei and witnesses are stored in shared fragments
+            tei_fragment = models.UnitFragment.for_tei(unit.pop('tei'))
+            fragments[tei_fragment.digest] = tei_fragment
+            unit['tei_fragment_id'] = tei_fragment.digest
+            witnesses = unit.pop('witnesses', None)
+            if witnesses is not None:
+                witnesses_fragment = models.UnitFragment.for_witnesses(witness_format.compact(witnesses))
+                fragments[witnesses_fragment.digest] = witnesses_fragment
+                unit['witnesses_fragment_id'] = witnesses_fragment.digest
+                unit_witnesses[unit['identifier']] = witnesses
             try:
                 del unit['user_id']
             except KeyError:
                 pass
-            collationunit_object = models.CollationUnit(**unit)
+            collationunit_objects.append(models.CollationUnit(**unit))
+        for start in range(0, len(collationunit_objects), UNIT_BATCH_SIZE):
+            batch = collationunit_objects[start:start + UNIT_BATCH_SIZE]
+            batch_fragments = {}
+            for unit in batch:
+                for digest in [unit.tei_fragment_id, unit.witnesses_fragment_id]:
+                    if digest is not None:
+                        batch_fragments[digest] = fragments[digest]
             try:
-                collationunit_object.save()
+                # fragments already stored by earlier uploads are skipped
+                models.UnitFragment.objects.bulk_create(batch_fragments.values(), ignore_conflicts=True)
+                models.CollationUnit.objects.bulk_create(batch)
+                models.ContextWitness.objects.bulk_create([models.ContextWitness.from_unit(unit) for unit in batch])
+                models.TokenIndex.objects.bulk_create(
+                    [token for unit in batch
+                     for token in models.TokenIndex.for_unit(unit, unit_witnesses.get(unit.identifier))],
+                    batch_size=TOKEN_BATCH_SIZE)
             except IntegrityError as e:
                 raise e
+            if on_progress is not None:
+                on_progress('written', language, start + len(batch))
+        unit_count += len(collationunit_objects)
+
+    return {'identifier': transcription_object.identifier,
+            'siglum': transcription_object.siglum,
+            'version': transcription_object.version,
+            'units': unit_count}
+
+
+def get_siglum_regex(pattern):
+    # * matches any sequence of characters in a siglum pattern
+    return '^{}$'.format('.*'.join(re.escape(part) for part in pattern.split('*')))
+
+
+def get_transcriptions_to_delete(ids=None, user=None, work=None, siglum=None):
+    if ids is None and user is None and work is None and siglum is None:
+        raise ValueError('At least one of ids, user, work or siglum must be given to delete transcriptions.')
+    transcriptions = models.Transcription.objects.order_by()
+    if ids is not None:
+        transcriptions = transcriptions.filter(id__in=ids)
+    if user is not None:
+        transcriptions = transcriptions.filter(user__id=user)
+    if work is not None:
+        transcriptions = transcriptions.filter(work__abbreviation=work)
+    if siglum is not None:
+        transcriptions = transcriptions.filter(siglum__regex=get_siglum_regex(siglum))
+    return transcriptions
+
+
+def delete_units(transcription_id, model=models.CollationUnit):
+    """Delete the rows of the model for a transcription in batches and return the number deleted."""
+    deleted = 0
+    while True:
+        with transaction.atomic():
+            row_ids = list(model.objects.order_by().filter(transcription_id=transcription_id)
+                           .values_list('id', flat=True)[:DELETE_BATCH_SIZE])
+            if len(row_ids) == 0:
+                return deleted
+            # the rows have no dependent rows so this is a single delete statement
+            deleted += model.objects.filter(id__in=row_ids).delete()[0]
+
+
+@shared_task(bind=True, track_started=True)
+def delete_transcriptions(self, ids=None, user=None, work=None, siglum=None):
+
+    task_id = self.request.id
+    transcriptions = get_transcriptions_to_delete(ids=ids, user=user, work=work, siglum=siglum)
+    to_delete = list(transcriptions.values_list('id', 'identifier', 'user', 'siglum'))
+    progress.publish(task_id, 'STARTED', stage='deleting', transcriptions_done=0,
+                     transcriptions_total=len(to_delete), units_deleted=0)
+    units_deleted = 0
+    deleted = []
+    try:
+        for i, (transcription_id, identifier, user_id, transcription_siglum) in enumerate(to_delete, 1):
+            units_deleted += delete_units(transcription_id)
+            delete_units(transcription_id, models.ContextWitness)
+            delete_units(transcription_id, models.TokenIndex)
+            with transaction.atomic():
+                # any units left are removed by the cascade in a single statement without being loaded
+                models.Transcription.objects.filter(id=transcription_id).delete()
+                # the collation units of any other transcriptions of the siglum are displayed with those deleted
+                models.Transcription.objects.filter(user=user_id, siglum=transcription_siglum).touch()
+            deleted.append(identifier)
+            progress.publish(task_id, 'STARTED', stage='deleting', transcriptions_done=i,
+                             transcriptions_total=len(to_delete), units_deleted=units_deleted)
+    except Exception as e:
+        progress.publish(task_id, 'FAILURE', message=str(e), deleted=deleted)
+        raise
+    result = {'transcriptions': deleted, 'units': units_deleted}
+    progress.publish(task_id, 'SUCCESS', **result)
+    return result
+
+
+def lock_fragments(shared=False):
+    # saves take the lock shared so they do not block each other, only collecting the fragments is exclusive
+    with connection.cursor() as cursor:
+        if shared:
+            cursor.execute('SELECT pg_advisory_xact_lock_shared(%s)', [FRAGMENT_LOCK_KEY])
+        else:
+            cursor.execute('SELECT pg_advisory_xact_lock(%s)', [FRAGMENT_LOCK_KEY])
+
+
+@shared_task
+def collect_fragments():
+    """Delete the unit fragments which are no longer referenced by any collation unit or context witness."""
+    with transaction.atomic():
+        lock_fragments()
+        orphans = models.UnitFragment.objects.filter(
+            ~Exists(models.CollationUnit.objects.order_by().filter(tei_fragment=OuterRef('pk'))),
+            ~Exists(models.CollationUnit.objects.order_by().filter(witnesses_fragment=OuterRef('pk'))),
+            ~Exists(models.ContextWitness.objects.order_by().filter(witnesses_fragment=OuterRef('pk'))))
+        deleted = orphans.delete()[0]
+    return {'fragments': deleted}
@@ -1,3 +1,1229 @@
-from django.test import TestCase
+import io
+import base64
+import os
+import json
+import math
+import time
+import zlib
+import tempfile
+from array import array
+import tracemalloc
+from unittest import mock
+from celery.exceptions import Retry
+from lxml import etree
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection, connections
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from accounts.models import User
+from transcriptions import (export, fields, flights, models, progress, routing, serializers, snapshot, tasks,
+                            validation, warmup, witness_format)
+from transcriptions.synthetic import generate_transcription
+from transcriptions.exceptions import XMLStructureError
+from transcriptions.validation import validate_xml
+from transcriptions.yasna_parser import YasnaParser, get_siglum_sort_key
 
-# Create your tests here.
+
+class TranscriptionsTestCase(TestCase):
+    """Set up the collection, works and user that transcriptions are indexed with."""
+
+    WORKS = ['VS']
+    SUPERUSER = False
+
+    @classmethod
+    def setUpTestData(cls):
+        collection = models.Collection.objects.create(identifier='AV', name='Avesta', abbreviation='AV')
+        for abbreviation in cls.WORKS:
+            models.Work.objects.create(identifier='AV_{}'.format(abbreviation), name=abbreviation,
+                                       abbreviation=abbreviation, collection=collection)
+        cls.user = User.objects.create_user(username='editor', password='password', is_superuser=cls.SUPERUSER)
+
+
+class SyntheticTranscriptionTests(SimpleTestCase):
+
+    def test_generation_is_deterministic(self):
+        self.assertEqual(generate_transcription(seed=3), generate_transcription(seed=3))
+        self.assertNotEqual(generate_transcription(seed=3), generate_transcription(seed=4))
+
+    def test_transcription_is_valid(self):
+        for siglum in ['basetext', '4010', '4010S1']:
+            xml_string = generate_transcription(siglum=siglum, hands=3, app_density=0.5, ritual_directions=0.5,
+                                                languages=['ae', 'sa'])
+            results = validate_xml(etree.fromstring(xml_string), 'synthetic.xml')
+            self.assertEqual(results['errors'], [])
+            self.assertTrue(results['valid'])
+
+    def test_transcription_parses(self):
+        xml_string = generate_transcription(chapters=2, stanzas=3, lines=4, hands=3, app_density=0.5,
+                                            languages=['ae', 'sa'])
+        parser = YasnaParser(xml_string, collection='AV', user_id=1, languages=['ae', 'sa'])
+        data = parser.get_data_online()
+        self.assertEqual(data['transcription']['identifier'], 'AV_4010_Y28-Y29_1')
+        self.assertEqual(data['transcription']['corrector_order'], ['firsthand', 'corrector', 'corrector2'])
+        for language in ['ae', 'sa']:
+            self.assertEqual(len(data['collation_units'][language]), 24)
+            for unit in data['collation_units'][language]:
+                self.assertTrue(len(unit['witnesses']) > 0)
+
+    def test_ritual_directions_are_moved_once(self):
+        xml_string = generate_transcription(siglum='basetext', ritual_directions=0.5, languages=['ae', 'sa'])
+        data = YasnaParser(xml_string, collection='AV', user_id=1, languages=['ae', 'sa']).get_data_online()
+        notes = [note for language in data['collation_units'] for unit in data['collation_units'][language]
+                 for note in etree.fromstring(unit['tei']).iter('{*}note')
+                 if note.get('type') == 'moved_ritual_direction']
+        self.assertTrue(len(notes) > 0)
+        # the later languages must not add the notes again once the directions have been moved
+        for note in notes:
+            self.assertTrue(len(note) > 0 or (note.text or '').strip() != '')
+
+
+class DryRunTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='editor', password='password')
+
+    def get_broken_transcription(self):
+        xml_string = generate_transcription(siglum='basetext', app_density=0.5)
+        start = xml_string.index('<app>')
+        end = xml_string.index('</app>', start)
+        # an app tag with a tail, an unexpected element in a stanza and a malformed n attribute
+        xml_string = (xml_string[:start] + '<seg type="x"><app>' + xml_string[start + 5:end] + '</app>tail</seg>' +
+                      xml_string[end + 6:])
+        xml_string = xml_string.replace('<div type="stanza" n="Y.29.1">', '<div type="stanza" n="Y.29.1"><p/>', 1)
+        return xml_string.replace('n="Y.28.2.1"', 'n="Y.28.x"', 1)
+
+    def test_all_errors_are_reported(self):
+        xml_string = self.get_broken_transcription()
+        with self.assertRaises(XMLStructureError):
+            YasnaParser(xml_string, collection='AV').get_data_online()
+        report = validation.dry_run(xml_string)
+        self.assertFalse(report['valid'])
+        self.assertEqual([error['context'] for error in report['errors']], ['Y.29.1', 'Y.28.x', 'Y.28.1.1'])
+        self.assertIsNotNone(report['errors'][0]['line'])
+        self.assertEqual(report['stats']['units'], {'ae': 23})
+
+    def test_errors_are_reported_once_for_all_languages(self):
+        xml_string = generate_transcription(siglum='basetext', languages=['ae', 'sa'])
+        xml_string = xml_string.replace('<div type="stanza" n="Y.28.2">', '<div type="stanza" n="Y.28.2"><p/>', 1)
+        report = validation.dry_run(xml_string, languages=['ae', 'sa'])
+        self.assertEqual([error['context'] for error in report['errors']], ['Y.28.2'])
+        self.assertEqual(report['stats']['units'], {'ae': 24, 'sa': 24})
+
+    def test_statistics(self):
+        xml_string = generate_transcription(siglum='4010', hands=3, languages=['ae', 'sa'])
+        report = validation.dry_run(xml_string, languages=['ae', 'sa'])
+        self.assertTrue(report['valid'])
+        self.assertEqual(report['stats']['units'], {'ae': 24, 'sa': 24})
+        self.assertEqual(set(report['stats']['hands']), {'firsthand', 'corrector', 'corrector2'})
+        self.assertGreater(report['stats']['token_index_rows'], report['stats']['tokens'] / 2)
+        self.assertGreater(report['stats']['estimated_bytes'], len(fields.compress(xml_string)))
+
+    def test_validate_view(self):
+        self.client.force_login(self.user)
+        src = 'data:text/xml;base64,' + base64.b64encode(self.get_broken_transcription().encode('utf-8')).decode()
+        with self.assertNumQueries(0):
+            response = self.client.post(reverse('validate'), {'src': src, 'file_name': 'basetext.xml',
+                                                              'dry_run': 'true', 'skip_schema': 'true'})
+        results = response.json()
+        self.assertFalse(results['valid'])
+        self.assertEqual(len(results['structure_errors']), 3)
+        self.assertIn('line', results['errors'][-3])
+        self.assertEqual(results['stats']['units'], {'ae': 23})
+
+    def test_command(self):
+        with tempfile.TemporaryDirectory() as directory:
+            for siglum in ['4010', '4020']:
+                with open(os.path.join(directory, '{}.xml'.format(siglum)), 'w', encoding='utf-8') as xml_file:
+                    xml_file.write(generate_transcription(siglum=siglum))
+            out = io.StringIO()
+            call_command('index_transcriptions', directory, '--user', 'editor', '--dry-run', stdout=out)
+        self.assertIn('Checked 2 files (48 collation units)', out.getvalue())
+        self.assertFalse(models.Transcription.objects.exists())
+
+
+class SiglumSortKeyTests(SimpleTestCase):
+
+    def test_sort_order(self):
+        sigla = ['4010S1', '402', 'basetext', '4010', 'other', '4010S', '4010S2', '1000']
+        sigla.sort(key=lambda siglum: (get_siglum_sort_key(siglum) is None, get_siglum_sort_key(siglum) or 0))
+        self.assertEqual(sigla, ['basetext', '402', '1000', '4010', '4010S', '4010S1', '4010S2', 'other'])
+
+
+class WitnessFormatTests(SimpleTestCase):
+
+    def get_witnesses(self):
+        xml_string = generate_transcription(siglum='4010', hands=3, app_density=0.5, ritual_directions=0.5,
+                                            languages=['ae', 'sa'])
+        data = YasnaParser(xml_string, collection='AV', user_id=1, languages=['ae', 'sa']).get_data_online()
+        return [unit['witnesses'] for language in data['collation_units']
+                for unit in data['collation_units'][language] if 'witnesses' in unit]
+
+    def test_round_trip(self):
+        for witnesses in self.get_witnesses():
+            compacted = witness_format.compact(witnesses)
+            self.assertEqual(compacted['v'], witness_format.FORMAT_VERSION)
+            self.assertEqual(witness_format.expand(json.loads(json.dumps(compacted))), witnesses)
+            self.assertLess(len(json.dumps(compacted)), len(json.dumps(witnesses)) / 2)
+
+    def test_uncompacted_witnesses(self):
+        witnesses = self.get_witnesses()[0]
+        self.assertIs(witness_format.expand(witnesses), witnesses)
+        self.assertIsNone(witness_format.expand(None))
+        with self.assertRaises(ValueError):
+            witness_format.expand({'v': witness_format.FORMAT_VERSION + 1, 'r': []})
+
+
+class CompressedTextFieldTests(TranscriptionsTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.xml_string = generate_transcription(siglum='4010')
+        data = tasks.parse_transcription(cls.xml_string, 'AV', username=cls.user.id)
+        cls.summary = tasks.save_transcription(data, cls.user.id)
+
+    def test_round_trip(self):
+        transcription = models.Transcription.objects.get(identifier=self.summary['identifier'])
+        self.assertEqual(transcription.tei, self.xml_string)
+        stored = models.Transcription.objects.values_list('tei', flat=True).get(id=transcription.id)
+        self.assertIsInstance(stored, fields.CompressedText)
+        self.assertTrue(stored.startswith(fields.MAGIC))
+        self.assertLess(len(stored), len(self.xml_string.encode('utf-8')) / 2)
+        self.assertEqual(fields.decompress(stored), self.xml_string)
+
+    def test_lazy_decompression(self):
+        transcription = models.Transcription.objects.get(identifier=self.summary['identifier'])
+        self.assertIsInstance(transcription.__dict__['tei'], fields.CompressedText)
+        # saving without reading the value writes back the same bytes
+        transcription.save()
+        self.assertIsInstance(transcription.__dict__['tei'], fields.CompressedText)
+        self.assertEqual(transcription.tei, self.xml_string)
+        self.assertIsInstance(transcription.__dict__['tei'], str)
+
+    def test_dictionary(self):
+        fragment = '<ab xmlns="http://www.tei-c.org/ns/1.0" type="line" n="Y.28.1.1"><w>ahiiā</w> <w>yāsā</w></ab>'
+        self.assertLess(len(fields.compress(fragment)), len(zlib.compress(fragment.encode('utf-8'))))
+        self.assertEqual(fields.decompress(fields.compress(fragment)), fragment)
+        self.assertEqual(fields.decompress(fragment.encode('utf-8')), fragment)
+
+
+class PerformanceBudgetTests(TranscriptionsTestCase):
+    """Query count ceilings for the main views and the indexing task.
+
+    The ceilings are the same for every size of corpus so any change which makes the number of
+    queries grow with the number of transcriptions or units fails here. Indexing only adds the
+    inserts of each further batch of units and tokens, which is checked with the batch sizes reduced
+    so that a transcription needs several of each. The wall time and peak memory of each scenario
+    are written to the file given in the TRANSCRIPTIONS_PERF_REPORT setting if there is one.
+    """
+
+    WORKS = ['Y', 'VS']
+    SUPERUSER = True
+
+    SIZES = {
+        'small': {'chapters': 1, 'stanzas': 2, 'lines': 2},
+        'medium': {'chapters': 1, 'stanzas': 10, 'lines': 5},
+        'large': {'chapters': 2, 'stanzas': 20, 'lines': 5},
+    }
+
+    TRANSCRIPTION_COUNTS = {'small': 1, 'medium': 5, 'large': 20}
+
+    QUERY_CEILINGS = {
+        'index_transcription': 22,
+        'manage': 4,
+        'collation_units': 5,
+    }
+
+    report = {}
+
+    @classmethod
+    def tearDownClass(cls):
+        report_path = getattr(settings, 'TRANSCRIPTIONS_PERF_REPORT', None)
+        if report_path is not None:
+            with open(report_path, 'w', encoding='utf-8') as report_file:
+                json.dump(cls.report, report_file, indent=1, sort_keys=True)
+        super().tearDownClass()
+
+    def measure(self, scenario, function):
+        with CaptureQueriesContext(connection) as queries:
+            tracemalloc.start()
+            start = time.perf_counter()
+            result = function()
+            elapsed = time.perf_counter() - start
+            peak_memory = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        self.report[scenario] = {'queries': len(queries), 'seconds': elapsed, 'peak_memory': peak_memory}
+        return result, len(queries)
+
+    def index(self, siglum, size):
+        xml_string = generate_transcription(siglum=siglum, hands=3, app_density=0.2, **self.SIZES[size])
+        return tasks.index_transcription.apply(args=(xml_string, 'AV'),
+                                               kwargs={'username': self.user.id, 'siglum': siglum}).get()
+
+    def test_index_transcription(self):
+        for position, size in enumerate(self.SIZES):
+            siglum = str(4001 + position)
+            for upload in ['new', 'replace']:
+                scenario = 'index_transcription_{}_{}'.format(size, upload)
+                result, query_count = self.measure(scenario, lambda: self.index(siglum, size))
+                self.assertTrue(result['units'] > 0)
+                self.assertLessEqual(query_count, self.QUERY_CEILINGS['index_transcription'], scenario)
+
+    def get_batched_ceiling(self, units, tokens):
+        # each further batch of units adds the inserts of its fragments, units and contexts and each further
+        # batch of tokens one more, a batch of units can end with a part batch of tokens
+        unit_batches = math.ceil(units / tasks.UNIT_BATCH_SIZE)
+        token_batches = math.ceil(tokens / tasks.TOKEN_BATCH_SIZE) + unit_batches - 1
+        return self.QUERY_CEILINGS['index_transcription'] + 3 * (unit_batches - 1) + token_batches - 1
+
+    @mock.patch('transcriptions.tasks.UNIT_BATCH_SIZE', 50)
+    @mock.patch('transcriptions.tasks.TOKEN_BATCH_SIZE', 200)
+    def test_index_transcription_in_batches(self):
+        for upload in ['new', 'replace']:
+            scenario = 'index_transcription_batched_{}'.format(upload)
+            result, query_count = self.measure(scenario, lambda: self.index('4001', 'large'))
+            tokens = models.TokenIndex.objects.count()
+            self.assertGreater(result['units'], tasks.UNIT_BATCH_SIZE * 3)
+            self.assertGreater(tokens, tasks.TOKEN_BATCH_SIZE * 3)
+            # every batch is written
+            self.assertEqual(models.CollationUnit.objects.count(), result['units'])
+            self.assertEqual(models.ContextWitness.objects.count(), result['units'])
+            self.assertLessEqual(query_count, self.get_batched_ceiling(result['units'], tokens), scenario)
+
+    def get_streamed(self, url, params):
+        # the rows of a streamed response are only read from the database as the content is consumed
+        response = self.client.get(url, params)
+        return response, response.getvalue().decode('utf-8')
+
+    def test_listings_do_not_load_tei(self):
+        self.client.force_login(self.user)
+        self.index('4001', 'small')
+        for url, params in [(reverse('manage'), {}), (reverse('collationunits'), {'siglum': '4001'})]:
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(url, params)
+                response.getvalue()
+            for query in queries:
+                self.assertNotIn('."tei"', query['sql'])
+
+    def test_views(self):
+        self.client.force_login(self.user)
+        indexed = 0
+        for size, count in self.TRANSCRIPTION_COUNTS.items():
+            while indexed < count:
+                indexed += 1
+                self.index(str(4000 + indexed), size)
+
+            response, query_count = self.measure('manage_{}'.format(size),
+                                                 lambda: self.client.get(reverse('manage')))
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(len(response.context['transcriptions']), count)
+            self.assertLessEqual(query_count, self.QUERY_CEILINGS['manage'])
+
+            (response, content), query_count = self.measure('collation_units_{}'.format(size),
+                                                            lambda: self.get_streamed(reverse('collationunits'),
+                                                                                      {'siglum': str(4000 + count)}))
+            self.assertEqual(response.status_code, 200)
+            self.assertIn('Y.28.1.1', content)
+            self.assertLessEqual(query_count, self.QUERY_CEILINGS['collation_units'])
+
+
+class CollationUnitViewTests(TranscriptionsTestCase):
+
+    SUPERUSER = True
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.xml_string = generate_transcription(siglum='4010', chapters=2, stanzas=3, lines=2,
+                                                languages=['ae', 'sa'])
+        cls.index(cls.xml_string)
+
+    @classmethod
+    def index(cls, xml_string):
+        return tasks.index_transcription.apply(args=(xml_string, 'AV'), kwargs={'username': cls.user.id,
+                                                                                'languages': ['ae', 'sa']}).get()
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.user)
+
+    def get_content(self, **params):
+        params['siglum'] = '4010'
+        response = self.client.get(reverse('collationunits'), params)
+        self.assertEqual(response.status_code, 200)
+        return response.getvalue().decode('utf-8')
+
+    def test_filters(self):
+        content = self.get_content(language='sa', chapter=29, stanza=2)
+        self.assertIn('Y.29.2.1', content)
+        self.assertIn('Y.29.2.2', content)
+        self.assertNotIn('Y.29.1.1', content)
+        self.assertNotIn('Y.28.2.1', content)
+        # each unit has a language and a context cell
+        self.assertEqual(content.count('<td rowspan'), 4)
+
+    @override_settings(TRANSCRIPTIONS_UNITS_PAGE_SIZE=4)
+    def test_pagination(self):
+        content = self.get_content(language='ae', page=2)
+        self.assertIn('page 2 of 3', content)
+        self.assertIn('Y.28.3.1', content)
+        self.assertNotIn('Y.28.2.2', content)
+        self.assertNotIn('Y.29.2.1', content)
+
+    @override_settings(TRANSCRIPTIONS_UNITS_PAGE_SIZE=4)
+    def test_rows_are_streamed_into_the_table(self):
+        # request values are echoed in the page before the rows and must not change where they go
+        response = self.client.get(reverse('collationunits'), {'siglum': '4010', 'language': 'ae',
+                                                               'note': '{% block rows %}COLLATION-UNIT-ROWS'})
+        parts = [part.decode('utf-8') for part in response.streaming_content]
+        content = ''.join(parts)
+        self.assertGreater(len(parts), 1)
+        self.assertTrue(parts[0].startswith('<'))
+        self.assertLess(content.index('<th>Text</th>'), content.index('Y.28.1.1'))
+        self.assertLess(content.index('Y.28.2.2'), content.index('</table>'))
+        self.assertEqual(content.count('<td rowspan'), 8)
+        self.assertIn('Back to Upload', parts[-1])
+
+    def test_conditional_response(self):
+        response = self.client.get(reverse('collationunits'), {'siglum': '4010'})
+        response.getvalue()
+        etag = response['ETag']
+        response = self.client.get(reverse('collationunits'), {'siglum': '4010'}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        response = self.client.get(reverse('collationunits'), {'siglum': '4010', 'language': 'ae'},
+                                   HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+        # reindexing the transcription changes the etag
+        self.index(self.xml_string)
+        response = self.client.get(reverse('collationunits'), {'siglum': '4010'}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_cached_response(self):
+        response = self.client.get(reverse('collationunits'), {'siglum': '4010'})
+        self.assertTrue(response.streaming)
+        content = response.getvalue()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('collationunits'), {'siglum': '4010'})
+        self.assertFalse(response.streaming)
+        self.assertEqual(response.content, content)
+        self.assertFalse(any('transcriptions_collationunit' in query['sql'] for query in queries))
+
+    def test_delete_changes_etag(self):
+        summary = self.index(generate_transcription(siglum='4010', first_chapter=30, chapters=1))
+        response = self.client.get(reverse('collationunits'), {'siglum': '4010'})
+        etag = response['ETag']
+        transcription = models.Transcription.objects.get(identifier=summary['identifier'])
+        with mock.patch.object(tasks.delete_transcriptions, 'apply_async',
+                               side_effect=lambda kwargs, **options: tasks.delete_transcriptions.apply(kwargs=kwargs)):
+            response = self.client.post(reverse('delete'), {'delete-transcription': '{}|{}'.format(
+                transcription.identifier, transcription.id)})
+        self.assertEqual(progress.get_progress(response.json()['task_id'])['state'], 'SUCCESS')
+        self.assertEqual(models.Transcription.objects.get(siglum='4010').version, 2)
+        response = self.client.get(reverse('collationunits'), {'siglum': '4010'}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+
+class TaskProgressTests(TranscriptionsTestCase):
+
+    SUPERUSER = True
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.user)
+
+    def test_task_publishes_progress(self):
+        xml_string = generate_transcription(siglum='4010', stanzas=30, languages=['ae', 'sa'])
+        result = tasks.index_transcription.apply(args=(xml_string, 'AV'), task_id='progress-test',
+                                                 kwargs={'username': self.user.id, 'languages': ['ae', 'sa']})
+        current = progress.get_progress('progress-test')
+        self.assertEqual(current['state'], 'SUCCESS')
+        self.assertEqual(current['meta'], result.get())
+        self.assertTrue(models.Transcription.objects.get(identifier=result.get()['identifier']).loading_complete)
+
+    def test_progress_counts(self):
+        reporter = progress.ProgressReporter(interval=60)
+        reporter.task_id = 'progress-test'
+        reporter.task = tasks.index_transcription
+        xml_string = generate_transcription(siglum='4010', stanzas=30, languages=['ae', 'sa'])
+        data = tasks.parse_transcription(xml_string, 'AV', username=self.user.id, languages=['ae', 'sa'],
+                                         on_progress=reporter.report)
+        tasks.save_transcription(data, self.user.id, on_progress=reporter.report)
+        for language in ['ae', 'sa']:
+            self.assertEqual(reporter.counts[language], {'parsed': 240, 'word_parsed': 240, 'written': 240})
+        current = progress.get_progress('progress-test')
+        self.assertEqual(current['meta']['units_done'], 480)
+        self.assertEqual(current['meta']['units_total'], 480)
+        # published at each change of stage or language but not at every batch within them
+        self.assertEqual(current['sequence'], 6)
+
+    def test_failure_is_published(self):
+        tasks.index_transcription.apply(args=(generate_transcription(siglum='4010'), 'AV'), task_id='progress-test',
+                                        kwargs={'username': 0})
+        current = progress.get_progress('progress-test')
+        self.assertEqual(current['state'], 'FAILURE')
+        self.assertIn('User matching query does not exist', current['meta']['message'])
+        self.assertFalse(models.Transcription.objects.exists())
+
+    def test_progress_is_returned_at_once(self):
+        progress.set_owner('progress-test', self.user.id)
+        progress.publish('progress-test', 'STARTED', stage='saving', units_done=10, units_total=20)
+        response = self.client.get(reverse('progress'), {'task': 'progress-test', 'sequence': 0})
+        self.assertEqual(response.json()['progress']['units_done'], 10)
+        self.assertEqual(response.json()['sequence'], 1)
+        self.assertNotIn('result', response.json())
+
+        # the request is not held, the client is told when to ask again
+        self.assertEqual(response['Retry-After'], '1')
+        with self.settings(TRANSCRIPTIONS_PROGRESS_RETRY_AFTER=3):
+            start = time.monotonic()
+            response = self.client.get(reverse('progress'), {'task': 'progress-test', 'sequence': 1})
+            self.assertLess(time.monotonic() - start, 0.5)
+        self.assertEqual(response.json()['sequence'], 1)
+        self.assertEqual(response['Retry-After'], '3')
+
+        progress.publish('progress-test', 'SUCCESS', identifier='AV_4010', siglum='4010', units=20)
+        response = self.client.get(reverse('progress'), {'task': 'progress-test', 'sequence': 1})
+        self.assertEqual(response.json()['state'], 'SUCCESS')
+        self.assertEqual(response.json()['result']['units'], 20)
+        self.assertNotIn('Retry-After', response)
+
+    def test_only_the_owner_can_follow_a_task(self):
+        other_user = User.objects.create_user(username='other', password='password')
+        progress.set_owner('progress-test', other_user.id)
+        progress.publish('progress-test', 'STARTED', stage='saving')
+        response = self.client.get(reverse('progress'), {'task': 'progress-test'})
+        self.assertEqual(response.status_code, 404)
+        response = self.client.get(reverse('progress'), {'task': 'unknown'})
+        self.assertEqual(response.status_code, 404)
+
+    def test_sequence_is_not_lost(self):
+        progress.publish('progress-test', 'STARTED')
+        progress.publish('progress-test', 'PROGRESS')
+        # the state written last by a concurrent publish may be the older one but the next number is not reused
+        cache.set(progress.get_key('progress-test'), {'state': 'STARTED', 'sequence': 1, 'meta': {}})
+        progress.publish('progress-test', 'PROGRESS')
+        self.assertEqual(progress.get_progress('progress-test')['sequence'], 3)
+
+
+class SingleFlightTests(TranscriptionsTestCase):
+
+    def setUp(self):
+        cache.clear()
+        patcher = mock.patch.object(tasks.index_transcription, 'apply_async')
+        self.apply_async = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(tasks.index_transcription.app.control, 'revoke')
+        self.revoke = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def start(self, xml_string):
+        return tasks.start_index_transcription(xml_string, 'AV', username=self.user.id, siglum='4010')
+
+    def run_task(self, task_id):
+        # run the task that was queued with the given id
+        for queued in self.apply_async.call_args_list:
+            if queued.kwargs['task_id'] == task_id:
+                return tasks.index_transcription.apply(args=queued.args[0], kwargs=queued.args[1],
+                                                       task_id=task_id).get()
+
+    def test_duplicate_attaches(self):
+        xml_string = generate_transcription(siglum='4010')
+        task_id = self.start(xml_string)
+        self.assertEqual(self.start(xml_string), task_id)
+        self.assertEqual(self.apply_async.call_count, 1)
+        self.run_task(task_id)
+        # once the task has finished the same content is indexed again
+        self.assertNotEqual(self.start(xml_string), task_id)
+
+    def test_newer_content_supersedes(self):
+        first_task_id = self.start(generate_transcription(siglum='4010'))
+        second_task_id = self.start(generate_transcription(siglum='4010', seed=1))
+        self.assertNotEqual(second_task_id, first_task_id)
+        self.revoke.assert_called_once_with(first_task_id)
+        self.assertEqual(progress.get_progress(first_task_id)['state'], 'SUPERSEDED')
+        self.assertEqual(progress.get_progress(first_task_id)['meta'], {'superseded_by': second_task_id})
+        # a superseded task which starts anyway stops without saving
+        self.assertEqual(self.run_task(first_task_id), {'superseded': True})
+        self.assertFalse(models.Transcription.objects.exists())
+        self.assertEqual(self.run_task(second_task_id)['siglum'], '4010')
+        self.assertEqual(models.Transcription.objects.count(), 1)
+
+    def test_malformed_input_is_reported(self):
+        with self.assertRaises(Exception):
+            tasks.index_transcription.apply(args=('<TEI>', 'AV'), kwargs={'username': self.user.id},
+                                            task_id='malformed-test').get()
+        self.assertEqual(progress.get_progress('malformed-test')['state'], 'FAILURE')
+
+    def test_other_chapters_do_not_supersede(self):
+        first_task_id = self.start(generate_transcription(siglum='4010', chapters=1))
+        second_task_id = self.start(generate_transcription(siglum='4010', chapters=1, first_chapter=30))
+        self.assertNotEqual(second_task_id, first_task_id)
+        self.revoke.assert_not_called()
+        self.run_task(first_task_id)
+        self.run_task(second_task_id)
+        self.assertEqual(models.Transcription.objects.count(), 2)
+
+    def test_dead_task_is_not_attached(self):
+        xml_string = generate_transcription(siglum='4010')
+        task_id = self.start(xml_string)
+        progress.publish(task_id, 'STARTED', stage='parsing')
+        # the worker died so the task never publishes again
+        with override_settings(TRANSCRIPTIONS_FLIGHT_STALE=-1):
+            self.assertNotEqual(self.start(xml_string), task_id)
+        task_id = self.start(xml_string)
+        with mock.patch.object(flights, 'AsyncResult', return_value=mock.Mock(state='FAILURE', backend=None)):
+            self.assertNotEqual(self.start(xml_string), task_id)
+
+
+class RoutingTests(TranscriptionsTestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def hold_slot(self, slot):
+        # take one of the user's slots from another database session as a task in another worker would
+        other = connections.create_connection('default')
+        self.addCleanup(other.close)
+        with other.cursor() as cursor:
+            cursor.execute('SELECT pg_advisory_lock(%s, hashtext(%s))',
+                           [routing.USER_SLOT_LOCK_CLASS, '{}:{}'.format(self.user.id, slot)])
+
+    def test_workload(self):
+        xml_string = generate_transcription(siglum='4010')
+        self.assertEqual(routing.get_workload(xml_string, '4010'), routing.INTERACTIVE)
+        self.assertEqual(routing.get_workload(xml_string, '4010', batch=True), routing.BULK)
+        self.assertEqual(routing.get_workload(xml_string, 'basetext', batch=True), routing.LARGE)
+        with override_settings(TRANSCRIPTIONS_LARGE_TRANSCRIPTION_SIZE=len(xml_string)):
+            self.assertEqual(routing.get_workload(xml_string, '4010'), routing.LARGE)
+
+    def test_queues(self):
+        xml_string = generate_transcription(siglum='4010')
+        task_id, signature = tasks.get_index_transcription_task(xml_string, 'AV', username=self.user.id,
+                                                                siglum='4010')
+        # without any queues configured everything goes to the default queue
+        self.assertNotIn('queue', signature.options)
+        queues = {routing.INTERACTIVE: 'uploads', routing.BULK: 'bulk'}
+        with override_settings(TRANSCRIPTIONS_QUEUES=queues):
+            task_id, signature = tasks.get_index_transcription_task(xml_string, 'AV', username=self.user.id,
+                                                                    siglum='4020', batch=True)
+            self.assertEqual(signature.options['queue'], 'bulk')
+            task_id, signature = tasks.get_index_transcription_task(xml_string, 'AV', username=self.user.id,
+                                                                    siglum='4030')
+            self.assertEqual(signature.options['queue'], 'uploads')
+            self.assertEqual(routing.get_options(routing.LARGE), {})
+
+    @override_settings(TRANSCRIPTIONS_USER_CONCURRENCY=2)
+    def test_user_slots(self):
+        self.hold_slot(0)
+        with routing.user_slot(self.user.id) as has_slot:
+            self.assertTrue(has_slot)
+        self.hold_slot(1)
+        with routing.user_slot(self.user.id) as has_slot:
+            self.assertFalse(has_slot)
+        # the slots of other users are not affected
+        with routing.user_slot(self.user.id + 1) as has_slot:
+            self.assertTrue(has_slot)
+
+    @override_settings(TRANSCRIPTIONS_USER_CONCURRENCY=1)
+    def test_task_waits_for_slot(self):
+        self.hold_slot(0)
+        xml_string = generate_transcription(siglum='4010')
+        with mock.patch.object(tasks.index_transcription, 'retry', side_effect=Retry()) as retry:
+            result = tasks.index_transcription.apply(args=(xml_string, 'AV'),
+                                                     kwargs={'username': self.user.id, 'siglum': '4010'},
+                                                     task_id='slot-test')
+        self.assertEqual(result.state, 'RETRY')
+        retry.assert_called_once_with(countdown=routing.USER_SLOT_WAIT, max_retries=None)
+        self.assertEqual(progress.get_progress('slot-test')['state'], 'PENDING')
+        self.assertFalse(models.Transcription.objects.exists())
+
+
+class BatchUploadTests(TranscriptionsTestCase):
+
+    SUPERUSER = True
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.user)
+
+    def upload(self, files):
+        # the group runs in this process rather than being sent to the workers
+        conf = tasks.index_transcription.app.conf
+        always_eager = conf.task_always_eager
+        conf.task_always_eager = True
+        try:
+            return self.client.post(reverse('batch'), {'files': files, 'collection': 'AV', 'language_1': 'ae'})
+        finally:
+            conf.task_always_eager = always_eager
+
+    def test_batch(self):
+        files = [SimpleUploadedFile('{}.xml'.format(siglum), generate_transcription(siglum=siglum).encode('utf-8'))
+                 for siglum in ['4010', '4020']]
+        files.append(SimpleUploadedFile('broken.xml', b'<TEI><teiHeader>'))
+        response = self.upload(files)
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual([file['valid'] for file in data['files']], [True, True, False])
+        self.assertEqual([file['siglum'] for file in data['files']], ['4010', '4020', None])
+        self.assertIsNone(data['files'][2]['task_id'])
+        response = self.client.get(reverse('progress'), {'batch': data['batch_id']})
+        batch = response.json()
+        self.assertEqual(batch['state'], 'SUCCESS')
+        self.assertEqual(batch['progress']['files_done'], 2)
+        self.assertEqual(batch['progress']['files_failed'], 1)
+        self.assertEqual(batch['progress']['units_done'], models.CollationUnit.objects.count())
+        self.assertEqual([file['state'] for file in batch['progress']['files']], ['SUCCESS', 'SUCCESS', 'INVALID'])
+        self.assertEqual(sorted(models.Transcription.objects.values_list('siglum', flat=True)), ['4010', '4020'])
+        # the task of each file can be followed on its own, as it is when an upload is superseded by it
+        for file in data['files'][:2]:
+            response = self.client.get(reverse('progress'), {'task': file['task_id']})
+            self.assertEqual(response.json()['state'], 'SUCCESS')
+
+    @override_settings(TRANSCRIPTIONS_BATCH_VALIDATION_WORKERS=2)
+    def test_schema_is_compiled_once_for_each_thread_in_use(self):
+        contents = [generate_transcription(siglum=siglum, stanzas=1).encode('utf-8')
+                    for siglum in ['4010', '4020', '4030', '4040']]
+        with mock.patch.object(validation, 'compile_schema', wraps=validation.compile_schema) as compile_schema:
+            for batch in range(3):
+                response = self.upload([SimpleUploadedFile('{}.xml'.format(i), content)
+                                        for i, content in enumerate(contents)])
+                self.assertTrue(all(file['valid'] for file in response.json()['files']))
+        # the schemas compiled by the threads of earlier requests are used again
+        self.assertLessEqual(compile_schema.call_count, 2)
+
+    def test_chapters_of_a_siglum(self):
+        files = [SimpleUploadedFile('4010-{}.xml'.format(chapter), generate_transcription(
+            siglum='4010', chapters=1, first_chapter=chapter).encode('utf-8')) for chapter in [28, 30]]
+        data = self.upload(files).json()
+        batch = self.client.get(reverse('progress'), {'batch': data['batch_id']}).json()
+        self.assertEqual([file['state'] for file in batch['progress']['files']], ['SUCCESS', 'SUCCESS'])
+        self.assertEqual(batch['progress']['files_superseded'], 0)
+        self.assertEqual(models.Transcription.objects.count(), 2)
+
+    def test_no_files(self):
+        self.assertEqual(self.client.post(reverse('batch'), {'collection': 'AV'}).status_code, 400)
+        self.assertEqual(self.client.get(reverse('progress'), {'batch': 'missing'}).status_code, 404)
+
+
+class WarmStartTests(TestCase):
+
+    def test_warm_up(self):
+        timings = warmup.warm_up()
+        self.assertEqual(list(timings), ['schema', 'pipeline', 'connections'])
+        # nothing is written by the canned transcription
+        self.assertFalse(models.Transcription.objects.exists())
+        self.assertFalse(models.UnitFragment.objects.exists())
+
+    def test_worker_process_init(self):
+        with self.assertLogs('transcriptions.warmup', 'INFO') as logs:
+            warmup.worker_process_init.send(sender=None)
+        self.assertIn('Transcription worker warmed up in', logs.output[0])
+        with override_settings(TRANSCRIPTIONS_WORKER_WARM_START=False), mock.patch.object(warmup, 'warm_up') as warm_up:
+            warmup.worker_process_init.send(sender=None)
+        warm_up.assert_not_called()
+
+    def test_failure_is_logged(self):
+        with mock.patch.object(validation, 'dry_run', return_value={'valid': False, 'errors': [], 'stats': {}}):
+            with self.assertLogs('transcriptions.warmup', 'ERROR') as logs:
+                warmup.warm_worker_process()
+        self.assertIn('could not be warmed up', logs.output[0])
+
+
+class DeleteTranscriptionsTests(TranscriptionsTestCase):
+
+    SUPERUSER = True
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        for siglum in ['4010', '4030', '4020', '4510']:
+            data = tasks.parse_transcription(generate_transcription(siglum=siglum, stanzas=2), 'AV',
+                                             username=cls.user.id)
+            tasks.save_transcription(data, cls.user.id)
+
+    def setUp(self):
+        cache.clear()
+
+    def test_a_filter_is_required(self):
+        with self.assertRaises(ValueError):
+            tasks.get_transcriptions_to_delete()
+
+    def test_siglum_pattern(self):
+        sigla = tasks.get_transcriptions_to_delete(siglum='40*').values_list('siglum', flat=True)
+        self.assertEqual(sorted(sigla), ['4010', '4020', '4030'])
+        sigla = tasks.get_transcriptions_to_delete(siglum='4010').values_list('siglum', flat=True)
+        self.assertEqual(list(sigla), ['4010'])
+
+    @mock.patch('transcriptions.tasks.DELETE_BATCH_SIZE', 5)
+    def test_delete_in_batches(self):
+        remaining = models.CollationUnit.objects.filter(siglum='4510').count()
+        result = tasks.delete_transcriptions.apply(kwargs={'siglum': '40*', 'user': self.user.id},
+                                                   task_id='delete-test').get()
+        self.assertEqual(sorted(result['transcriptions']), ['AV_{}_Y28-Y29_{}'.format(siglum, self.user.id)
+                                                            for siglum in ['4010', '4020', '4030']])
+        self.assertEqual(result['units'], 48)
+        self.assertEqual(list(models.Transcription.objects.values_list('siglum', flat=True)), ['4510'])
+        self.assertEqual(models.CollationUnit.objects.count(), remaining)
+        current = progress.get_progress('delete-test')
+        self.assertEqual(current['state'], 'SUCCESS')
+        # started and one update for each transcription before success
+        self.assertEqual(current['sequence'], 5)
+
+    def test_delete_view_queues(self):
+        self.client.force_login(self.user)
+        transcription = models.Transcription.objects.get(siglum='4010')
+        queues = {routing.INTERACTIVE: 'interactive', routing.BULK: 'bulk'}
+        with override_settings(TRANSCRIPTIONS_QUEUES=queues), \
+                mock.patch.object(tasks.delete_transcriptions, 'apply_async') as apply_async:
+            apply_async.return_value.task_id = 'delete-test'
+            self.client.post(reverse('delete'), {'delete-transcription': '{}|{}'.format(transcription.identifier,
+                                                                                       transcription.id)})
+            self.client.post(reverse('delete'), {'siglum': '40*'})
+        self.assertEqual([call.kwargs['queue'] for call in apply_async.call_args_list], ['interactive', 'bulk'])
+        self.assertEqual(apply_async.call_args_list[0].kwargs['kwargs'], {'ids': [transcription.id]})
+
+    def test_async_command_is_followed_by_its_user(self):
+        with mock.patch.object(tasks.delete_transcriptions, 'apply_async') as apply_async:
+            apply_async.return_value.task_id = 'delete-test'
+            call_command('delete_transcriptions', '--user', 'editor', '--async', stdout=io.StringIO())
+        self.assertTrue(progress.is_owner('delete-test', self.user.id))
+
+    def test_delete_view_rejects_malformed_ids(self):
+        self.client.force_login(self.user)
+        with mock.patch.object(tasks.delete_transcriptions, 'apply_async') as apply_async:
+            for value in ['AV_4010', 'AV_4010|', 'AV_4010|x']:
+                response = self.client.post(reverse('delete'), {'delete-transcription': value})
+                self.assertEqual(response.status_code, 400)
+        apply_async.assert_not_called()
+
+
+class ReindexAllTests(TranscriptionsTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        for siglum in ['4010', '4020']:
+            data = tasks.parse_transcription(generate_transcription(siglum=siglum, stanzas=2), 'AV',
+                                             username=cls.user.id)
+            tasks.save_transcription(data, cls.user.id)
+
+    def test_checkpoint(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'checkpoint.json')
+            call_command('reindex_all', '--force', '--checkpoint', path, stdout=io.StringIO())
+            self.assertEqual(list(models.Transcription.objects.values_list('version', flat=True)), [2, 2])
+            # the transcriptions to skip are found without reading their tei
+            out = io.StringIO()
+            with CaptureQueriesContext(connection) as queries:
+                call_command('reindex_all', '--force', '--checkpoint', path, stdout=out)
+            self.assertIn('There are no transcriptions to reindex.', out.getvalue())
+            self.assertNotIn('"tei"', ' '.join(query['sql'] for query in queries.captured_queries))
+            # a transcription uploaded again since is reindexed
+            data = tasks.parse_transcription(generate_transcription(siglum='4010', stanzas=2, seed=2), 'AV',
+                                             username=self.user.id)
+            tasks.save_transcription(data, self.user.id)
+            out = io.StringIO()
+            call_command('reindex_all', '--force', '--checkpoint', path, stdout=out)
+        self.assertIn('Reindexed 1 transcriptions', out.getvalue())
+        self.assertIn('AV_4010_Y28-Y29_{} reindexed'.format(self.user.id), out.getvalue())
+
+    def test_failure_is_reported_by_identifier(self):
+        err = io.StringIO()
+        with mock.patch.object(tasks, 'parse_transcription', side_effect=ValueError('the tei could not be parsed')):
+            with self.assertRaises(CommandError):
+                call_command('reindex_all', '--force', stdout=io.StringIO(), stderr=err)
+        for siglum in ['4010', '4020']:
+            self.assertIn('AV_{}_Y28-Y29_{}: the tei could not be parsed'.format(siglum, self.user.id), err.getvalue())
+
+
+class ExportTests(TranscriptionsTestCase):
+
+    SUPERUSER = True
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        for siglum in ['4010', '4020']:
+            xml_string = generate_transcription(siglum=siglum, hands=3, app_density=0.5, languages=['ae', 'sa'])
+            data = tasks.parse_transcription(xml_string, 'AV', username=cls.user.id, languages=['ae', 'sa'])
+            tasks.save_transcription(data, cls.user.id)
+
+    def read_lines(self, content):
+        return [json.loads(line) for line in content.decode('utf-8').splitlines()]
+
+    def test_context_range(self):
+        units = export.get_export_units(start='Y.28.2.3', end='Y.29.1', languages=['ae'], sigla=['4020'])
+        contexts = [unit['context'] for unit in self.read_lines(b''.join(export.generate_lines(units)))]
+        self.assertEqual(contexts, ['Y.28.2.3', 'Y.28.2.4', 'Y.28.3.1', 'Y.28.3.2', 'Y.28.3.3', 'Y.28.3.4',
+                                    'Y.29.1.1', 'Y.29.1.2', 'Y.29.1.3', 'Y.29.1.4'])
+        with self.assertRaises(ValueError):
+            export.get_export_units(start='28.1')
+
+    def test_endpoint(self):
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('export'), {'start': 'Y.29', 'siglum': ['4010', '4020']})
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        lines = self.read_lines(response.getvalue())
+        self.assertEqual(len(lines), 48)
+        self.assertNotIn('tei', lines[0])
+        self.assertEqual([(line['siglum'], line['language']) for line in lines[:4]],
+                         [('4010', 'ae'), ('4010', 'sa'), ('4020', 'ae'), ('4020', 'sa')])
+        unit = models.CollationUnit.objects.get(identifier=lines[0]['identifier'])
+        self.assertEqual(lines[0]['witnesses'], unit.witnesses)
+        response = self.client.get(reverse('export'), {'start': 'Y.29', 'siglum': '4010', 'compact': 1})
+        lines = self.read_lines(response.getvalue())
+        self.assertEqual(lines[0]['witnesses'], unit.compact_witnesses)
+
+    def test_stored_text_is_passed_through(self):
+        unit = models.CollationUnit.objects.get(siglum='4010', context='Y.28.1.1', language='ae')
+        # a unit indexed before the compact format has its witnesses stored in the expanded shape
+        fragment = models.UnitFragment.for_witnesses(unit.witnesses)
+        fragment.save()
+        models.CollationUnit.objects.filter(id=unit.id).update(witnesses_fragment=fragment)
+        units = models.CollationUnit.objects.filter(id=unit.id)
+        with mock.patch.object(witness_format, 'expand', wraps=witness_format.expand) as expand:
+            for compact in [False, True]:
+                lines = self.read_lines(b''.join(export.generate_lines(units, compact=compact)))
+                self.assertEqual(lines[0]['witnesses'], unit.witnesses)
+                read = json.loads(b''.join(export.generate_json(units, ['witnesses'], compact=compact)))
+                self.assertEqual(read[0]['witnesses'], unit.witnesses)
+        expand.assert_not_called()
+
+    def test_read_units(self):
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('units'), {'context': 'Y.28.1.1', 'language': 'ae',
+                                                      'fields': 'identifier,siglum,work,witnesses'})
+        self.assertEqual(response['Content-Type'], 'application/json')
+        units = json.loads(response.getvalue())
+        self.assertEqual([(unit['siglum'], list(unit)) for unit in units],
+                         [(siglum, ['identifier', 'siglum', 'work', 'witnesses']) for siglum in ['4010', '4020']])
+        unit = models.CollationUnit.objects.get(identifier=units[0]['identifier'])
+        self.assertEqual(units[0]['work'], unit.work_id)
+        self.assertEqual(units[0]['witnesses'], unit.witnesses)
+        response = self.client.get(reverse('units'), {'identifier': unit.identifier, 'compact': 1})
+        units = json.loads(response.getvalue())
+        self.assertEqual(units[0]['witnesses'], unit.compact_witnesses)
+        self.assertEqual(set(units[0]), set(export.DEFAULT_READ_FIELDS))
+        # the tei is only read when it is asked for
+        response = self.client.get(reverse('units'), {'identifier': unit.identifier, 'fields': 'tei'})
+        self.assertEqual(json.loads(response.getvalue()), [{'tei': unit.tei}])
+        self.assertEqual(self.client.get(reverse('units'), {'fields': 'identifier,secret'}).status_code, 400)
+        # only public units and those of the user are read
+        self.client.force_login(User.objects.create_user(username='reader', password='password'))
+        self.assertEqual(json.loads(self.client.get(reverse('units'), {'context': 'Y.28.1.1'}).getvalue()), [])
+
+    def test_command(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'units.ndjson')
+            call_command('export_units', '--work', 'VS', '--language', 'sa', '--output', path, stderr=io.StringIO())
+            with open(path, 'rb') as export_file:
+                lines = self.read_lines(export_file.read())
+        self.assertEqual(len(lines), 48)
+        self.assertTrue(all(line['language'] == 'sa' for line in lines))
+
+
+class SnapshotTests(TranscriptionsTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        for siglum in ['4010', '4020']:
+            cls.index(generate_transcription(siglum=siglum, chapters=1, hands=3, app_density=0.5))
+
+    @classmethod
+    def index(cls, xml_string):
+        return tasks.save_transcription(tasks.parse_transcription(xml_string, 'AV', username=cls.user.id), cls.user.id)
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def update(self):
+        output = io.StringIO()
+        call_command('snapshot_tokens', self.directory, '--format', 'npy', stdout=output)
+        with open(os.path.join(self.directory, snapshot.MANIFEST_NAME)) as manifest_file:
+            return output.getvalue(), json.load(manifest_file)
+
+    def read_npy(self, path, typecode):
+        with open(path, 'rb') as npy_file:
+            content = npy_file.read()
+        header_length = int.from_bytes(content[8:10], 'little')
+        self.assertEqual((10 + header_length) % 64, 0)
+        values = array(typecode)
+        values.frombytes(content[10 + header_length:])
+        return list(values)
+
+    def read_column(self, part, column):
+        codes = self.read_npy(os.path.join(self.directory, part['path'], '{}.npy'.format(column)), 'i')
+        with open(os.path.join(self.directory, part['path'], '{}.json'.format(column)), encoding='utf-8') as values:
+            values = json.load(values)
+        return [values[code] if code >= 0 else None for code in codes]
+
+    def test_snapshot(self):
+        output, manifest = self.update()
+        self.assertIn('Wrote 2 transcriptions, kept 0 and removed 0', output)
+        self.assertEqual(manifest['format'], 'npy')
+        identifier = models.Transcription.objects.get(siglum='4010').identifier
+        part = manifest['transcriptions'][identifier]
+        units = models.CollationUnit.objects.filter(transcription__identifier=identifier)
+        tokens = [(unit.context, reading['hand'], token['t']) for unit in units.order_by('index')
+                  for reading in unit.witnesses for token in reading['tokens']]
+        self.assertEqual(part['rows'], len(tokens))
+        self.assertEqual(list(zip(self.read_column(part, 'context'), self.read_column(part, 'hand'),
+                                  self.read_column(part, 't'))), tokens)
+        positions = self.read_npy(os.path.join(self.directory, part['path'], 'position.npy'), 'i')
+        self.assertEqual(positions[:3], [2, 4, 6])
+
+        # only the reindexed transcription is written again and deleted transcriptions are removed
+        self.index(generate_transcription(siglum='4010', chapters=1, hands=3, app_density=0.5, seed=1))
+        tasks.delete_transcriptions.apply(kwargs={'siglum': '4020'})
+        output, manifest = self.update()
+        self.assertIn('Wrote 1 transcriptions, kept 0 and removed 1', output)
+        self.assertEqual(list(manifest['transcriptions']), [identifier])
+        self.assertNotEqual(manifest['transcriptions'][identifier]['path'], part['path'])
+        self.assertEqual(sorted(os.listdir(self.directory)),
+                         sorted([snapshot.MANIFEST_NAME, manifest['transcriptions'][identifier]['path']]))
+        output, manifest = self.update()
+        self.assertIn('Wrote 0 transcriptions, kept 1 and removed 0', output)
+
+    @mock.patch.object(snapshot, 'pyarrow', None)
+    def test_parquet_needs_pyarrow(self):
+        with self.assertRaises(CommandError):
+            call_command('snapshot_tokens', self.directory, '--format', 'parquet', stdout=io.StringIO())
+
+
+class ContextWitnessTests(TranscriptionsTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.other_user = User.objects.create_user(username='other', password='password')
+        for siglum, user in [('4020', cls.user), ('4010', cls.user), ('4030', cls.other_user)]:
+            data = tasks.parse_transcription(generate_transcription(siglum=siglum, hands=3, app_density=0.5),
+                                             'AV', username=user.id)
+            tasks.save_transcription(data, user.id)
+
+    def get_witnesses(self, **params):
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('contextwitnesses'), params)
+        self.assertEqual(response.status_code, 200)
+        return response.json()['witnesses']
+
+    def test_lookup(self):
+        witnesses = self.get_witnesses(context='Y.28.1.1')
+        # the private transcription of the other user is not included
+        self.assertEqual([witness['siglum'] for witness in witnesses], ['4010', '4020'])
+        unit = models.CollationUnit.objects.get(identifier=witnesses[0]['unit_identifier'])
+        self.assertEqual(witnesses[0]['witnesses'], unit.witnesses)
+        self.assertEqual(self.get_witnesses(context='Y.28.1.1', language='sa'), [])
+
+    def test_kept_in_step_with_units(self):
+        data = tasks.parse_transcription(generate_transcription(siglum='4010', seed=1), 'AV', username=self.user.id)
+        tasks.save_transcription(data, self.user.id)
+        transcription = models.Transcription.objects.get(siglum='4010')
+        self.assertEqual(transcription.context_witnesses.count(), 24)
+        self.assertEqual(transcription.context_witnesses.get(context='Y.28.1.1').witnesses,
+                         transcription.units.get(context='Y.28.1.1').witnesses)
+        self.assertEqual(set(transcription.context_witnesses.values_list('unit_identifier', flat=True)),
+                         set(transcription.units.values_list('identifier', flat=True)))
+        tasks.delete_transcriptions(ids=[transcription.id])
+        self.assertEqual([witness['siglum'] for witness in self.get_witnesses(context='Y.28.1.1')], ['4020'])
+
+
+class UnitFragmentTests(TranscriptionsTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.xml_string = generate_transcription(siglum='4010', stanzas=2)
+
+    def index(self, xml_string):
+        data = tasks.parse_transcription(xml_string, 'AV', username=self.user.id)
+        return tasks.save_transcription(data, self.user.id)
+
+    def test_serializer_reads_nothing_more(self):
+        # the api reads the units with their related keys and serializes them, which must not query
+        # the fragments of each unit separately
+        self.index(self.xml_string)
+        units = models.CollationUnit.objects.select_related(*models.CollationUnit.RELATED_KEYS)
+        with self.assertNumQueries(1):
+            data = serializers.CollationUnitSerializer(units, many=True).data
+        self.assertEqual(len(data), models.CollationUnit.objects.count())
+        unit = models.CollationUnit.objects.get(identifier=data[0]['identifier'])
+        self.assertEqual(data[0]['tei'], unit.tei)
+        self.assertEqual(data[0]['witnesses'], witness_format.expand(unit.compact_witnesses))
+
+    def test_values_of_moved_columns(self):
+        self.index(self.xml_string)
+        unit = models.CollationUnit.objects.get(context='Y.28.1.1')
+        values = models.CollationUnit.objects.filter(id=unit.id).values('context', 'tei', 'witnesses').get()
+        self.assertEqual(fields.decompress(values['tei']), unit.tei)
+        self.assertEqual(values['witnesses'], unit.compact_witnesses)
+        tei = models.CollationUnit.objects.filter(id=unit.id).values_list('tei', flat=True).get()
+        self.assertEqual(fields.decompress(tei), unit.tei)
+
+    def test_reupload_reuses_fragments(self):
+        self.index(self.xml_string)
+        fragments = models.UnitFragment.objects.count()
+        unit = models.CollationUnit.objects.get(context='Y.28.1.1')
+        self.assertIn('<ab', unit.tei)
+        self.assertIsInstance(unit.witnesses, list)
+        self.index(self.xml_string)
+        self.assertEqual(models.UnitFragment.objects.count(), fragments)
+        self.assertEqual(tasks.collect_fragments(), {'fragments': 0})
+
+    def test_fragments_are_shared(self):
+        self.index(self.xml_string)
+        fragments = models.UnitFragment.objects.count()
+        # the same transcription uploaded by another user has the same unit tei and witnesses
+        other_user = User.objects.create_user(username='other', password='password')
+        data = tasks.parse_transcription(self.xml_string, 'AV', username=other_user.id)
+        tasks.save_transcription(data, other_user.id)
+        self.assertEqual(models.CollationUnit.objects.filter(user=other_user).count(),
+                         models.CollationUnit.objects.filter(user=self.user).count())
+        self.assertEqual(models.UnitFragment.objects.count(), fragments)
+
+    def test_collect_after_delete(self):
+        self.index(self.xml_string)
+        self.index(generate_transcription(siglum='4020', stanzas=2))
+        transcription = models.Transcription.objects.get(siglum='4010')
+        tasks.delete_transcriptions(ids=[transcription.id])
+        self.assertGreater(tasks.collect_fragments()['fragments'], 0)
+        referenced = set(models.CollationUnit.objects.values_list('tei_fragment', flat=True))
+        referenced.update(models.CollationUnit.objects.values_list('witnesses_fragment', flat=True))
+        self.assertEqual(set(models.UnitFragment.objects.values_list('digest', flat=True)), referenced)
+        out = io.StringIO()
+        call_command('collect_fragments', stdout=out)
+        self.assertIn('Deleted 0 unit fragments', out.getvalue())
+
+
+class TokenIndexTests(TranscriptionsTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.other_user = User.objects.create_user(username='other', password='password')
+        for siglum, user in [('4010', cls.user), ('4020', cls.user), ('4030', cls.other_user)]:
+            data = tasks.parse_transcription(generate_transcription(siglum=siglum, hands=3, app_density=0.5),
+                                             'AV', username=user.id)
+            tasks.save_transcription(data, user.id)
+
+    def search(self, **params):
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('search'), params)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def get_token(self, siglum, **token_filter):
+        unit = models.CollationUnit.objects.filter(siglum=siglum).first()
+        reading = unit.witnesses[0]
+        token = [token for token in reading['tokens'] if all(token.get(key) == value
+                                                            for key, value in token_filter.items())][0]
+        return unit, reading, token
+
+    def test_token_search(self):
+        unit, reading, token = self.get_token('4010')
+        results = self.search(term=token['t'].upper())['results']
+        self.assertIn({'context': unit.context, 'siglum': '4010', 'hand': reading['hand'], 'reading': reading['id'],
+                       'position': int(token['index']), 'unit_identifier': unit.identifier}, results)
+        # the private transcription of the other user is not included
+        self.assertNotIn('4030', [result['siglum'] for result in results])
+        hand_results = self.search(term=token['t'], hand='firsthand', siglum='4010')['results']
+        self.assertEqual(set(result['hand'] for result in hand_results), {'firsthand'})
+        self.assertEqual(set(result['siglum'] for result in hand_results), {'4010'})
+
+    def test_lemma_search(self):
+        token = models.TokenIndex.objects.filter(kind='lemma', siglum='4020').first()
+        results = self.search(term=token.term, kind='lemma')['results']
+        self.assertIn(token.unit_identifier, [result['unit_identifier'] for result in results])
+        self.assertEqual(self.search(term=token.term, kind='lemma', work='VytS')['results'], [])
+        self.client.force_login(self.user)
+        self.assertEqual(self.client.get(reverse('search'), {'term': token.term, 'kind': 'x'}).status_code, 400)
+        self.assertEqual(self.client.get(reverse('search')).status_code, 400)
+
+    def test_rule_match_forms_are_normalised(self):
+        unit = [unit for unit in models.CollationUnit.objects.filter(siglum='4010')
+                if any(set(variant) & set('[]{}()') for reading in unit.witnesses for token in reading['tokens']
+                       for variant in token.get('rule_match') or [])][0]
+        variant = [variant for reading in unit.witnesses for token in reading['tokens']
+                   for variant in token.get('rule_match') or [] if set(variant) & set('[]{}()')][0]
+        results = self.search(term=variant)['results']
+        self.assertIn(unit.identifier, [result['unit_identifier'] for result in results])
+        terms = models.TokenIndex.objects.values_list('term', flat=True)
+        self.assertTrue(all(term == witness_format.normalise(term) for term in terms))
+
+    @override_settings(TRANSCRIPTIONS_SEARCH_LIMIT=2)
+    def test_limit(self):
+        term = models.TokenIndex.objects.filter(siglum='4010').first().term
+        data = self.search(term=term)
+        self.assertEqual(len(data['results']), 2)
+        self.assertTrue(data['truncated'])
+
+    def test_kept_in_step_with_units(self):
+        transcription = models.Transcription.objects.get(siglum='4010')
+        count = transcription.token_index.count()
+        self.assertGreater(count, transcription.units.count())
+        data = tasks.parse_transcription(generate_transcription(siglum='4010', hands=3, app_density=0.5), 'AV',
+                                         username=self.user.id)
+        tasks.save_transcription(data, self.user.id)
+        self.assertEqual(transcription.token_index.count(), count)
+        tasks.delete_transcriptions(ids=[transcription.id])
+        self.assertFalse(models.TokenIndex.objects.filter(siglum='4010').exists())
+
+
+class QueryPlanTests(TranscriptionsTestCase):
+    """Check that the collation unit access patterns are served by the composite indexes."""
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        xml_string = generate_transcription(siglum='4010', chapters=2, stanzas=10, lines=5)
+        cls.summary = tasks.index_transcription.apply(args=(xml_string, 'AV'), kwargs={'username': cls.user.id}).get()
+
+    def setUp(self):
+        if connection.vendor != 'postgresql':
+            self.skipTest('query plans are only checked on PostgreSQL')
+        # with the small test tables a sequential scan is always cheapest so it is disabled for the
+        # duration of the test transaction to show which index the planner would choose
+        with connection.cursor() as cursor:
+            cursor.execute('SET LOCAL enable_seqscan = off')
+
+    def assertUsesIndex(self, queryset, *index_names):
+        plan = queryset.explain()
+        self.assertTrue(any(index_name in plan for index_name in index_names), plan)
+
+    def test_siglum_listing(self):
+        units = models.CollationUnit.objects.filter(siglum='4010', user=self.user).order_by(
+            'language', 'chapter_number', 'stanza_number', 'line_number')
+        self.assertUsesIndex(units, 'collationunit_siglum_user_idx')
+
+    def test_transcription_listing(self):
+        transcriptions = models.Transcription.objects.filter(user=self.user).only('id', 'identifier', 'siglum')
+        self.assertUsesIndex(transcriptions, 'transcription_user_sort_idx')
+
+    def test_transcription_lookup(self):
+        units = models.CollationUnit.objects.for_transcription(self.summary['identifier'])
+        self.assertUsesIndex(units, 'collationunit_trans_ident_idx')
+
+    def test_context_lookup(self):
+        work = models.Work.objects.get(abbreviation='VS')
+        units = models.CollationUnit.objects.unordered().filter(work=work, context='Y.28.1.1')
+        # either index serves the lookup equally well with so few rows
+        self.assertUsesIndex(units, 'collationunit_work_context_idx', 'collationunit_context_idx')
+
+    def test_context_witness_lookup(self):
+        witnesses = models.ContextWitness.objects.for_context('Y.28.1.1', 'ae').available_to(self.user)
+        self.assertUsesIndex(witnesses, 'contextwitness_context_idx')
+
+    def test_token_search(self):
+        tokens = models.TokenIndex.objects.search('ahiiā').available_to(self.user)
+        self.assertUsesIndex(tokens, 'tokenindex_term_idx')
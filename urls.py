@@ -3,6 +3,12 @@ from . import views
 
 urlpatterns = [
     re_path(r'^$', views.home, name='home'),
+    re_path(r'^progress/?$', views.task_progress, name='progress'),
+    re_path(r'^export/?$', views.export_units, name='export'),
+    re_path(r'^units/?$', views.read_units, name='units'),
+    re_path(r'^witnesses/?$', views.context_witnesses, name='contextwitnesses'),
+    re_path(r'^search/?$', views.search_tokens, name='search'),
+    re_path(r'^batch/?$', views.index_batch, name='batch'),
     re_path(r'manage/?', views.manage, name='manage'),
     re_path(r'validate/?', views.validate, name="validate"),
     re_path(r'delete/?', views.delete, name="delete"),
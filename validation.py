@@ -0,0 +1,163 @@
+import os
+import json
+import queue
+from contextlib import contextmanager
+from lxml import etree
+from django.conf import settings
+from transcriptions import fields, witness_format
+from transcriptions.yasna_parser import YasnaParser
+
+# the compiled schemas not in use by any thread
+_schemas = queue.SimpleQueue()
+
+
+def compile_schema():
+    schema_directory = os.path.join(settings.BASE_DIR, 'transcriptions', 'schema')
+    return etree.XMLSchema(etree.parse(os.path.join(schema_directory, 'TEI-MUYA.xsd')))
+
+
+@contextmanager
+def get_schema():
+    """Lend a compiled schema for the duration of the block.
+
+    Compiling the schema is expensive so the compiled schemas are kept for the life of the process and
+    one is only compiled when all of the others are in use, however many threads come and go. A schema
+    is never used by two threads at once because the errors of the last validation are kept on it.
+    """
+    try:
+        schema = _schemas.get_nowait()
+    except queue.Empty:
+        schema = compile_schema()
+    try:
+        yield schema
+    finally:
+        _schemas.put(schema)
+
+
+def process_validation_errors(log):
+    errors = []
+    for i in range(0, len(log)):
+        error = str(log[i])
+        error = error.replace('<string>:', 'Error in line ')
+        error = error.replace('{http://www.tei-c.org/ns/1.0}', '')
+        error = error.replace('0:ERROR:SCHEMASV:SCHEMAV_ELEMENT_CONTENT:', '')
+        errors.append(error)
+    return errors
+
+
+def get_siglum(tree):
+    return tree.xpath('//tei:title[@type="document"]/@n', namespaces={'tei': 'http://www.tei-c.org/ns/1.0'})[0]
+
+
+def validate_xml(tree, filename, skip_schema=False):
+
+    results = {}
+    if not skip_schema:
+        # first check with the schema unless instructed to skip
+        with get_schema() as schema:
+            result = schema.validate(tree)
+            log = schema.error_log
+
+        if result is False:
+            results['valid'] = False
+            results['errors'] = process_validation_errors(log)
+            results['filename'] = filename
+        else:
+            results['valid'] = True
+            results['errors'] = []
+            results['filename'] = filename
+    else:
+        results['valid'] = True
+        results['errors'] = ['The file has not been validated against the schema.']
+        results['filename'] = filename
+
+    # check that all hands are included in the header
+    declared_hands = tree.xpath('//tei:listWit/tei:witness/@xml:id',
+                                namespaces={'tei': 'http://www.tei-c.org/ns/1.0',
+                                            'xml': 'http://www.w3.org/XML/1998/namespace'})
+    declared_hands = set(declared_hands)
+    hands = tree.xpath('//tei:rdg/@hand', namespaces={'tei': 'http://www.tei-c.org/ns/1.0'})
+
+    unique_hands = set(hands)
+    missing_hands = unique_hands - declared_hands
+    if len(missing_hands) > 0:
+        results['valid'] = False
+        results['errors'].insert(0, 'There are hands in this transcription which have not been declared in the '
+                                 'header. The missing hands are: %s.' % ', '.join(missing_hands))
+
+    # is there a sigla and is it acceptable
+    titles = tree.xpath('//tei:title[@type="document"]/@n', namespaces={'tei': 'http://www.tei-c.org/ns/1.0'})
+    try:
+        siglum = titles[0]
+    except IndexError:
+        results['valid'] = False
+        results['errors'].insert(0, 'No siglum provided in the transcription. '
+                                 'The siglum should be at //tei:title[@type="document"]/@n')
+    else:
+        # TODO: this is perhaps better as a regex but it needs to work in partnership with the filtering of Supplements
+        # in the output so I am restricting here until I know how that will work.
+        if len(siglum) > 1 and siglum.rfind('S') == len(siglum) - 1:
+            vsiglum = siglum[:-1]
+        elif len(siglum) > 1 and siglum.rfind('S1') == len(siglum) - 2:
+            vsiglum = siglum[:-2]
+        elif len(siglum) > 1 and siglum.rfind('S2') == len(siglum) - 2:
+            vsiglum = siglum[:-2]
+        else:
+            vsiglum = siglum
+        if vsiglum != 'basetext' and not vsiglum.isdigit():
+            results['valid'] = False
+            results['errors'].insert(0, 'The siglum provided in the transcription (%s) does not comply with the '
+                                     'project conventions. It should be "basetext" or a numerical identifier '
+                                     '(possibly followed by S, S1 or S2).' % siglum)
+
+    # embedded app tags (it happens and is valid TEI but makes no sense in the context of these transcriptions)
+    if len(tree.xpath('//tei:app//tei:app', namespaces={'tei': 'http://www.tei-c.org/ns/1.0'})) > 0:
+        results['valid'] = False
+        results['errors'].insert(0, 'The transcription contains an app tag embedded in another app tag.'
+                                 'This cannot be indexed for collation and should be fixed.')
+    return results
+
+
+def format_error(error):
+    location = []
+    if error['line'] is not None:
+        location.append('line {}'.format(error['line']))
+    if error['context'] is not None:
+        location.append(error['context'])
+    if len(location) == 0:
+        return error['message']
+    return '{} ({})'.format(error['message'], ', '.join(location))
+
+
+def dry_run(xml_string, filename=None, collection='AV', languages=['ae']):
+    """Run the indexing pipeline on a transcription in memory and report what it would write.
+
+    Every structural error found by the parsers is collected with its line and context rather than
+    stopping at the first. The statistics are the number of units of each language, the number of
+    tokens, the number of readings of each hand, the number of token index rows and an estimate of
+    the bytes which would be stored. Nothing is read from or written to the database.
+    """
+    parser = YasnaParser(xml_string, collection=collection, filename=filename, languages=languages,
+                         collect_errors=True)
+    data = parser.get_data_online()
+    errors = list(parser.errors)
+    if data['transcription']['work'] is None:
+        errors.insert(0, {'message': 'The work specified in the transcription could not be identified.',
+                          'line': None, 'context': None})
+
+    stats = {'units': {}, 'tokens': 0, 'hands': {}, 'token_index_rows': 0,
+             'estimated_bytes': len(fields.compress(parser.file_string))}
+    for language, units in data['collation_units'].items():
+        stats['units'][language] = len(units)
+        for unit in units:
+            stats['estimated_bytes'] += len(fields.compress(unit['tei']))
+            if unit.get('witnesses') is None:
+                continue
+            compacted = witness_format.compact(unit['witnesses'])
+            stats['estimated_bytes'] += len(json.dumps(compacted, ensure_ascii=False).encode('utf-8'))
+            for reading in unit['witnesses']:
+                stats['tokens'] += len(reading['tokens'])
+                hand = reading.get('hand')
+                stats['hands'][hand] = stats['hands'].get(hand, 0) + 1
+            stats['token_index_rows'] += sum(1 for term in witness_format.get_token_terms(unit['witnesses']))
+    return {'valid': len(errors) == 0, 'errors': errors, 'stats': stats}
@@ -1,23 +1,31 @@
 import re
 import os
+import uuid
 import base64
 import json
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
 from lxml import etree
 from celery.result import AsyncResult
 from django.shortcuts import render, get_object_or_404
 from django.views.decorators.csrf import ensure_csrf_cookie
-from django.views.decorators.http import require_http_methods
+from django.views.decorators.http import require_http_methods, condition
 from django.contrib.auth.decorators import login_required, permission_required
 from django.conf import settings
-from django.http import HttpResponse, JsonResponse, HttpResponseRedirect
+from django.http import HttpResponse, JsonResponse, HttpResponseRedirect, StreamingHttpResponse
+from django.template.loader import get_template
 from django.urls import reverse
+from django.core.paginator import Paginator
 from django.forms import modelformset_factory as formset_factory
-from django.db.models import Q
+from django.db.models import F, Q, Count, Sum, Max
+from django.core.cache import cache
 from rest_framework.request import Request
 
 import api.views
-from transcriptions import models, tasks
-
+from transcriptions import models, tasks, progress, routing, witness_format
+from transcriptions.streaming import stream_template
+from transcriptions.export import get_export_units, generate_lines, get_read_fields, generate_json
+from transcriptions.validation import validate_xml, get_siglum, dry_run, format_error
 
 def get_login_status(request):
     if request.user.is_authenticated:
@@ -26,39 +34,13 @@ def get_login_status(request):
         return None
 
 
-def process_validation_errors(log):
-    errors = []
-    for i in range(0, len(log)):
-        error = str(log[i])
-        error = error.replace('<string>:', 'Error in line ')
-        error = error.replace('{http://www.tei-c.org/ns/1.0}', '')
-        error = error.replace('0:ERROR:SCHEMASV:SCHEMAV_ELEMENT_CONTENT:', '')
-        errors.append(error)
-    return errors
-
-
-def sort_by_sigla(item):
-    if item.siglum == 'basetext':
-        return -1
-    try:
-        return float(item.siglum)
-    except ValueError:
-        match = re.match(r'^(\d+)S(\d?)$', item.siglum)
-        if match is not None:
-            siglum = float(match.group(1)) + 0.1
-            if match.group(2) != '':
-                siglum += float(match.group(2))/100
-            return siglum
-    return item.siglum
-
-
 def home(request):
 
     post_login_url = request.path + '?' + request.GET.urlencode()
     login_details = get_login_status(request)
 
     if login_details is not None:
-        return HttpResponseRedirect('/transcriptions/manage')
+        return HttpResponseRedirect(reverse('manage'))
 
     data = {
             'login_status': login_details,
@@ -94,92 +76,158 @@ def manage(request):
     post_login_url = request.path + '?' + request.GET.urlencode()
     login_details = get_login_status(request)
 
-    transcriptions = models.Transcription.objects.filter(user__id=request.user.id)
-    # sort them for the list display
-    transcription_list = []
-    for transcription in transcriptions:
-        transcription_list.append(transcription)
-    transcription_list.sort(key=sort_by_sigla)
+    # the default ordering uses the stored siglum sort key so the sorting and paging is done in the database
+    transcriptions = models.Transcription.objects.filter(user__id=request.user.id).only('id', 'identifier', 'siglum')
+    paginator = Paginator(transcriptions, getattr(settings, 'TRANSCRIPTIONS_MANAGE_PAGE_SIZE', 100))
+    page = paginator.get_page(request.GET.get('page'))
 
     data = {'login_status': login_details,
             'post_login_url': post_login_url,
             'post_logout_url': '/transcriptions',
             'page_title': 'Transcription Uploader',
-            'transcriptions': transcription_list
+            'transcriptions': page.object_list,
+            'page': page
             }
     return render(request, 'transcriptions/manage.html', data)
 
 
-# validation function
-def validate_xml(tree, filename, skip_schema=False):
+@login_required
+@require_http_methods(["GET"])
+def context_witnesses(request):
+    # every public or own unit of a single context from the context index in one lookup
+    context = request.GET.get('context', None)
+    if context is None:
+        return HttpResponse('a context must be supplied', status=400)
+    language = request.GET.get('language', 'ae')
+    witnesses = list(models.ContextWitness.objects.for_context(context, language).available_to(request.user)
+                     .values('siglum', 'duplicate_position', 'unit_identifier',
+                             witnesses=F('witnesses_fragment__witnesses')))
+    if request.GET.get('compact', None) is None:
+        for witness in witnesses:
+            witness['witnesses'] = witness_format.expand(witness['witnesses'])
+    data = {'context': context,
+            'language': language,
+            'witnesses': witnesses
+            }
+    return JsonResponse(data)
 
-    results = {}
-    if not skip_schema:
-        # first check with the schema unless instructed to skip
-        schema_directory = os.path.join(settings.BASE_DIR, 'transcriptions', 'schema')
-        schema = etree.XMLSchema(etree.parse(os.path.join(schema_directory, 'TEI-MUYA.xsd')))
 
-        result = schema.validate(tree)
-        log = schema.error_log
+@login_required
+@require_http_methods(["GET"])
+def search_tokens(request):
+    # occurrences of a word form or lemma in the public and own collation units from the token index
+    term = request.GET.get('term', None)
+    if term is None:
+        return HttpResponse('a term must be supplied', status=400)
+    kind = request.GET.get('kind', 'token')
+    if kind not in models.TokenIndex.KINDS:
+        return HttpResponse('kind must be one of {}'.format(', '.join(models.TokenIndex.KINDS)), status=400)
+    limit = getattr(settings, 'TRANSCRIPTIONS_SEARCH_LIMIT', 1000)
+    tokens = list(models.TokenIndex.objects.search(term, kind=kind,
+                                                   work=request.GET.get('work', None),
+                                                   sigla=request.GET.getlist('siglum'),
+                                                   hand=request.GET.get('hand', None),
+                                                   language=request.GET.get('language', None))
+                  .available_to(request.user)
+                  .values('context', 'siglum', 'hand', 'reading', 'position', 'unit_identifier')[:limit + 1])
+    data = {'term': term,
+            'kind': kind,
+            'truncated': len(tokens) > limit,
+            'results': tokens[:limit]
+            }
+    return JsonResponse(data)
 
-        if result is False:
-            results['valid'] = False
-            results['errors'] = process_validation_errors(log)
-            results['filename'] = filename
-        else:
-            results['valid'] = True
-            results['errors'] = []
-            results['filename'] = filename
-    else:
-        results['valid'] = True
-        results['errors'] = ['The file has not been validated against the schema.']
-        results['filename'] = filename
-
-    # check that all hands are included in the header
-    declared_hands = tree.xpath('//tei:listWit/tei:witness/@xml:id',
-                                namespaces={'tei': 'http://www.tei-c.org/ns/1.0',
-                                            'xml': 'http://www.w3.org/XML/1998/namespace'})
-    declared_hands = set(declared_hands)
-    hands = tree.xpath('//tei:rdg/@hand', namespaces={'tei': 'http://www.tei-c.org/ns/1.0'})
-
-    unique_hands = set(hands)
-    missing_hands = unique_hands - declared_hands
-    if len(missing_hands) > 0:
-        results['valid'] = False
-        results['errors'].insert(0, 'There are hands in this transcription which have not been declared in the '
-                                 'header. The missing hands are: %s.' % ', '.join(missing_hands))
-
-    # is there a sigla and is it acceptable
-    titles = tree.xpath('//tei:title[@type="document"]/@n', namespaces={'tei': 'http://www.tei-c.org/ns/1.0'})
+
+@login_required
+@require_http_methods(["GET"])
+def read_units(request):
+    # a light read path for bulk fetches: only the fields asked for are read and the stored witnesses are
+    # passed through as JSON text when the compact format is requested
     try:
-        siglum = titles[0]
-    except IndexError:
-        results['valid'] = False
-        results['errors'].insert(0, 'No siglum provided in the transcription. '
-                                 'The siglum should be at //tei:title[@type="document"]/@n')
-    else:
-        # TODO: this is perhaps better as a regex but it needs to work in partnership with the filtering of Supplements
-        # in the output so I am restricting here until I know how that will work.
-        if len(siglum) > 1 and siglum.rfind('S') == len(siglum) - 1:
-            vsiglum = siglum[:-1]
-        elif len(siglum) > 1 and siglum.rfind('S1') == len(siglum) - 2:
-            vsiglum = siglum[:-2]
-        elif len(siglum) > 1 and siglum.rfind('S2') == len(siglum) - 2:
-            vsiglum = siglum[:-2]
-        else:
-            vsiglum = siglum
-        if vsiglum != 'basetext' and not vsiglum.isdigit():
-            results['valid'] = False
-            results['errors'].insert(0, 'The siglum provided in the transcription (%s) does not comply with the '
-                                     'project conventions. It should be "basetext" or a numerical identifier '
-                                     '(possibly followed by S, S1 or S2).' % siglum)
-
-    # embedded app tags (it happens and is valid TEI but makes no sense in the context of these transcriptions)
-    if len(tree.xpath('//tei:app//tei:app', namespaces={'tei': 'http://www.tei-c.org/ns/1.0'})) > 0:
-        results['valid'] = False
-        results['errors'].insert(0, 'The transcription contains an app tag embedded in another app tag.'
-                                 'This cannot be indexed for collation and should be fixed.')
-    return results
+        read_fields = get_read_fields(request.GET.get('fields', None))
+        units = get_export_units(work=request.GET.get('work', None),
+                                 start=request.GET.get('start', None),
+                                 end=request.GET.get('end', None),
+                                 languages=request.GET.getlist('language'),
+                                 sigla=request.GET.getlist('siglum'))
+    except ValueError as e:
+        return HttpResponse(str(e), status=400)
+    if request.GET.get('context', None):
+        units = units.filter(context=request.GET.get('context'))
+    if request.GET.getlist('identifier'):
+        units = units.filter(identifier__in=request.GET.getlist('identifier'))
+    units = units.filter(Q(public=True) | Q(user=request.user))
+    compact = request.GET.get('compact', None) is not None
+    return StreamingHttpResponse(generate_json(units, read_fields, compact=compact), content_type='application/json')
+
+
+@login_required
+@require_http_methods(["GET"])
+def export_units(request):
+    try:
+        units = get_export_units(work=request.GET.get('work', None),
+                                 start=request.GET.get('start', None),
+                                 end=request.GET.get('end', None),
+                                 languages=request.GET.getlist('language'),
+                                 sigla=request.GET.getlist('siglum'))
+    except ValueError as e:
+        return HttpResponse(str(e), status=400)
+    units = units.filter(Q(public=True) | Q(user=request.user))
+    compact = request.GET.get('compact', None) is not None
+    return StreamingHttpResponse(generate_lines(units, compact=compact), content_type='application/x-ndjson')
+
+
+@login_required
+@require_http_methods(["GET"])
+def task_progress(request):
+    # the current progress is returned at once with a Retry-After header telling the client when to ask again
+    # while the task is unfinished, so no web server worker is held waiting for a change; progress is read from
+    # the cache so the result backend is not queried each time
+    task_id = request.GET.get('task', None)
+    batch_id = request.GET.get('batch', None)
+    if task_id is None and batch_id is None:
+        return HttpResponse('a task id or batch id must be supplied', status=400)
+    try:
+        sequence = int(request.GET.get('sequence', 0))
+    except ValueError:
+        sequence = 0
+    # only the user who started the task or batch can follow it, any other id is treated as unknown
+    if not progress.is_owner(batch_id or task_id, request.user.id):
+        return HttpResponse('the task was not found', status=404)
+    if batch_id is not None:
+        current = progress.get_batch_progress(batch_id)
+        if current is None:
+            return HttpResponse('the batch was not found', status=404)
+        data = {'batch_id': batch_id,
+                'state': current['state'],
+                'sequence': current['sequence'],
+                'progress': current['meta']
+                }
+        return set_retry_after(JsonResponse(data), current['state'] != 'SUCCESS')
+    current = progress.get_progress(task_id)
+    if current is None:
+        # nothing has been published for this task (or it has expired from the cache) so ask celery
+        task = AsyncResult(task_id)
+        current = {'state': task.state, 'sequence': sequence, 'meta': {}}
+        if task.state == 'SUCCESS':
+            current['meta'] = task.result
+        elif task.state == 'FAILURE':
+            current['meta'] = {'message': str(task.result)}
+    data = {'task_id': task_id,
+            'siglum': request.GET.get('siglum'),
+            'state': current['state'],
+            'sequence': current['sequence'],
+            'progress': current['meta']
+            }
+    if current['state'] in ('SUCCESS', 'FAILURE'):
+        data['result'] = current['meta']
+    return set_retry_after(JsonResponse(data), current['state'] not in ('SUCCESS', 'FAILURE'))
+
+
+def set_retry_after(response, unfinished):
+    if unfinished:
+        response['Retry-After'] = str(getattr(settings, 'TRANSCRIPTIONS_PROGRESS_RETRY_AFTER', 1))
+    return response
 
 
 @require_http_methods(["POST"])
@@ -204,6 +252,20 @@ def validate(request):
     # now validate against our schema
     results = validate_xml(tree, filename, skip_schema)
 
+    if request.POST.get('dry_run', False) and results['valid'] is True:
+        # run the parsers as well to report all of the structural errors and what would be indexed
+        languages = [value for key, value in request.POST.items() if key.find('language') == 0 and value != '']
+        if isinstance(real_content, bytes):
+            real_content = real_content.decode('utf-8')
+        # the parsers do not accept a string with an encoding declaration
+        xml_string = re.sub(r'<\?xml.+?\?>', '', real_content)
+        report = dry_run(xml_string, filename, collection=request.POST.get('collection', 'AV'),
+                         languages=languages or ['ae'])
+        results['valid'] = report['valid']
+        results['errors'].extend(format_error(error) for error in report['errors'])
+        results['structure_errors'] = report['errors']
+        results['stats'] = report['stats']
+
     return JsonResponse(results)
 
 
@@ -249,7 +311,7 @@ def index(request):
     # else we have a valid XML file so we can continue to indexing
     collection = request.POST.get('collection', 'unknown')
     username = request.user.id
-    siglum = tree.xpath('//tei:title[@type="document"]/@n', namespaces={'tei': 'http://www.tei-c.org/ns/1.0'})[0]
+    siglum = get_siglum(tree)
     if siglum == 'basetext':
         public_flag = True
     else:
@@ -259,14 +321,70 @@ def index(request):
     # (to do that it needs to be turned from bytes to string)
     xml_string = re.sub(r'<\?xml.+?\?>', '', xml_string.decode('utf-8'))
     # now we are allowed to start the indexing
-    task = tasks.index_transcription.delay(xml_string,
-                                           collection,
-                                           siglum=siglum,
-                                           username=username,
-                                           public_flag=public_flag,
-                                           languages=languages)
+    # a repeated upload of the same file is given the task already indexing it
+    task_id = tasks.start_index_transcription(xml_string,
+                                              collection,
+                                              siglum=siglum,
+                                              username=username,
+                                              public_flag=public_flag,
+                                              languages=languages)
 
-    return HttpResponseRedirect('/transcriptions/manage?task=' + task.task_id + '&siglum=' + siglum)
+    return HttpResponseRedirect('/transcriptions/manage?task=' + task_id + '&siglum=' + siglum)
+
+
+def check_upload(content, filename, skip_schema=False):
+    """Validate an uploaded file and return the result for the file and the xml string to index if it is valid."""
+    results = {'file_name': filename, 'siglum': None, 'valid': False, 'errors': []}
+    try:
+        tree = etree.fromstring(content)
+    except etree.XMLSyntaxError:
+        results['errors'] = ['the file was not well formed xml']
+        return results, None
+    validation = validate_xml(tree, filename, skip_schema)
+    results['valid'] = validation['valid']
+    results['errors'] = validation['errors']
+    if results['valid'] is False:
+        return results, None
+    results['siglum'] = get_siglum(tree)
+    # remove the encoding declaration because etree parser does not support it
+    return results, re.sub(r'<\?xml.+?\?>', '', content.decode('utf-8'))
+
+
+@ensure_csrf_cookie
+@require_http_methods(["POST"])
+@permission_required(['transcriptions.delete_transcription',
+                      'transcriptions.delete_collationunit',
+                      'transcriptions.change_transcription',
+                      'transcriptions.change_collationunit',
+                      'transcriptions.add_transcription',
+                      'transcriptions.add_collationunit',
+                      ], raise_exception=True)
+def index_batch(request):
+    # several files in one upload: they are validated in parallel threads (lxml releases the GIL while
+    # validating) and the valid ones are indexed by a group of tasks followed as a single batch
+    files = request.FILES.getlist('files')
+    if len(files) == 0:
+        return HttpResponse('no files were uploaded', status=400)
+    skip_schema = request.POST.get('skip_schema', False)
+    collection = request.POST.get('collection', 'unknown')
+    languages = [value for key, value in request.POST.items() if key.find('language') == 0 and value != '']
+    contents = [(file.read(), file.name) for file in files]
+    workers = getattr(settings, 'TRANSCRIPTIONS_BATCH_VALIDATION_WORKERS', 4)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        checked = list(executor.map(lambda upload: check_upload(*upload, skip_schema=skip_schema), contents))
+
+    results = [file_results for file_results, xml_string in checked]
+    uploads = [{'xml_string': xml_string, 'siglum': file_results['siglum'],
+                'public_flag': file_results['siglum'] == 'basetext'}
+               for file_results, xml_string in checked if xml_string is not None]
+    task_ids = iter(tasks.start_index_batch(uploads, collection, username=request.user.id, languages=languages))
+    for file_results in results:
+        file_results['task_id'] = next(task_ids) if file_results['valid'] else None
+
+    batch_id = uuid.uuid4().hex
+    progress.register_batch(batch_id, results)
+    progress.set_owner(batch_id, request.user.id)
+    return JsonResponse({'batch_id': batch_id, 'files': results})
 
 
 @login_required
@@ -286,34 +404,110 @@ def schema_download(request):
                       'transcriptions.delete_collationunit'
                       ], raise_exception=True)
 def delete(request):
+    # the deletion is done by a task and its progress can be followed with the progress endpoint
     transcription_id = request.POST.get('delete-transcription', None)
+    work = request.POST.get('work', None) or None
+    siglum = request.POST.get('siglum', None) or None
     if transcription_id is not None:
-        try:
-            models.Transcription.objects.filter(id=transcription_id.split('|')[1]).delete()
-        except Exception:
-            pass
-    return HttpResponseRedirect(reverse('manage'))
+        # the value is the identifier and id of the transcription separated by |
+        parts = transcription_id.split('|')
+        if len(parts) < 2 or not parts[1].isdigit():
+            return HttpResponse('the transcription to delete is not valid', status=400)
+        kwargs = {'ids': [int(parts[1])]}
+        workload = routing.INTERACTIVE
+    elif work is not None or siglum is not None:
+        # bulk deletions are restricted to the transcriptions of the user
+        kwargs = {'user': request.user.id, 'work': work, 'siglum': siglum}
+        workload = routing.BULK
+    else:
+        return HttpResponse('a transcription, work or siglum must be supplied', status=400)
+    task = tasks.delete_transcriptions.apply_async(kwargs=kwargs, **routing.get_options(workload))
+    progress.set_owner(task.task_id, request.user.id)
+    return JsonResponse({'task_id': task.task_id})
+
+
+def stream_rows(rows_template, units, chunk_size=50):
+    # render the rows in chunks as they are read
+    chunk = []
+    for unit in units.iterator(chunk_size=chunk_size):
+        chunk.append(unit)
+        if len(chunk) == chunk_size:
+            yield rows_template.render({'data': chunk})
+            chunk = []
+    if len(chunk) > 0:
+        yield rows_template.render({'data': chunk})
+
+
+def get_collation_units_state(request):
+    # one query provides both the etag and the last modified date so it is stored on the request
+    # to save the condition decorator from repeating it
+    if not hasattr(request, '_collation_units_state'):
+        siglum = request.GET.get('siglum', '')
+        # unit sigla of duplicated units have a -n suffix which the transcription siglum does not
+        transcriptions = models.Transcription.objects.filter(user=request.user, siglum=siglum.split('-')[0])
+        state = transcriptions.order_by().aggregate(count=Count('id'), version=Sum('version'),
+                                                    modified=Max('modified'))
+        key = '{}|{}|{}|{}|{}'.format(request.user.id, request.GET.urlencode(), state['count'], state['version'],
+                                      state['modified'])
+        state['etag'] = hashlib.md5(key.encode('utf-8')).hexdigest()
+        request._collation_units_state = state
+    return request._collation_units_state
+
+
+def cache_stream(stream, cache_key):
+    parts = []
+    for part in stream:
+        parts.append(part)
+        yield part
+    cache.set(cache_key, ''.join(parts), getattr(settings, 'TRANSCRIPTIONS_CACHE_TIMEOUT', 3600))
 
 
 @login_required
+@condition(etag_func=lambda request: get_collation_units_state(request)['etag'],
+           last_modified_func=lambda request: get_collation_units_state(request)['modified'])
 def collation_units(request):
 
+    # the etag changes whenever one of the transcriptions is indexed or deleted so it can be used
+    # as the key for caching the whole page
+    cache_key = 'transcriptions:collationunits:{}'.format(get_collation_units_state(request)['etag'])
+    content = cache.get(cache_key)
+    if content is not None:
+        return HttpResponse(content)
+
     post_login_url = request.path + '?' + request.GET.urlencode()
     login_details = get_login_status(request)
 
     siglum = request.GET.get('siglum', None)
-    units = models.CollationUnit.objects.all().filter(siglum=siglum,
-                                                      user=request.user).distinct().order_by('language',
-                                                                                             'chapter_number',
-                                                                                             'stanza_number',
-                                                                                             'line_number')
+    units = models.CollationUnit.objects.without_tei().filter(siglum=siglum, user=request.user)
+    filters = {}
+    if request.GET.get('language'):
+        filters['language'] = request.GET.get('language')
+        units = units.filter(language=filters['language'])
+    for key, field in [('chapter', 'chapter_number'), ('stanza', 'stanza_number')]:
+        try:
+            filters[key] = int(request.GET.get(key))
+        except (TypeError, ValueError):
+            continue
+        units = units.filter(**{field: filters[key]})
+    units = units.order_by('language', 'chapter_number', 'stanza_number', 'line_number')
+
+    paginator = Paginator(units, getattr(settings, 'TRANSCRIPTIONS_UNITS_PAGE_SIZE', 200))
+    page = paginator.get_page(request.GET.get('page'))
+    query_string = request.GET.copy()
+    query_string.pop('page', None)
 
     context = {
         'login_status': login_details,
         'post_login_url': post_login_url,
         'post_logout_url': '/transcriptions',
         'page_title': 'Collation units for {}'.format(siglum),
-        'data': units
+        'siglum': siglum,
+        'filters': filters,
+        'page': page,
+        'query_string': query_string.urlencode()
         }
 
-    return render(request, 'transcriptions/collation_units.html', context)
+    # the page is sent up to the rows straight away and the rows as they are read
+    rows = stream_rows(get_template('transcriptions/collation_unit_rows.html'), page.object_list)
+    page_parts = stream_template('transcriptions/collation_units.html', context, request, {'rows': rows})
+    return StreamingHttpResponse(cache_stream(page_parts, cache_key))
@@ -0,0 +1,61 @@
+"""Warm the transcription pipeline in each new Celery worker process.
+
+The first task run by a new worker process would otherwise pay for compiling the schema, the first
+use of the parsers and opening the database and cache connections. The worker_process_init signal
+is sent in each process of the prefork pool as it starts, including those started to replace
+processes recycled by max_tasks_per_child or added by autoscaling, so the work is done then with a
+small synthetic transcription instead. The time taken is logged so that the recycling settings can
+be tuned."""
+
+import time
+import logging
+from lxml import etree
+from celery.signals import worker_process_init
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+from transcriptions import validation
+from transcriptions.synthetic import generate_transcription
+
+logger = logging.getLogger(__name__)
+
+
+def warm_up():
+    """Run the pipeline once on a tiny transcription without writing anything and return the seconds of each step."""
+    timings = {}
+    start = time.perf_counter()
+    with validation.get_schema():
+        pass
+    timings['schema'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    xml_string = generate_transcription(chapters=1, stanzas=1, lines=2, app_density=0.5, ritual_directions=0)
+    results = validation.validate_xml(etree.fromstring(xml_string), 'warmup.xml')
+    if results['valid'] is False:
+        raise ValueError('The warm up transcription was not valid: {}'.format(' '.join(results['errors'])))
+    report = validation.dry_run(xml_string, 'warmup.xml')
+    if report['valid'] is False:
+        raise ValueError('The warm up transcription could not be parsed: {}'.format(
+            '; '.join(validation.format_error(error) for error in report['errors'])))
+    timings['pipeline'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    connection.ensure_connection()
+    cache.get('transcriptions:warmup')
+    timings['connections'] = time.perf_counter() - start
+    return timings
+
+
+@worker_process_init.connect
+def warm_worker_process(**kwargs):
+    if not getattr(settings, 'TRANSCRIPTIONS_WORKER_WARM_START', True):
+        return
+    start = time.perf_counter()
+    try:
+        timings = warm_up()
+    except Exception:
+        # a worker which could not be warmed can still run tasks
+        logger.exception('The transcription pipeline could not be warmed up.')
+        return
+    logger.info('Transcription worker warmed up in %.3fs (%s).', time.perf_counter() - start,
+                ', '.join('{} {:.3f}s'.format(step, seconds) for step, seconds in timings.items()))
@@ -0,0 +1,162 @@
+"""Compact storage format for the witnesses of a collation unit.
+
+The word parser produces a list of readings, each with a list of token dictionaries which repeat the
+verse, reading and siglum of the reading and hold values which can be derived from the others. For
+storage the readings are compacted into a dictionary with the format version under 'v' and the
+readings under 'r': the fields shared by every token are moved to the reading, values equal to those
+derived from the rest of the token are left out and the keys are shortened. expand() reverses this
+exactly and returns lists in the original shape unchanged so both can be read at any time.
+
+The derived values are calculated here rather than by the parser so that a stored format version
+always expands in the same way. A change to the format must increase FORMAT_VERSION and keep the
+expansion of the earlier versions.
+"""
+
+FORMAT_VERSION = 1
+
+READING_KEYS = {'id': 'id', 'hand': 'h', 'hand_abbreviation': 'ha', 'gap_reading': 'g'}
+
+READING_DEFAULTS = {'hand': 'firsthand', 'hand_abbreviation': '*'}
+
+TOKEN_KEYS = {
+    'verse': 'v', 'reading': 'rd', 'siglum': 's', 'index': 'i', 'type': 'ty', 't': 't', 'original': 'o',
+    'expanded': 'e', 'lemma': 'l', 'rule_match': 'r', 'language': 'lg', 'foreign': 'f', 'supplied': 'su',
+    'unclear': 'u', 'nomSac': 'n', 'gap_before': 'gb', 'gap_before_details': 'gbd', 'gap_after': 'ga',
+    'gap_details': 'gd', 'pc_before': 'pb', 'pc_after': 'pa', 'rd_before': 'rb', 'rd_after': 'ra',
+    'rdt_before': 'tb', 'rdt_after': 'ta',
+}
+
+# token fields which are the same for every token of a reading and are stored once on the reading
+SHARED_KEYS = ['verse', 'reading', 'siglum']
+
+EXPANDED_TOKEN_KEYS = {short: key for key, short in TOKEN_KEYS.items()}
+EXPANDED_READING_KEYS = {short: key for key, short in READING_KEYS.items()}
+
+
+def normalise(text):
+    for character in '[]{}()':
+        text = text.replace(character, '')
+    return text.lower()
+
+
+def get_default_t(token):
+    if 'lemma' in token:
+        text = token['lemma']
+    else:
+        text = token.get('expanded', token.get('original'))
+    if text is None:
+        return None
+    return normalise(text)
+
+
+def get_default_rule_match(token):
+    if 'original' not in token:
+        return None
+    rule_match = [token.get('lemma', token['original']).lower()]
+    if 'expanded' in token:
+        rule_match.append(token['expanded'].lower())
+    return rule_match
+
+
+def get_default_index(position):
+    # the parser numbers the tokens of a reading 2, 4, 6...
+    return str((position + 1) * 2)
+
+
+def compact_token(token, position, shared):
+    compacted = {}
+    for key, value in token.items():
+        if key in shared:
+            continue
+        if key == 'index' and value == get_default_index(position):
+            continue
+        compacted[TOKEN_KEYS.get(key, key)] = value
+    # the derived values are checked against the complete token
+    if 't' in token and token['t'] == get_default_t(token):
+        del compacted['t']
+    if 'rule_match' in token and token['rule_match'] == get_default_rule_match(token):
+        del compacted['r']
+    return compacted
+
+
+def compact_reading(reading):
+    compacted = {}
+    for key, value in reading.items():
+        if key == 'tokens' or READING_DEFAULTS.get(key, None) == value:
+            continue
+        compacted[READING_KEYS.get(key, key)] = value
+    tokens = reading.get('tokens', [])
+    shared = {}
+    if len(tokens) > 0:
+        for key in SHARED_KEYS:
+            if key in tokens[0] and all(key in token and token[key] == tokens[0][key] for token in tokens):
+                shared[key] = tokens[0][key]
+                compacted[TOKEN_KEYS[key]] = tokens[0][key]
+    compacted['k'] = [compact_token(token, position, shared) for position, token in enumerate(tokens)]
+    return compacted
+
+
+def compact(witnesses):
+    """Return the witnesses in the compact format, None and already compact witnesses are returned unchanged."""
+    if witnesses is None or isinstance(witnesses, dict):
+        return witnesses
+    return {'v': FORMAT_VERSION, 'r': [compact_reading(reading) for reading in witnesses]}
+
+
+def expand_token(token, position, shared):
+    expanded = dict(shared)
+    for key, value in token.items():
+        expanded[EXPANDED_TOKEN_KEYS.get(key, key)] = value
+    if 'index' not in expanded:
+        expanded['index'] = get_default_index(position)
+    if 't' not in expanded:
+        expanded['t'] = get_default_t(expanded)
+    if 'rule_match' not in expanded:
+        expanded['rule_match'] = get_default_rule_match(expanded)
+    return expanded
+
+
+def expand_reading(reading):
+    expanded = {}
+    shared = {}
+    for key, value in reading.items():
+        if key == 'k':
+            continue
+        if key in EXPANDED_TOKEN_KEYS and EXPANDED_TOKEN_KEYS[key] in SHARED_KEYS:
+            shared[EXPANDED_TOKEN_KEYS[key]] = value
+        else:
+            expanded[EXPANDED_READING_KEYS.get(key, key)] = value
+    for key, value in READING_DEFAULTS.items():
+        expanded.setdefault(key, value)
+    expanded['tokens'] = [expand_token(token, position, shared) for position, token in enumerate(reading['k'])]
+    return expanded
+
+
+def expand(witnesses):
+    """Return the witnesses in the shape produced by the word parser whichever format they are stored in."""
+    if witnesses is None or isinstance(witnesses, list):
+        return witnesses
+    if witnesses.get('v') != FORMAT_VERSION:
+        raise ValueError('Unknown witness format version {}.'.format(witnesses.get('v')))
+    return [expand_reading(reading) for reading in witnesses['r']]
+
+
+def get_token_terms(witnesses):
+    """Yield the reading, token, kind and text of each term of the witnesses which is indexed for search.
+
+    The terms of kind 'token' are the normalised token and any other forms it matches in rule_match,
+    those of kind 'lemma' the normalised lemma. Every term is normalised in the same way as the terms
+    searched for.
+    """
+    for reading in expand(witnesses) or []:
+        for token in reading['tokens']:
+            terms = []
+            if token.get('t') is not None:
+                terms.append(normalise(token['t']))
+            for variant in token.get('rule_match') or []:
+                if normalise(variant) not in terms:
+                    terms.append(normalise(variant))
+            for term in terms:
+                yield reading, token, 'token', term
+            if token.get('lemma') is not None:
+                yield reading, token, 'lemma', normalise(token['lemma'])
@@ -9,14 +9,55 @@ import json
 from copy import deepcopy
 from lxml import etree
 from transcriptions.yasna_word_parser import YasnaWordParser as WordParser
-from transcriptions.exceptions import XMLStructureError
+from transcriptions.exceptions import XMLStructureError, DataParsingError
+
+# This must be increased whenever a change to the parsers alters the data they produce so that
+# stored transcriptions can be identified and reindexed with the reindex_all management command.
+PARSER_VERSION = 3
+
+# the number of units word parsed between each progress report
+PROGRESS_BATCH_SIZE = 100
+
+
+def get_siglum_sort_key(siglum):
+    """Get the numerical position of a siglum in the sort order.
+
+    The basetext comes first followed by the numerical sigla with any supplements (S, S1, S2)
+    immediately after the manuscript they supplement. Any other siglum has no key and is sorted
+    alphabetically after the rest.
+    """
+    if siglum == 'basetext':
+        return -1
+    try:
+        return float(siglum)
+    except ValueError:
+        match = re.match(r'^(\d+)S(\d?)$', siglum)
+        if match is not None:
+            sort_key = float(match.group(1)) + 0.1
+            if match.group(2) != '':
+                sort_key += float(match.group(2))/100
+            return sort_key
+    return None
+
+
+def get_chapter_range(root, nsmap):
+    """Return the range of chapters of a transcription as it appears in its identifier (Y28 or Y28-Y34)."""
+    chapters = list(set(root.xpath('.//tei:div[@type="chapter"]/@n', namespaces=nsmap)))
+    chapters = [int(x.split('.')[1])for x in chapters]
+    chapters.sort()
+
+    if len(chapters) == 1:
+        return 'Y{}'.format(chapters[0])
+    elif len(chapters) == 0:
+        return ''
+    return 'Y{}-Y{}'.format(chapters[0], chapters[-1])
 
 
 class YasnaParser(object):
     """Parse a TEI file."""
     def __init__(self, file_string, filename=None, collection='', debug=False,
                  manuscript_id=None, siglum=None, languages=['ae'],
-                 lang=None, private=True, user_id=None):
+                 lang=None, private=True, user_id=None, collect_errors=False):
 
         # parse the file_string into a tree and get the root
         if file_string is None:
@@ -46,6 +87,12 @@ class YasnaParser(object):
         # set other simple features
         self.private = private
         self._debug = debug
+        # when collecting errors each structural error is recorded in errors and the element is
+        # skipped so that every problem in the file can be reported at once
+        self.collect_errors = collect_errors
+        self.errors = []
+        # the ritual directions are moved into the lines once for the document rather than for each language
+        self.ritual_directions_reorganised = False
         self.user_id = user_id
         self.collection = collection
 
@@ -136,18 +183,17 @@ class YasnaParser(object):
             nsmap['tei'] = nsmap.pop(None)
         return nsmap
 
+    def structure_error(self, message, element=None, context=None):
+        """Raise an XMLStructureError or record it if errors are being collected."""
+        if not self.collect_errors:
+            raise XMLStructureError(message)
+        self.errors.append({'message': message,
+                            'line': element.sourceline if element is not None else None,
+                            'context': context})
+
     def get_transcription(self):
         """Make dictionary of data for transcription object."""
-        chapters = list(set(self.root.xpath('.//tei:div[@type="chapter"]/@n', namespaces=self.nsmap)))
-        chapters = [int(x.split('.')[1])for x in chapters]
-        chapters.sort()
-
-        if len(chapters) == 1:
-            self.chapter_range = 'Y{}'.format(chapters[0])
-        elif len(chapters) == 0:
-            self.chapter_range = ''
-        else:
-            self.chapter_range = 'Y{}-Y{}'.format(chapters[0], chapters[-1])
+        self.chapter_range = get_chapter_range(self.root, self.nsmap)
 
         correctors = None
         if len(self.root.xpath('.//tei:listWit/tei:witness', namespaces=self.nsmap)) > 0:
@@ -163,8 +209,10 @@ class YasnaParser(object):
             'tei': self.file_string,
             'source': self.source,
             'siglum': self.siglum,
+            'siglum_sort_key': get_siglum_sort_key(self.siglum),
             'work': self.work,
-            'main_language': self.main_lang
+            'main_language': self.main_lang,
+            'parser_version': PARSER_VERSION
             }
         # if this is a basetext and main language is not Avestan
         # add a capitalised first letter of main language before the Y
@@ -196,12 +244,12 @@ class YasnaParser(object):
                      }
         matcher = r'(?P<work>\w+).(?P<chapter_number>\d+).(?P<stanza_number>\d+).(?P<line_number>\d+)'
         match_object = re.match(matcher, context_info)
-        try:
-            info_dict = match_object.groupdict()
-        except AttributeError as e:
+        if match_object is None:
             message = ('The ab element does not have correctly formatted content in the n attribute.'
                        'Value = {}'.format(context_info))
-            raise XMLStructureError(message) from e
+            self.structure_error(message, ab_element, context_info)
+            return units
+        info_dict = match_object.groupdict()
 
         unit_info['chapter_number'] = int(info_dict['chapter_number'])
         unit_info['stanza_number'] = int(info_dict['stanza_number'])
@@ -212,6 +260,7 @@ class YasnaParser(object):
         unit_info['transcription_identifier'] = self.transcription_id
         unit_info['transcription_siglum'] = self.siglum
         unit_info['siglum'] = self.siglum
+        unit_info['siglum_sort_key'] = get_siglum_sort_key(self.siglum)
 
         # In some projects we would remove the user_id from public transcriptions
         # but in this case we need to make sure people cannot override others basetexts
@@ -309,7 +358,7 @@ class YasnaParser(object):
                         message = 'There is an unexpected XML element in the stanza/verse {}'.format(stanza.get('n'))
                     except Exception:
                         message = 'There is an unexpected XML element in one of the stanzas/verses'
-                    raise XMLStructureError(message)
+                    self.structure_error(message, child, stanza.get('n'))
             # check if anything is left in waiting_ritual_directions and add them to the end of the last line if so
             if len(waiting_ritual_directions) > 0:
                 self.add_ritual_direction_note(previous_line, waiting_ritual_directions, 'end')
@@ -317,8 +366,9 @@ class YasnaParser(object):
 
     def get_all_collation_units(self, language):
         """Get info about collation units from TEI."""
-        if self.collect_ritual_directions is True:
+        if self.collect_ritual_directions is True and not self.ritual_directions_reorganised:
             self.reorganise_ritual_directions()
+            self.ritual_directions_reorganised = True
 
         if language == self.main_lang:
             ab_elements = self.tree.xpath('//tei:ab[@type="line" or @type="verseline"]'
@@ -459,8 +509,12 @@ class YasnaParser(object):
             references.append(unit['reference'])
         return len(set(references))
 
-    def get_data_online(self):
-        """Get all manuscript data."""
+    def get_data_online(self, on_progress=None):
+        """Get all manuscript data.
+
+        If on_progress is supplied it is called with the stage, language and number of units processed
+        once the units of each language are extracted and after every PROGRESS_BATCH_SIZE units are word parsed.
+        """
         data = {}
         data['transcription'] = self.get_transcription()
 
@@ -468,14 +522,23 @@ class YasnaParser(object):
         for language in self.languages:
 
             units = self.get_all_collation_units(language)
+            if on_progress is not None:
+                on_progress('parsed', language, len(units))
 
             corrector_order = None
             if 'corrector_order' in data['transcription']:
                 corrector_order = self.doctor_corrector_order(data['transcription']['corrector_order'])
 
             word_parser = WordParser()
-            for unit in units:
-                unit = word_parser.parse_unit(unit, corrector_order)
+            for i, unit in enumerate(units, 1):
+                try:
+                    unit = word_parser.parse_unit(unit, corrector_order)
+                except (XMLStructureError, DataParsingError) as e:
+                    if not self.collect_errors:
+                        raise
+                    self.errors.append({'message': str(e), 'line': None, 'context': unit['context']})
+                if on_progress is not None and (i % PROGRESS_BATCH_SIZE == 0 or i == len(units)):
+                    on_progress('word_parsed', language, i)
 
             all_units[language] = units
 
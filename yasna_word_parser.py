@@ -3,7 +3,7 @@ import sys
 import re
 from copy import deepcopy
 from lxml import etree
-from transcriptions.exceptions import XMLStructureError
+from transcriptions.exceptions import XMLStructureError, DataParsingError
 
 
 class YasnaWordParser(object):